@@ -0,0 +1,196 @@
+"""
+Evaluates the chunking strategies of utils.chunking offline: how well
+the chunks of a manual are retrieved, and what they cost in tokens.
+
+Every strategy chunks the same pages, then every query retrieves the
+top k chunks (5, as topNDocuments), by BM25 rather than embeddings, so
+it runs without any service. Its scores are a proxy, to compare
+strategies and sizes; not a measure of the deployed search. It
+reports:
+
+- recall@k: queries with the answer in a retrieved chunk
+- MRR: the mean reciprocal rank of the first chunk with the answer
+- chunks, and mean and max tokens per chunk
+- embedded tokens: the tokens embedded to index the manual
+- context tokens: the mean tokens of the retrieved chunks, which are
+  sent to the chat model with every query
+
+The manual is synthetic by default: sections on replacing parts, with
+the torque of their fasteners in a sentence that does not name the
+part, so only the heading ties them. Use --dataset for a real one, as
+JSON: {"pages": [{"page": 1, "content": "..."}], "queries":
+[{"query": "...", "answer": "..."}]}, with headings in Markdown (as
+analyze_pages writes them). Run from the core directory:
+
+    python benchmarks/chunking.py [--dataset manual.json]
+"""
+
+import argparse
+import json
+import math
+import random
+import re
+from collections import Counter
+from typing import Any
+
+import common  # noqa: F401 # pylint: disable=unused-import
+
+# pylint: disable=wrong-import-order
+from langchain_core.documents import Document  # noqa: E402
+from utils.chunking import (CHUNK_OVERLAP_TOKENS,  # noqa: E402
+                            CHUNK_TOKENS, CHUNKING_STRATEGIES, make_chunker)
+from utils.embeddings import EMBEDDING_MODEL  # noqa: E402
+from utils.tokens import get_token_counter  # noqa: E402
+
+PARTS = ('compressor', 'condenser fan', 'evaporator coil', 'expansion valve',
+         'filter drier', 'pressure switch', 'thermostat', 'contactor',
+         'crankcase heater', 'sight glass', 'door gasket', 'drain pump',
+         'defrost timer', 'capacitor', 'blower motor', 'service valve')
+FILLER = ('Isolate the unit at the mains before removing any panel.',
+          'Recover the refrigerant into an approved cylinder.',
+          'Inspect the surrounding wiring for signs of heat damage.',
+          'Record the work in the service log of the unit.',
+          'Check the system for leaks once it is pressurised again.',
+          'Use only parts approved by the manufacturer.',
+          'Clean the area around the mounting points first.',
+          'Support the weight of the assembly while it is unbolted.')
+UNITS = ('indoor', 'outdoor', 'auxiliary')
+WORDS_PER_PAGE = 450
+K = 5
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+
+def make_manual(seed: int = 0) -> dict[str, Any]:
+    """
+    Makes a synthetic manual, and its queries.
+    """
+    rng = random.Random(seed)
+    lines, queries = ['# Service manual'], []
+    for unit in UNITS:
+        for part in PARTS:
+            torque = rng.randint(5, 95)
+            body = rng.sample(FILLER, 6)
+            body.insert(rng.randint(2, 6),
+                        f'Tighten the fasteners to {torque} Nm.')
+            lines += [f'## Replacing the {part} of the {unit} unit'] + body
+            queries.append({
+                'query': f'What torque for the {part} fasteners of the'
+                         f' {unit} unit?',
+                'answer': f'{torque} Nm'})
+
+    pages: list[dict[str, Any]] = []
+    page: list[str] = []
+    for line in lines:
+        page.append(line)
+        if sum(len(text.split()) for text in page) >= WORDS_PER_PAGE:
+            pages.append({'page': len(pages) + 1,
+                          'content': '\n\n'.join(page)})
+            page = []
+    if page:
+        pages.append({'page': len(pages) + 1, 'content': '\n\n'.join(page)})
+    return {'pages': pages, 'queries': queries}
+
+
+def tokenize(text: str) -> list[str]:
+    """
+    Splits text into lowercase words.
+    """
+    return re.findall(r'[a-z0-9]+', text.lower())
+
+
+def rank(query: str, chunks: list[list[str]]) -> list[int]:
+    """
+    Ranks the chunks for the query by BM25.
+
+    Returns:
+        list[int]: The indexes of the chunks, best first
+    """
+    frequencies = [Counter(chunk) for chunk in chunks]
+    average = sum(len(chunk) for chunk in chunks) / len(chunks)
+    documents = Counter(word for chunk in frequencies for word in chunk)
+    scores = []
+    for chunk, frequency in zip(chunks, frequencies):
+        score = 0.0
+        for word in set(tokenize(query)):
+            if not frequency[word]:
+                continue
+            idf = math.log(1 + (len(chunks) - documents[word] + 0.5)
+                           / (documents[word] + 0.5))
+            score += idf * frequency[word] * (BM25_K1 + 1) / (
+                frequency[word] + BM25_K1 * (
+                    1 - BM25_B + BM25_B * len(chunk) / average))
+        scores.append(score)
+    return sorted(range(len(chunks)), key=lambda i: -scores[i])
+
+
+# pylint: disable-next=too-many-locals
+def evaluate(strategy: str, dataset: dict[str, Any], chunk_tokens: int,
+             overlap_tokens: int) -> dict[str, float]:
+    """
+    Chunks the manual with the strategy, and runs its queries.
+    """
+    count_tokens = get_token_counter(EMBEDDING_MODEL)
+    pages = [Document(page_content=page['content'],
+                      metadata={'source': 'manual', 'page': page['page']})
+             for page in dataset['pages']]
+    chunks = [chunk.page_content for chunk in make_chunker(
+        strategy, chunk_tokens, overlap_tokens, count_tokens).split(pages)]
+    tokens = [count_tokens(chunk) for chunk in chunks]
+    words = [tokenize(chunk) for chunk in chunks]
+
+    hits, reciprocal_ranks, context_tokens = 0, 0.0, 0
+    for query in dataset['queries']:
+        top = rank(query['query'], words)[:K]
+        context_tokens += sum(tokens[i] for i in top)
+        for position, i in enumerate(top, 1):
+            if query['answer'] in chunks[i]:
+                hits += 1
+                reciprocal_ranks += 1 / position
+                break
+    queries = len(dataset['queries'])
+    return {
+        'recall': hits / queries,
+        'mrr': reciprocal_ranks / queries,
+        'chunks': len(chunks),
+        'mean_tokens': sum(tokens) / len(chunks),
+        'max_tokens': max(tokens),
+        'embedded_tokens': sum(tokens),
+        'context_tokens': context_tokens / queries,
+    }
+
+
+def main() -> None:
+    """
+    Evaluates every strategy, and prints a table.
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--dataset')
+    parser.add_argument('--chunk-tokens', type=int, default=CHUNK_TOKENS)
+    parser.add_argument('--overlap-tokens', type=int,
+                        default=CHUNK_OVERLAP_TOKENS)
+    parser.add_argument('--strategies', nargs='+',
+                        default=list(CHUNKING_STRATEGIES))
+    args = parser.parse_args()
+
+    if args.dataset:
+        with open(args.dataset, encoding='utf-8') as file:
+            dataset = json.load(file)
+    else:
+        dataset = make_manual()
+
+    print(f"{'strategy':>9} {'recall@5':>9} {'mrr':>6} {'chunks':>7}"
+          f" {'mean tok':>9} {'max tok':>8} {'embedded':>9}"
+          f" {'context':>8}")
+    for strategy in args.strategies:
+        result = evaluate(strategy, dataset, args.chunk_tokens,
+                          args.overlap_tokens)
+        print(f"{strategy:>9} {result['recall']:9.2f} {result['mrr']:6.2f}"
+              f" {result['chunks']:7.0f} {result['mean_tokens']:9.0f}"
+              f" {result['max_tokens']:8.0f}"
+              f" {result['embedded_tokens']:9.0f}"
+              f" {result['context_tokens']:8.0f}")
+
+
+if __name__ == '__main__':
+    main()
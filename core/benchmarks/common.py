@@ -0,0 +1,118 @@
+"""
+Helpers shared by the benchmarks: representative images, and measuring
+a function in a fresh process.
+"""
+
+import multiprocessing
+import resource
+import sys
+import time
+import tracemalloc
+from io import BytesIO
+from pathlib import Path
+from typing import Any, Callable
+
+from PIL import ExifTags, Image
+
+# Makes the function app modules (e.g. utils.image_utils) importable
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'core'))
+
+
+def make_photo(megapixels: float, orientation: int = 1,
+               image_format: str = 'JPEG') -> bytes:
+    """
+    Makes a noisy 4:3 image, which compresses about as badly as a phone
+    photo.
+
+    Args:
+        megapixels (float): The size of the image
+        orientation (int): The EXIF orientation
+        image_format (str): The Pillow format to save as
+
+    Returns:
+        bytes: The encoded image
+    """
+    width = int((megapixels * 1_000_000 * 4 / 3) ** 0.5)
+    height = width * 3 // 4
+    noise = [Image.effect_noise((width, height), sigma)
+             for sigma in (60, 70, 80)]
+    exif = Image.Exif()
+    exif[ExifTags.Base.Orientation] = orientation
+    out = BytesIO()
+    Image.merge('RGB', noise).save(out, format=image_format, quality=95,
+                                   exif=exif)
+    return out.getvalue()
+
+
+def __peak_rss_mb() -> float:
+    """
+    Gets the peak RSS of the process. On Linux, VmHWM is used, because
+    ru_maxrss carries over the peak of the parent across exec.
+    """
+    try:
+        with open('/proc/self/status', encoding='ascii') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in KiB on Linux, and bytes on macOS
+    scale = 2**20 if sys.platform == 'darwin' else 2**10
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+def __measure(function: Callable[..., Any], path: str) -> dict[str, float]:
+    """
+    Calls the function with the contents of the file, and measures it.
+    """
+    content = Path(path).read_bytes()
+    tracemalloc.start()
+    wall, cpu = time.perf_counter(), time.process_time()
+    output = function(content)
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    _, peak_traced = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'wall_ms': wall * 1000,
+        'cpu_ms': cpu * 1000,
+        'peak_python_mb': peak_traced / 2**20,
+        'peak_rss_mb': __peak_rss_mb(),
+        'output_kb': len(output) / 1024,
+    }
+
+
+def measure_in_fresh_process(function: Callable[..., Any],
+                             path: str) -> dict[str, float]:
+    """
+    Calls a module-level function with the contents of a file, in a
+    fresh process, so the peak RSS of one call does not hide another.
+
+    Args:
+        function (Callable[..., Any]): The function to measure. Must
+            return something with a length (e.g. bytes)
+        path (str): The file to read the input from
+
+    Returns:
+        dict[str, float]: Wall and CPU time, peak Python allocations,
+            peak RSS and output size
+    """
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pool.apply(__measure, (function, path))
+
+
+def print_header() -> None:
+    """
+    Prints the header of the results table.
+    """
+    print(f"{'input':>24} {'variant':>12} {'wall ms':>9} {'cpu ms':>9}"
+          f" {'py MB':>7} {'rss MB':>7} {'out KB':>7}")
+
+
+def print_result(label: str, name: str, result: dict[str, float]) -> None:
+    """
+    Prints a row of the results table.
+    """
+    print(f"{label:>24} {name:>12}"
+          f" {result['wall_ms']:9.0f} {result['cpu_ms']:9.0f}"
+          f" {result['peak_python_mb']:7.1f} {result['peak_rss_mb']:7.1f}"
+          f" {result['output_kb']:7.0f}")
@@ -0,0 +1,86 @@
+"""
+Micro-benchmarks compress_image against its implementation before
+draft mode and reducing_gap, over representative images.
+
+Each measurement runs in a fresh process. Run from the core directory:
+
+    python benchmarks/compress_image.py
+"""
+
+import tempfile
+from io import BytesIO
+from typing import Callable
+
+from PIL import Image
+
+from common import (make_photo, measure_in_fresh_process, print_header,
+                    print_result)
+
+# pylint: disable=wrong-import-order
+from utils.image_utils import (compress_image,  # noqa: E402
+                               get_compression_preset)
+
+# label -> (megapixels, EXIF orientation, format)
+IMAGES = {
+    'small JPEG 0.3 MP': (0.3, 1, 'JPEG'),
+    'phone JPEG 12 MP': (12, 1, 'JPEG'),
+    'rotated JPEG 12 MP': (12, 6, 'JPEG'),
+    'phone JPEG 20 MP': (20, 1, 'JPEG'),
+    'screenshot PNG 2.5 MP': (2.5, 1, 'PNG'),
+}
+
+
+def legacy_compress(content: bytes) -> bytes:
+    """
+    compress_image before draft mode and reducing_gap: fully decodes,
+    ignores the EXIF orientation, and resizes with the default
+    resampler.
+    """
+    img = Image.open(BytesIO(content)).convert('RGB')
+    width, height = img.size
+    if width > 600:
+        img = img.resize((600, int(600 * height / width)))
+    out_stream = BytesIO()
+    img.save(out_stream, format='JPEG')
+    return out_stream.getvalue()
+
+
+def default_compress(content: bytes) -> bytes:
+    """
+    compress_image with the default preset.
+    """
+    preset = get_compression_preset('default')
+    return compress_image(content, preset.width, quality=preset.quality)
+
+
+def detailed_compress(content: bytes) -> bytes:
+    """
+    compress_image with the detailed preset.
+    """
+    preset = get_compression_preset('detailed')
+    return compress_image(content, preset.width, quality=preset.quality)
+
+
+VARIANTS: dict[str, Callable[[bytes], bytes]] = {
+    'legacy': legacy_compress,
+    'default': default_compress,
+    'detailed': detailed_compress,
+}
+
+
+def main() -> None:
+    """
+    Runs every variant for every image, and prints a table.
+    """
+    print_header()
+    for label, (megapixels, orientation, image_format) in IMAGES.items():
+        with tempfile.NamedTemporaryFile() as file:
+            file.write(make_photo(megapixels, orientation, image_format))
+            file.flush()
+            for name, variant in VARIANTS.items():
+                print_result(label, name,
+                             measure_in_fresh_process(variant, file.name))
+
+
+if __name__ == '__main__':
+    main()
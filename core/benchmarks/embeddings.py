@@ -0,0 +1,94 @@
+"""
+Benchmarks embedding the chunks of a manual: one call per chunk (as
+embed_query did), against BatchedEmbeddings.
+
+The embeddings are stubbed: every call sleeps for a fixed latency,
+plus a little per text, so the results reflect the round trips rather
+than the model. Run from the core directory:
+
+    python benchmarks/embeddings.py [--chunks 200 1000]
+"""
+
+import argparse
+import random
+import threading
+import time
+from typing import Any
+
+import common  # noqa: F401 # pylint: disable=unused-import
+
+# pylint: disable=wrong-import-order
+from langchain_core.embeddings import Embeddings  # noqa: E402
+from utils.embeddings import BatchedEmbeddings  # noqa: E402
+from utils.tokens import get_token_counter  # noqa: E402
+
+WORDS = ('compressor', 'evaporator', 'thermostat', 'refrigerant', 'valve',
+         'pressure', 'warning', 'install', 'the', 'unit', 'before', 'after')
+
+
+class StubEmbeddings(Embeddings):
+    """
+    Stands in for AzureOpenAIEmbeddings, counting calls.
+    """
+    def __init__(self, latency: float, latency_per_text: float) -> None:
+        self.latency = latency
+        self.latency_per_text = latency_per_text
+        self.calls = 0
+        self.__lock = threading.Lock()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        with self.__lock:
+            self.calls += 1
+        time.sleep(self.latency + len(texts) * self.latency_per_text)
+        return [[0.0] * 1536 for _ in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_documents([text])[0]
+
+
+def make_chunks(chunks: int) -> list[str]:
+    """
+    Makes chunks of a manual, about a page each.
+    """
+    rng = random.Random(chunks)
+    return [' '.join(rng.choices(WORDS, k=rng.randint(200, 500)))
+            for _ in range(chunks)]
+
+
+def main() -> None:
+    """
+    Runs both variants for every number of chunks, and prints a table.
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--chunks', type=int, nargs='+',
+                        default=[200, 1000])
+    parser.add_argument('--latency-ms', type=float, default=150)
+    parser.add_argument('--latency-ms-per-text', type=float, default=5)
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args()
+
+    count_tokens = get_token_counter('text-embedding-ada-002')
+    print(f"{'chunks':>7} {'variant':>10} {'calls':>6} {'wall ms':>9}"
+          f" {'chunks/s':>9} {'tokens/s':>9}")
+    for size in args.chunks:
+        texts = make_chunks(size)
+        tokens = sum(count_tokens(text) for text in texts)
+        for name in ('per_query', 'batched'):
+            stub = StubEmbeddings(args.latency_ms / 1000,
+                                  args.latency_ms_per_text / 1000)
+            embeddings: Any = stub if name == 'per_query' else \
+                BatchedEmbeddings(stub, args.batch_size, args.workers)
+            start = time.perf_counter()
+            if name == 'per_query':
+                for text in texts:
+                    embeddings.embed_query(text)
+            else:
+                embeddings.embed_documents(texts)
+            wall = time.perf_counter() - start
+            print(f"{size:7d} {name:>10} {stub.calls:6d} {wall * 1000:9.0f}"
+                  f" {size / wall:9.1f} {tokens / wall:9.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+Benchmarks the chat image ingest path: validating, decoding and
+compressing a URL encoded phone photo.
+
+Each variant runs in a fresh process that reads the photo from a
+temporary file, so the peak RSS of one does not hide the other, and
+both start from the same baseline. Run from the core directory:
+
+    python benchmarks/image_ingest.py [--megapixels 12 16 20]
+"""
+
+import argparse
+import base64
+import tempfile
+from typing import Callable
+
+import puremagic  # type: ignore[import-untyped]
+
+from common import (make_photo, measure_in_fresh_process, print_header,
+                    print_result)
+
+# pylint: disable=wrong-import-order
+from utils.image_utils import (compress_image,  # noqa: E402
+                               decode_url_encoded_image)
+
+
+def legacy_ingest(content: bytes) -> bytes:
+    """
+    The ingest path before single-pass decoding: the whole image is
+    decoded to be validated, then decoded again to be compressed.
+    """
+    body = content.decode()
+    decoded = base64.b64decode(body.split(',')[1])
+    magic_detection = puremagic.magic_string(decoded)
+    assert magic_detection[0].mime_type.startswith('image')
+    return compress_image(base64.b64decode(body.split(',')[1]))
+
+
+def single_pass_ingest(content: bytes) -> bytes:
+    """
+    The current ingest path.
+    """
+    image = decode_url_encoded_image(content.decode())
+    assert image is not None
+    return compress_image(image)
+
+
+VARIANTS: dict[str, Callable[[bytes], bytes]] = {
+    'legacy': legacy_ingest,
+    'single_pass': single_pass_ingest,
+}
+
+
+def main() -> None:
+    """
+    Runs every variant for every photo size, and prints a table.
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--megapixels', type=int, nargs='+',
+                        default=[12, 16, 20])
+    args = parser.parse_args()
+
+    print_header()
+    for megapixels in args.megapixels:
+        photo = make_photo(megapixels)
+        label = f'{megapixels} MP/{len(photo) / 2**20:.1f} MB'
+        with tempfile.NamedTemporaryFile(suffix='.txt') as file:
+            file.write(b'data:image/jpeg;base64,' + base64.b64encode(photo))
+            file.flush()
+            for name, variant in VARIANTS.items():
+                print_result(label, name,
+                             measure_in_fresh_process(variant, file.name))
+
+
+if __name__ == '__main__':
+    main()
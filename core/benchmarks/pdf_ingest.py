@@ -0,0 +1,177 @@
+"""
+Benchmarks ingesting an uploaded manual into a search index: reading,
+parsing, embedding and uploading it whole, against the streaming
+pipeline of utils.ingestion.
+
+Document Intelligence and the vector store are stubbed: the client
+makes a page of text per PAGE_BYTES of the document (read from the
+request, or from its URL without any upload), and the vector
+store embeds every page as a 1536 dimension vector, then keeps the
+upload payload until add_documents returns, as AzureSearch does. Each
+variant runs in a fresh process; the streaming one also hashes the
+blob (for the ingestion cache) and chunks the pages. Run from the
+core directory:
+
+    python benchmarks/pdf_ingest.py [--pages 100 500 1000]
+"""
+
+import argparse
+import tempfile
+from io import BytesIO
+from typing import Callable, Iterable, Optional
+
+from common import measure_in_fresh_process, print_header, print_result
+
+# pylint: disable=wrong-import-order
+from langchain_core.documents import Document  # noqa: E402
+from utils.chunking import make_chunker  # noqa: E402
+from utils.ingestion import analyze_pages, ingest  # noqa: E402
+from utils.ingestion_cache import hash_file  # noqa: E402
+
+PAGE_BYTES = 20 * 1024
+WORDS_PER_PAGE = 600
+DIMENSIONS = 1536
+
+
+class StubPage:
+    """
+    A page of an AnalyzeResult.
+    """
+    def __init__(self, number: int) -> None:
+        self.page_number = number
+        self.lines = [StubLine(f'line {i} of page {number} of the manual')
+                      for i in range(WORDS_PER_PAGE // 8)]
+
+
+class StubLine:  # pylint: disable=too-few-public-methods
+    """
+    A line of a page.
+    """
+    def __init__(self, content: str) -> None:
+        self.content = content
+
+
+class StubPoller:  # pylint: disable=too-few-public-methods
+    """
+    The poller of an analysis, with its result.
+    """
+    def __init__(self, pages: list[StubPage]) -> None:
+        self.pages = pages
+        self.paragraphs = None
+
+    def result(self) -> 'StubPoller':
+        """
+        Gets the result, which has the pages.
+        """
+        return self
+
+
+class StubClient:
+    """
+    Stands in for DocumentAnalysisClient, for a document of size bytes
+    in blob storage.
+    """
+    def __init__(self, size: int = 0) -> None:
+        self.size = size
+
+    def begin_analyze_document(self, model: str, document: BytesIO,
+                               pages: str = '') -> StubPoller:
+        """
+        Analyses the pages of the document, or all of them.
+        """
+        del model
+        # Uploads the document a buffer at a time, as the SDK does
+        return self.__analyze(sum(len(buffer) for buffer in iter(
+            lambda: document.read(2**20), b'')), pages)
+
+    def begin_analyze_document_from_url(self, model: str, document_url: str,
+                                        pages: str = '') -> StubPoller:
+        """
+        Analyses the pages of the document in blob storage, or all of
+        them.
+        """
+        del model, document_url
+        return self.__analyze(self.size, pages)
+
+    @staticmethod
+    def __analyze(size: int, pages: str) -> StubPoller:
+        count = size // PAGE_BYTES
+        first, last = (int(page) for page in pages.split('-')) \
+            if pages else (1, count)
+        return StubPoller([StubPage(number) for number in
+                           range(first, min(last, count) + 1)])
+
+
+class StubVectorStore:  # pylint: disable=too-few-public-methods
+    """
+    Stands in for AzureSearch.
+    """
+    def add_documents(self, documents: Iterable[Document],
+                      keys: Optional[list[str]] = None) -> None:
+        """
+        Embeds the documents, and builds their upload payload.
+        """
+        del keys
+        payload = [{'content': document.page_content,
+                    'metadata': document.metadata,
+                    'content_vector': [float(i) for i in range(DIMENSIONS)]}
+                   for document in documents]
+        del payload
+
+
+def legacy_ingest(content: bytes) -> bytes:
+    """
+    Ingestion before streaming: the whole document is read, analysed,
+    and added at once.
+    """
+    blob = BytesIO(content)
+    data = blob.read()
+    result = StubClient().begin_analyze_document(
+        'prebuilt-document', BytesIO(data)).result()
+    documents = [Document(page_content=' '.join(line.content
+                                                for line in page.lines),
+                          metadata={'page': page.page_number})
+                 for page in result.pages]
+    StubVectorStore().add_documents(documents)
+    return str(len(documents)).encode()
+
+
+def streaming_ingest(content: bytes) -> bytes:
+    """
+    The current ingestion.
+    """
+    hash_file(BytesIO(content))
+    pages = analyze_pages(StubClient(len(content)), 'prebuilt-document',
+                          lambda: 'https://account.blob.core.windows.net/x')
+    count = ingest(make_chunker('headings').split(pages),
+                   StubVectorStore())  # type: ignore[arg-type]
+    return str(count).encode()
+
+
+VARIANTS: dict[str, Callable[[bytes], bytes]] = {
+    'legacy': legacy_ingest,
+    'streaming': streaming_ingest,
+}
+
+
+def main() -> None:
+    """
+    Runs every variant for every size of manual, and prints a table.
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--pages', type=int, nargs='+',
+                        default=[100, 500, 1000])
+    args = parser.parse_args()
+
+    print_header()
+    for pages in args.pages:
+        with tempfile.NamedTemporaryFile(suffix='.pdf') as file:
+            file.write(b'%PDF' + b'\0' * (pages * PAGE_BYTES - 4))
+            file.flush()
+            for name, function in VARIANTS.items():
+                result = measure_in_fresh_process(function, file.name)
+                print_result(f'{pages} pages', name, result)
+
+
+if __name__ == '__main__':
+    main()
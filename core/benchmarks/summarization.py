@@ -0,0 +1,118 @@
+"""
+Benchmarks summarizing long conversations, with the refine and
+mapreduce strategies of chat_done, over chunks of 4000 characters (the
+former default) or chunks packed up to a token budget.
+
+The OpenAI client is stubbed: every completion sleeps for a fixed
+latency, plus a little per input character, so the results reflect the
+round trips rather than the model. Tokens are counted with tiktoken
+(estimated if the encoding cannot be downloaded). Run from the core
+directory:
+
+    python benchmarks/summarization.py [--messages 50 200 800]
+"""
+
+import argparse
+import random
+import time
+from types import SimpleNamespace
+from typing import Any
+
+import common  # noqa: F401 # pylint: disable=unused-import
+
+# pylint: disable=wrong-import-order
+from langchain.text_splitter import \
+    RecursiveCharacterTextSplitter  # noqa: E402
+from utils.summarization import (SummaryUsage,  # noqa: E402
+                                 get_token_counter, split_conversation,
+                                 summarize_map_reduce, summarize_refine)
+
+MODEL = 'gpt-35-turbo'
+WORDS = ('the', 'fridge', 'is', 'not', 'cooling', 'compressor', 'error',
+         'code', 'E5', 'door', 'seal', 'model', 'manual', 'reset', 'fan',
+         'thermostat', 'please', 'check', 'power', 'supply', 'filter')
+
+
+class StubCompletions:  # pylint: disable=too-few-public-methods
+    """
+    Stands in for client.chat.completions, counting calls.
+    """
+    def __init__(self, latency: float, latency_per_char: float) -> None:
+        self.latency = latency
+        self.latency_per_char = latency_per_char
+        self.count_tokens = get_token_counter(MODEL)
+
+    def create(self, model: str,  # pylint: disable=unused-argument
+               messages: list[dict[str, str]]) -> Any:
+        """
+        Sleeps like a completion, and returns a short summary.
+        """
+        size = sum(len(message['content']) for message in messages)
+        time.sleep(self.latency + size * self.latency_per_char)
+        summary = ' '.join(random.choices(WORDS, k=150))
+        return SimpleNamespace(
+            choices=[SimpleNamespace(
+                message=SimpleNamespace(content=summary))],
+            usage=SimpleNamespace(
+                prompt_tokens=sum(self.count_tokens(message['content'])
+                                  for message in messages),
+                completion_tokens=self.count_tokens(summary)))
+
+
+def make_transcript(messages: int) -> list[str]:
+    """
+    Makes the messages of a conversation, formatted the way chat_done
+    formats them.
+    """
+    rng = random.Random(messages)
+    return [f"{'USER' if i % 2 == 0 else 'BOT'}: "
+            f"{' '.join(rng.choices(WORDS, k=rng.randint(10, 120)))}"
+            for i in range(messages)]
+
+
+def main() -> None:
+    """
+    Runs every chunker and strategy for every conversation length, and
+    prints a table.
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--messages', type=int, nargs='+',
+                        default=[50, 200, 800])
+    parser.add_argument('--latency-ms', type=float, default=300)
+    parser.add_argument('--latency-us-per-char', type=float, default=20)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--token-budget', type=int, default=6000)
+    args = parser.parse_args()
+
+    print(f"{'messages':>9} {'chunker':>8} {'chunks':>7} {'strategy':>10}"
+          f" {'calls':>6} {'in tok':>8} {'out tok':>8} {'wall ms':>9}")
+    for messages in args.messages:
+        transcript = make_transcript(messages)
+        chunkers = {
+            'chars': RecursiveCharacterTextSplitter().split_text(
+                '\n'.join(transcript)),
+            'tokens': split_conversation(transcript, MODEL,
+                                         args.token_budget),
+        }
+        for chunker, chunks in chunkers.items():
+            for name in ('refine', 'mapreduce'):
+                client: Any = SimpleNamespace(chat=SimpleNamespace(
+                    completions=StubCompletions(
+                        args.latency_ms / 1000,
+                        args.latency_us_per_char / 10**6)))
+                usage = SummaryUsage()
+                start = time.perf_counter()
+                if name == 'refine':
+                    summarize_refine(chunks, client, MODEL, usage=usage)
+                else:
+                    summarize_map_reduce(chunks, client, MODEL,
+                                         args.workers, usage=usage)
+                wall = time.perf_counter() - start
+                print(f"{messages:9d} {chunker:>8} {len(chunks):7d}"
+                      f" {name:>10} {usage.calls:6d}"
+                      f" {usage.prompt_tokens:8d}"
+                      f" {usage.completion_tokens:8d} {wall * 1000:9.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -21,8 +21,12 @@ from functions.chat_connection import main as chat_connection
 from functions.chat_done import main as chat_done
 from functions.chat_history import main as chat_history
 from functions.file_upload_trigger import main as file_upload_trigger
+from functions.summarization_status import main as summarization_status
+from functions.summarization_worker import main as summarization_worker
 from functions.validation_to_production import main as validation_to_production
 from functions.work_order import main as work_order
+from utils.job_queue import SUMMARIZATION_QUEUE_NAME
+from utils.services import Services
 from utils.verify_token import verify_token
 
 logging.basicConfig(level=logging.INFO)
@@ -50,7 +54,8 @@ def __auth_guard(req: func.HttpRequest,
             "Unauthenticated",
             status_code=401
         )
-    return fn(req)
+    with Services().db_session_scope():
+        return fn(req)
 
 
 # NOTE: Chat is a special WebPubSubTrigger endpoint. Traditionally,
@@ -66,7 +71,8 @@ def __auth_guard(req: func.HttpRequest,
                     eventName='message',
                     eventType='user')
 def __chat_main(request: str) -> None:
-    chat_main(request)
+    with Services().db_session_scope():
+        chat_main(request)
 
 
 @bp.function_name('chat_connection')
@@ -84,7 +90,8 @@ def __chat_history(req: func.HttpRequest) -> func.HttpResponse:
 @bp.function_name('file_upload_trigger')
 @bp.blob_trigger('blob', 'verification/{fileName}', 'DocumentStorageContainer')
 def __file_upload_trigger(blob: func.InputStream) -> None:
-    file_upload_trigger(blob)
+    with Services().db_session_scope():
+        file_upload_trigger(blob)
 
 
 @bp.function_name('validation_to_production')
@@ -105,5 +112,18 @@ def __chat_done(req: func.HttpRequest) -> func.HttpResponse:
     return __auth_guard(req, chat_done)
 
 
+@bp.function_name("summarization_status")
+@bp.route(methods=["GET"])
+def __summarization_status(req: func.HttpRequest) -> func.HttpResponse:
+    return __auth_guard(req, summarization_status)
+
+
+@bp.function_name("summarization_worker")
+@bp.queue_trigger('msg', SUMMARIZATION_QUEUE_NAME, 'AzureWebJobsStorage')
+def __summarization_worker(msg: func.QueueMessage) -> None:
+    with Services().db_session_scope():
+        summarization_worker(msg)
+
+
 app = func.FunctionApp()
 app.register_functions(bp)
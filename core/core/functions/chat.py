@@ -11,21 +11,27 @@ References:
 import base64
 import logging
 import re
+from concurrent.futures import (FIRST_COMPLETED, Future, ThreadPoolExecutor,
+                                wait)
 from datetime import datetime
 from json import JSONDecodeError
-from typing import Callable, cast
+from typing import Any, Callable, NoReturn, Optional
 from uuid import uuid4
 
 from azure.core.exceptions import ResourceNotFoundError
-from openai.types.chat import ChatCompletionMessageParam
-from models.chat_message import ChatMessageDAO, ChatMessageModel, SenderTypes
+from openai.types.chat import ChatCompletion, ChatCompletionMessageParam
+from models.chat_message import (ChatMessageBuffer, ChatMessageDAO,
+                                 ChatMessageModel)
 from utils.authorise_conversation import authorise_user
 from utils.chat_message import (BidirectionalChatMessage, ChatMessage,
-                                ResponseChatMessage, ResponseErrorMessage,
-                                Citation, translate_citation_urls)
+                                ResponseChatMessage, ResponseDeltaMessage,
+                                ResponseErrorMessage, Citation,
+                                translate_citation_urls)
+from utils.get_preauthenticated_blob_url import get_container_sas_token
 from utils.get_user_id import get_user_id
 from utils.hashing import get_search_index_for_user_id
-from utils.image_utils import compress_image, is_url_encoded_image
+from utils.image_utils import (compress_image, decode_url_encoded_image,
+                               get_compression_preset)
 from utils.search_utils import does_index_exist
 from utils.verify_token import verify_token
 from utils.web_pub_sub_interfaces import WebPubSubRequest
@@ -40,6 +46,8 @@ You are a helpful chatbot named DiagnoseAI. You have access to the summaries of
 
 OPENAI_API_VERSION = '2024-03-01-preview'
 EMBEDDING_DEPLOYMENT_NAME = "text-embedding-ada-002"
+# Number of most recent messages sent to the model, in order of preference
+HISTORY_WINDOWS = [10, 5, 1]
 
 logging.basicConfig(level=logging.INFO)
 
@@ -71,7 +79,8 @@ def ws_send_message(text: str, connection_id: str) -> None:
 def shadow_msg_to_db(
         conversation_id: str, message: str, sender_is_bot: bool,
         is_image: bool, citations: list[Citation],
-        additional_context: str = ''
+        additional_context: str = '',
+        pending: Optional[ChatMessageBuffer] = None
 ) -> None:
     """
     Shadows the message to the database.
@@ -83,26 +92,31 @@ def shadow_msg_to_db(
         is_image (bool): Whether the message is an image
         citations (list[Citation]): The citations
         additional_context (str, optional): Additional context. Defaults to ''.
+        pending (Optional[ChatMessageBuffer], optional): If given, the
+            message is buffered until the buffer is flushed, instead of
+            being saved immediately. Defaults to None.
     """
     # Ethereal messages; don't store history
     if conversation_id == '-1':
         logging.info('Ethereal conversation, not storing history')
         return
 
-    ChatMessageDAO.save_message(
-        Services().db_session,
-        ChatMessageModel.from_bidirectional_chat_message(
-            BidirectionalChatMessage(
-                message=message,
-                conversation_id=conversation_id,
-                sent_at=datetime.now(),
-                is_image=is_image,
-                citations=citations,
-                sender='bot' if sender_is_bot else 'user',
-            ),
-            additional_context
-        )
+    model = ChatMessageModel.from_bidirectional_chat_message(
+        BidirectionalChatMessage(
+            message=message,
+            conversation_id=conversation_id,
+            sent_at=datetime.now(),
+            is_image=is_image,
+            citations=citations,
+            sender='bot' if sender_is_bot else 'user',
+        ),
+        additional_context
     )
+    if pending is not None:
+        pending.add(model)
+        return
+
+    ChatMessageDAO.save_message(Services().db_session, model)
 
 
 def db_history_to_ai_history(conversation_id: str, history_size: int = 10) \
@@ -112,17 +126,8 @@ def db_history_to_ai_history(conversation_id: str, history_size: int = 10) \
     format. Pure images are ignored, because it is assumed that the
     interpeted text will be sent back to the user
     """
-    history = ChatMessageDAO.get_all_messages_for_conversation(
-        Services().db_session, conversation_id, count=history_size)
-
-    # Should either match ChatCompletionSystemMessageParam or
-    # ChatCompletionUserMessageParam, so we cast to make typing happy
-    return [
-        cast(ChatCompletionMessageParam,
-             {'role': 'assistant' if msg.sender == SenderTypes.BOT else 'user',
-              'content': msg.message if not msg.is_image
-              else msg.additional_context}
-             ) for msg in history if not msg.is_image]
+    return ChatMessageDAO.get_ai_history(
+        Services().db_session, conversation_id, history_size)
 
 
 def ws_log_and_send_error(text: str, connection_id: str) -> None:
@@ -184,7 +189,8 @@ def __process_message_image(message: ChatMessage,
         Tuple[str, str]: filename and summary
     """
     logging.info('message claims to be an image %s', connection_id)
-    if not is_url_encoded_image(message.message):
+    image = decode_url_encoded_image(message.message)
+    if image is None:
         ws_log_and_send_error(
             ('message claims to be an image, but is not a URL encoded'
              f' image. for debugging purposes, you were {connection_id}'),
@@ -192,9 +198,10 @@ def __process_message_image(message: ChatMessage,
         raise RuntimeError('message is not a URL encoded image')
 
     logging.info('message is a URL encoded image %s', connection_id)
-    image = message.message.split(',')[1]
+    preset = get_compression_preset(Secrets().get("ImageCompressionPreset"))
     try:
-        compressed = compress_image(base64.b64decode(image))
+        compressed = compress_image(image, preset.width,
+                                    quality=preset.quality)
         compressed_object_url = (
             "data:image/jpeg;base64,"
             f"{base64.b64encode(compressed).decode()}")
@@ -204,18 +211,30 @@ def __process_message_image(message: ChatMessage,
              f' for debugging purposes, you were {connection_id}'),
             connection_id)
         raise e
-
-    filename = __upload_image_to_blob(message, compressed)
-
+    finally:
+        # The decoded image can be tens of megabytes; let it go early
+        image.release()
+
+    # The upload and the summary only depend on the compressed image,
+    # so the upload runs while the image is being summarised
+    executor = ThreadPoolExecutor(max_workers=1)
+    upload = executor.submit(__upload_image_to_blob, message, compressed)
     try:
-        summary = Services().image_summary_model.get_image_summary(
-            compressed_object_url)
+        summary = Services().image_summary_cache.get_or_create(
+            compressed,
+            lambda: Services().image_summary_model.get_image_summary(
+                compressed_object_url))
     except Exception as e:  # pylint: disable=[broad-exception-caught]
         ws_log_and_send_error(
             ('message claims to be an image, but cannot be interpreted.'
                 f' for debugging purposes, you were {connection_id}'),
             connection_id)
         raise e
+    finally:
+        executor.shutdown(wait=False)
+
+    # Falls back to the data URL if the upload failed
+    filename = upload.result()
     return (filename, summary)
 
 
@@ -247,106 +266,287 @@ def strip_all_citations(completion: str) -> str:
     return re.sub(doc_regex, '', completion)
 
 
+def __citation_count(chat_response: ChatCompletion) -> int:
+    """
+    Counts the citations in a chat response. Responses without any
+    choices have no citations.
+    """
+    if len(chat_response.choices) == 0:
+        return 0
+    # Context definitely exists; but the SDK doesn't know it.
+    return len(chat_response.choices[0].message.context['citations'])  # type: ignore # noqa: E501
+
+
+def __best_response(responses: list[ChatCompletion]) -> ChatCompletion:
+    """
+    Picks the response with the most citations.
+
+    Args:
+        responses (list[ChatCompletion]): The responses, ordered from
+            the largest history window to the smallest
+
+    Returns:
+        ChatCompletion: The best response
+    """
+    # Subtle note: It is GUARANTEED by the python implementation
+    # of max that in the event of a tie, it will be the first
+    # argument, i.e. the larger history window
+    return max(responses, key=__citation_count)
+
+
+def __query_history_windows_serially(
+        create: Callable[[int], ChatCompletion]) -> ChatCompletion:
+    """
+    Tries each history window one after another, until a response
+    carries citations.
+
+    Args:
+        create (Callable[[int], ChatCompletion]): Creates a chat
+            completion given the max history
+
+    Returns:
+        ChatCompletion: The best response
+    """
+    responses: list[ChatCompletion] = []
+    for max_history in HISTORY_WINDOWS:
+        logging.info('Trying max_history=%d', max_history)
+        responses.append(create(max_history))
+
+        # break early, if there are already citations it should be
+        # quite relevant to the context
+        if __citation_count(responses[-1]) > 0:
+            break
+    return __best_response(responses)
+
+
+def __query_history_windows_concurrently(
+        create: Callable[[int], ChatCompletion],
+        hedge_delay: float) -> ChatCompletion:
+    """
+    Fans out the history windows concurrently, and returns the first
+    response that carries citations. The rest are ignored, as are
+    windows that fail, unless they all do.
+
+    A window is launched whenever the hedge delay passes without a
+    response, or when a response without citations comes back. A hedge
+    delay of 0 launches all windows at once.
+
+    Args:
+        create (Callable[[int], ChatCompletion]): Creates a chat
+            completion given the max history
+        hedge_delay (float): Seconds to wait before launching the next
+            window
+
+    Returns:
+        ChatCompletion: The best response
+    """
+    windows = iter(HISTORY_WINDOWS)
+    responses: dict[int, ChatCompletion] = {}
+    pending: dict[Future[ChatCompletion], int] = {}
+    error: Optional[Exception] = None
+    executor = ThreadPoolExecutor(max_workers=len(HISTORY_WINDOWS))
+
+    def launch_next() -> bool:
+        max_history = next(windows, None)
+        if max_history is None:
+            return False
+        logging.info('Trying max_history=%d', max_history)
+        pending[executor.submit(create, max_history)] = max_history
+        return True
+
+    try:
+        launch_next()
+        while hedge_delay == 0 and launch_next():
+            pass
+        while pending:
+            done, _ = wait(pending, timeout=hedge_delay or None,
+                           return_when=FIRST_COMPLETED)
+            for future in done:
+                max_history = pending.pop(future)
+                try:
+                    responses[max_history] = future.result()
+                # pylint: disable-next=[broad-exception-caught]
+                except Exception as e:
+                    # Another window may still answer (e.g. after a 429)
+                    logging.warning('max_history=%d failed: %s',
+                                    max_history, e)
+                    error = e
+                    continue
+                if __citation_count(responses[max_history]) > 0:
+                    logging.info('max_history=%d won', max_history)
+                    return responses[max_history]
+            launch_next()
+    finally:
+        # Losing windows cannot be interrupted mid-request; their
+        # responses are simply ignored
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    if not responses:
+        assert error is not None
+        raise error
+    return __best_response([responses[max_history]
+                            for max_history in HISTORY_WINDOWS
+                            if max_history in responses])
+
+
 # pylint: disable=too-many-arguments # noqa: E501
-def __query_llm_with_index(
+def __create_completion(
         messages: list[ChatCompletionMessageParam],
+        max_history: int,
         document_index: str,
         search_endpoint: str,
         search_key: str,
         prompt: str,
-        connection_id: str) -> tuple[str, list[Citation]]:
+        stream: bool = False) -> Any:
     """
-    Queries the AI model from the validation document index.
+    Creates a chat completion grounded on a search index.
 
     Args:
         messages (list[ChatCompletionMessageParam]): The messages to
             send to the model
+        max_history (int): The number of most recent messages to send
         document_index (str): The document index to query
         search_endpoint (str): The search endpoint
         search_key (str): The search key
         prompt (str): Model Prompt
-        connection_id (str): The connection ID
+        stream (bool, optional): Whether to stream the
+            completion. Defaults to False.
 
     Returns:
-        tuple[str, list[Citation]]: The response and the citations
+        Any: A ChatCompletion, or a Stream of ChatCompletionChunk if
+            streaming
     """
-    best_response = None
+    embedding_endpoint = Secrets().get("OpenAIEndpoint")
+    return Services().openai_chat_model.chat.completions.create(
+        model=Secrets().get("OpenAIModelName"),
+        extra_body={
+            "data_sources": [
+                {
+                    "type": "AzureCognitiveSearch",
+                    "parameters": {
+                        "endpoint": search_endpoint,
+                        "key": search_key,
+                        "indexName": document_index,
+                        "semanticConfiguration": "default",
+                        "queryType": "vector",
+                        "embeddingEndpoint": (
+                            f"{embedding_endpoint}/openai/"
+                            f"deployments/{EMBEDDING_DEPLOYMENT_NAME}/"
+                            f"embeddings?api-version={OPENAI_API_VERSION}"
+                        ),
+                        "embeddingKey": Secrets().get("OpenAIKey"),
+                        "fieldsMapping": {
+                            "filepath_field": "filepath"
+                        },
+                        "inScope": True,
+                        "filter": None,
+                        "strictness": 1,
+                        "topNDocuments": 5,
+                        "roleInformation": prompt
+                    }
+                }
+            ],
+        },
+        messages=messages[-max_history:],
+        temperature=0,
+        top_p=1,
+        max_tokens=800,
+        stream=stream,
+    )
 
-    if not does_index_exist(document_index, Services().search_index_client):
-        logging.info('Index %s does not exists', document_index)
+
+def __send_chat_error(message: str, connection_id: str,
+                      send_errors: bool) -> NoReturn:
+    """
+    Raises a ChatError, sending its message to the connection first,
+    unless send_errors is False (e.g. for a speculative query, whose
+    response may be discarded).
+
+    Args:
+        message (str): The error message
+        connection_id (str): The connection ID
+        send_errors (bool): Whether to send the error
+
+    Raises:
+        ChatError: Always
+    """
+    if send_errors:
         ws_log_and_send_error(
-            ('Document index does not exist.'
-             f' for debugging purposes, you were {connection_id}'),
+            f'{message}. for debugging purposes, you were {connection_id}',
             connection_id)
-        raise ChatError('Document index does not exist')
+    raise ChatError(message)
 
-    for max_history in [10, 5, 1]:
-        logging.info('Trying max_history=%d', max_history)
-        embedding_endpoint = Secrets().get("OpenAIEndpoint")
-        embedding_key = Secrets().get("OpenAIKey")
-        chat_response = Services().openai_chat_model.chat.completions.create(
-            model=Secrets().get("OpenAIModelName"),
-            extra_body={
-                "data_sources": [
-                    {
-                        "type": "AzureCognitiveSearch",
-                        "parameters": {
-                            "endpoint": search_endpoint,
-                            "key": search_key,
-                            "indexName": document_index,
-                            "semanticConfiguration": "default",
-                            "queryType": "vector",
-                            "embeddingEndpoint": (
-                                f"{embedding_endpoint}/openai/"
-                                f"deployments/{EMBEDDING_DEPLOYMENT_NAME}/"
-                                f"embeddings?api-version={OPENAI_API_VERSION}"
-                            ),
-                            "embeddingKey": embedding_key,
-                            "fieldsMapping": {
-                                "filepath_field": "filepath"
-                            },
-                            "inScope": True,
-                            "filter": None,
-                            "strictness": 1,
-                            "topNDocuments": 5,
-                            "roleInformation": prompt
-                        }
-                    }
-                ],
-            },
-            messages=messages[-max_history:],
-            temperature=0,
-            top_p=1,
-            max_tokens=800,
-        )
 
-        if best_response is None:
-            best_response = chat_response
+def __ensure_index_exists(document_index: str, connection_id: str,
+                          send_errors: bool = True) -> None:
+    """
+    Ensures that the document index exists before querying it.
 
-        assert best_response is not None
-        # Subtle note: It is GUARANTEED by the python implementation
-        # of max that in the event of a tie, it will be the first
-        # argument
-        best_response = max(best_response, chat_response,
-                            key=lambda x:
-                            len(x.choices[0].message.context['citations'])  # type: ignore # noqa: E501
-                            if len(x.choices) > 0 else 0)
+    Args:
+        document_index (str): The document index to query
+        connection_id (str): The connection ID
+        send_errors (bool, optional): Whether to send errors to the
+            connection. Defaults to True.
 
-        # break early, if there are already citations it should be
-        # quite relevant to the context
-        if len(best_response.choices) > 0 and \
-           len(best_response.choices[0].message.context['citations']) > 0:  # type: ignore # noqa: E501
-            break
+    Raises:
+        ChatError: If the index does not exist
+    """
+    if not does_index_exist(document_index, Services().search_index_client):
+        logging.info('Index %s does not exists', document_index)
+        __send_chat_error('Document index does not exist', connection_id,
+                          send_errors)
+
+
+# pylint: disable=too-many-arguments # noqa: E501
+def __query_llm_with_index(
+        messages: list[ChatCompletionMessageParam],
+        document_index: str,
+        search_endpoint: str,
+        search_key: str,
+        prompt: str,
+        connection_id: str,
+        send_errors: bool = True) -> tuple[str, list[Citation]]:
+    """
+    Queries the AI model from the validation document index.
+
+    The history windows are tried according to ChatHistoryStrategy;
+    serially by default, concurrently with "parallel", or with a
+    delayed hedge of ChatHistoryHedgeDelayMs with "hedged".
+
+    Args:
+        messages (list[ChatCompletionMessageParam]): The messages to
+            send to the model
+        document_index (str): The document index to query
+        search_endpoint (str): The search endpoint
+        search_key (str): The search key
+        prompt (str): Model Prompt
+        connection_id (str): The connection ID
+        send_errors (bool, optional): Whether to send errors to the
+            connection, rather than only raise them. Defaults to True.
+
+    Returns:
+        tuple[str, list[Citation]]: The response and the citations
+    """
+    __ensure_index_exists(document_index, connection_id, send_errors)
+
+    def create(max_history: int) -> ChatCompletion:
+        return __create_completion(messages, max_history, document_index,
+                                   search_endpoint, search_key, prompt)
+
+    strategy = Secrets().get("ChatHistoryStrategy")
+    if strategy == 'parallel':
+        best_response = __query_history_windows_concurrently(create, 0)
+    elif strategy == 'hedged':
+        best_response = __query_history_windows_concurrently(
+            create, int(Secrets().get("ChatHistoryHedgeDelayMs")) / 1000)
+    else:
+        best_response = __query_history_windows_serially(create)
 
-    assert best_response is not None
     logging.info('%s: model response received', connection_id)
     if len(best_response.choices) == 0 \
        or best_response.choices[0].message.content is None:
-        ws_log_and_send_error(
-            ('no response from AI chat.'
-             f' for debugging purposes, you were {connection_id}'),
-            connection_id)
-        raise ChatError('no response from AI chat')
+        __send_chat_error('no response from AI chat', connection_id,
+                          send_errors)
 
     citations: list[Citation] = [
         Citation.from_dict(raw_citation)
@@ -358,42 +558,151 @@ def __query_llm_with_index(
     return best_response.choices[0].message.content, citations
 
 
-def process_message(message: ChatMessage, connection_id: str) -> None:
+# pylint: disable=too-many-arguments # noqa: E501
+def __stream_llm_with_index(
+        messages: list[ChatCompletionMessageParam],
+        document_index: str,
+        search_endpoint: str,
+        search_key: str,
+        prompt: str,
+        connection_id: str,
+        conversation_id: str) -> tuple[str, list[Citation]]:
     """
-    Processes the message received from the request.
+    Queries the AI model from the document index, streaming the
+    response to the connection as ResponseDeltaMessages.
 
-    For now, the message goes directly into Azure OpenAI, which spits
-    out a chat message.
+    The citations arrive with the first chunks, before any content;
+    hence, a history window without citations is abandoned before any
+    delta is sent, and the next window is tried. If no window has
+    citations, the largest window is requested again and streamed, as
+    ties favour it (see __best_response).
 
     Args:
-        message (ChatMessage): The ChatMessage object deserialize from the
-                               input
-        connection_id (str): The conneciton ID of the websocket in question
+        messages (list[ChatCompletionMessageParam]): The messages to
+            send to the model
+        document_index (str): The document index to query
+        search_endpoint (str): The search endpoint
+        search_key (str): The search key
+        prompt (str): Model Prompt
+        connection_id (str): The connection ID
+        conversation_id (str): The conversation ID
+
+    Returns:
+        tuple[str, list[Citation]]: The full response and the citations
     """
-    if not verify_token(message.auth_token):
-        ws_log_and_send_error(
-            ('Invalid token.'
-             f' for debugging purposes, you were {connection_id}'),
-            connection_id)
-        return
+    __ensure_index_exists(document_index, connection_id)
+
+    body = ''
+    raw_citations: list[dict] = []
+    # Whether to stream the window even without citations
+    for max_history, committed in [
+            *((max_history, False) for max_history in HISTORY_WINDOWS),
+            (HISTORY_WINDOWS[0], True)]:
+        logging.info('Streaming max_history=%d', max_history)
+        stream = __create_completion(messages, max_history, document_index,
+                                     search_endpoint, search_key, prompt,
+                                     stream=True)
+        raw_citations = []
+        for chunk in stream:
+            if len(chunk.choices) == 0:
+                continue
+            delta = chunk.choices[0].delta
+            # Context is an Azure extension; the SDK doesn't know it.
+            context = getattr(delta, 'context', None)
+            if context:
+                raw_citations.extend(context.get('citations', []))
+                committed = committed or len(raw_citations) > 0
+            if not delta.content:
+                continue
+            if not committed:
+                break
+            body += delta.content
+            ws_send_message(
+                ResponseDeltaMessage(delta.content, conversation_id)
+                .to_json(),
+                connection_id)
+
+        if committed:
+            break
+        stream.close()
 
-    curr_user = get_user_id(message.auth_token)
-    # Ethereal Conversations are denoted with a -1. They are
-    # converesations that do not store history, and exists for the
-    # purposes of validation.  Since they do not store state
-    # (i.e. chat history), we can assume the all users are authorised
-    # to use ethereal chats.
-    ethereal_conversation = message.conversation_id == '-1'
-    assert curr_user is not None
-    if not ethereal_conversation and \
-       not authorise_user(Services().db_session, message.conversation_id,
-                          curr_user):
+    logging.info('%s: model response streamed', connection_id)
+    if body == '':
         ws_log_and_send_error(
-            ('User not authorised.'
+            ('no response from AI chat.'
              f' for debugging purposes, you were {connection_id}'),
             connection_id)
-        return
+        raise ChatError('no response from AI chat')
+
+    return body, [Citation.from_dict(raw_citation)
+                  for raw_citation in raw_citations]
+
+
+def is_summary_empty(summary: str) -> bool:
+    """
+    Checks if a summary returned with SUMMARY_PROMPT carries no
+    information, i.e. the model found nothing or answered NONE.
+    """
+    return summary.strip().rstrip('.').upper() in ('', 'NONE')
+
+
+def __query_concurrently(
+        query_summary: Callable[[], str],
+        query_document: Callable[[str, bool], tuple[str, list[Citation]]]
+) -> tuple[str, list[Citation]]:
+    """
+    Queries the summary index, and speculatively queries the document
+    index without a summary at the same time. If the summary turns out
+    to be empty, the speculative answer is used as-is; otherwise, the
+    document index is queried again with the summary.
+
+    The speculative query sends no errors to the connection, as its
+    response may be discarded; if it fails and is needed, the document
+    index is queried again, sending its errors.
+
+    Args:
+        query_summary (Callable[[], str]): Queries the summary index
+        query_document (Callable[[str, bool], tuple[str,
+            list[Citation]]]): Queries the document index given a
+            summary, and whether to send errors
+
+    Returns:
+        tuple[str, list[Citation]]: The response and the citations
+    """
+    executor = ThreadPoolExecutor(max_workers=1)
+    try:
+        speculative = executor.submit(query_document, '', False)
+        summary = query_summary()
+        if is_summary_empty(summary):
+            logging.info('Summary is empty, using speculative response')
+            try:
+                return speculative.result()
+            # pylint: disable-next=[broad-exception-caught]
+            except Exception as e:
+                logging.warning('Speculative response failed: %s', e)
+                return query_document('', True)
+    finally:
+        # Never block on a speculative response that is no longer needed
+        executor.shutdown(wait=False)
+
+    logging.info('Summary found, discarding speculative response')
+    return query_document(summary, True)
+
+
+# pylint: disable=too-many-locals
+def __respond_to_message(message: ChatMessage, connection_id: str,
+                         curr_user: str, pending: ChatMessageBuffer) -> None:
+    """
+    Sends the message to the model with its history, and responds to
+    the WebSocket. Messages to be saved are added to pending.
 
+    Args:
+        message (ChatMessage): The authorised message
+        connection_id (str): The connection ID of the websocket
+        curr_user (str): The user ID of the sender
+        pending (ChatMessageBuffer): Buffer of the messages to save
+    """
+    ethereal_conversation = message.conversation_id == '-1'
     logging.info('%s: sending to model', connection_id)
     messages = db_history_to_ai_history(message.conversation_id)
 
@@ -404,9 +713,10 @@ def process_message(message: ChatMessage, connection_id: str) -> None:
         contextualized_summary = f"USER IMAGE: {summary}"
         messages.append({'role': 'user', 'content': contextualized_summary})
         shadow_msg_to_db(message.conversation_id, filename, False, True, [],
-                         additional_context=contextualized_summary)
+                         additional_context=contextualized_summary,
+                         pending=pending)
         shadow_msg_to_db(message.conversation_id, contextualized_summary, True,
-                         False, [])
+                         False, [], pending=pending)
         ws_send_message(
             ResponseChatMessage(
                 summary,
@@ -417,30 +727,48 @@ def process_message(message: ChatMessage, connection_id: str) -> None:
 
     messages.append({'role': 'user', 'content': message.message})
     shadow_msg_to_db(message.conversation_id, message.message, False, False,
-                     [])
+                     [], pending=pending)
 
-    assert curr_user is not None
     summary_index = get_search_index_for_user_id(curr_user)
     summary_search_endpoint = Secrets().get("SummarySearchEndpoint")
     summary_search_key = Secrets().get("SummarySearchKey")
 
-    try:
-        if ethereal_conversation:
-            summary = ''
-        else:
-            summary = __index_guard(summary_index,
-                                    lambda: strip_all_citations(
-                                        __query_llm_with_index(
-                                            messages, summary_index,
-                                            summary_search_endpoint,
-                                            summary_search_key,
-                                            SUMMARY_PROMPT, connection_id)[0]))
-
-        chat_response, citations = __query_llm_with_index(
+    def query_summary() -> str:
+        return __index_guard(summary_index,
+                             lambda: strip_all_citations(
+                                 __query_llm_with_index(
+                                     messages, summary_index,
+                                     summary_search_endpoint,
+                                     summary_search_key,
+                                     SUMMARY_PROMPT, connection_id)[0]))
+
+    streaming = Secrets().get("ChatStreaming") == 'true'
+
+    def query_document(summary: str, send_errors: bool = True
+                       ) -> tuple[str, list[Citation]]:
+        if streaming:
+            return __stream_llm_with_index(
+                messages, message.index,
+                summary_search_endpoint, summary_search_key,
+                DOCUMENT_PROMPT + summary, connection_id,
+                message.conversation_id
+            )
+        return __query_llm_with_index(
             messages, message.index,
             summary_search_endpoint, summary_search_key,
-            DOCUMENT_PROMPT + summary, connection_id
+            DOCUMENT_PROMPT + summary, connection_id, send_errors
         )
+
+    try:
+        if ethereal_conversation:
+            chat_response, citations = query_document('')
+        # A speculative response cannot be streamed; it may be discarded
+        elif not streaming and \
+                Secrets().get("ChatRetrievalMode") == 'concurrent':
+            chat_response, citations = __query_concurrently(
+                query_summary, query_document)
+        else:
+            chat_response, citations = query_document(query_summary())
     except ChatError:
         # chat errors already have responses sent to the websocket
         return
@@ -453,21 +781,73 @@ def process_message(message: ChatMessage, connection_id: str) -> None:
             connection_id)
         return
 
+    doc_container = Secrets().get("DocumentProductionContainerName")
+    # One container-scoped token, if enabled, for all citations
+    container_sas = get_container_sas_token(
+        Services().doc_blob_client, doc_container) \
+        if citations and Secrets().get("CitationSasMode") == 'container' \
+        else None
     response = ResponseChatMessage(
         body=chat_response,
         conversation_id=message.conversation_id,
         sent_at=datetime.now(),
         citations=translate_citation_urls(
-            citations, Services().doc_blob_client,
-            Secrets().get("DocumentProductionContainerName")
+            citations, Services().doc_blob_client, doc_container,
+            container_sas
         )
     )
     shadow_msg_to_db(
         message.conversation_id, response.body, True, False,
-        citations)
+        citations, pending=pending)
     ws_send_message(response.to_json(), connection_id)
 
 
+def process_message(message: ChatMessage, connection_id: str) -> None:
+    """
+    Processes the message received from the request.
+
+    For now, the message goes directly into Azure OpenAI, which spits
+    out a chat message.
+
+    Args:
+        message (ChatMessage): The ChatMessage object deserialize from the
+                               input
+        connection_id (str): The conneciton ID of the websocket in question
+    """
+    if not verify_token(message.auth_token):
+        ws_log_and_send_error(
+            ('Invalid token.'
+             f' for debugging purposes, you were {connection_id}'),
+            connection_id)
+        return
+
+    curr_user = get_user_id(message.auth_token)
+    # Ethereal Conversations are denoted with a -1. They are
+    # converesations that do not store history, and exists for the
+    # purposes of validation.  Since they do not store state
+    # (i.e. chat history), we can assume the all users are authorised
+    # to use ethereal chats.
+    ethereal_conversation = message.conversation_id == '-1'
+    assert curr_user is not None
+    if not ethereal_conversation and \
+       not authorise_user(Services().db_session, message.conversation_id,
+                          curr_user):
+        ws_log_and_send_error(
+            ('User not authorised.'
+             f' for debugging purposes, you were {connection_id}'),
+            connection_id)
+        return
+
+    # The messages of the turn are saved together once the response
+    # has been sent, rather than one round trip per message
+    pending = ChatMessageBuffer()
+    try:
+        __respond_to_message(message, connection_id, curr_user, pending)
+    finally:
+        if len(pending) > 0:
+            pending.flush(Services().db_session)
+
+
 def main(request: str) -> None:
     """
     Entrypoint of the chat function.
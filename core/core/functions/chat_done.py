@@ -2,72 +2,46 @@
 Chat done API endpoint.
 
 This API is called by the web app endpoint whenever a conversation is
-complete.
+complete. Summarizing the conversation takes a while, so it is queued
+for the summarization worker, and its status can be polled from the
+summarization status endpoint.
 """
 
 import logging
-from functools import reduce
 from typing import Optional
 
 import azure.functions as func  # type: ignore[import-untyped]
 from langchain.docstore.document import Document
-from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_community.vectorstores.azuresearch import AzureSearch
 from models.chat_message import ChatMessageDAO
 from models.conversation_status import ConversationStatusDAO
+from models.conversation_summary import ConversationSummaryDAO
+from models.summarization_job import (SummarizationJobDAO,
+                                      SummarizationJobModel,
+                                      SummarizationStatusResponse)
 from utils.authorise_conversation import authorise_user
 from utils.get_user_id import get_user_id
 from utils.hashing import get_search_index_for_user_id
+from utils.search_utils import invalidate_index_cache
 from utils.secrets import Secrets
 from utils.services import Services
-
-SUMMARIZATION_PROMPT = (
-    "You are a summarization service. You will be iteratively passed chunks of"
-    " an entire chat history. Each message either begins with BOT or USER,"
-    " which represents the two different parties of the conversation. If the"
-    " message contains [USER IMAGE], it is the description of an image"
-    " uploaded by the USER, irregardless of the sender. You will receive, in"
-    " order, both the summary thus far (role: assistant), and the next chunk"
-    " of the conversation (role: user). You should summarize the conversation"
-    " up to that point."
-)
-
-
-def __obtain_summary(prev_summary: str, next_chunk: str) -> str:
-    """
-    Obtains the summary of a conversation.
-
-    Args:
-        prev_summary (str): The previous summary
-        next_chunk (str): The next chunk of the conversation
-    """
-    chat_response = Services().openai_chat_model.chat.completions.create(
-        model=Secrets().get("SummarizationModel"),
-        messages=[{
-            "role": "system",
-            "content": SUMMARIZATION_PROMPT
-        }, {
-            "role": "assistant",
-            "content": prev_summary
-        }, {
-            "role": "user",
-            "content": next_chunk
-        }],
-    )
-
-    response = chat_response.choices[0].message.content
-    assert response is not None
-    return response
+from utils.summarization import (SummaryUsage, split_conversation,
+                                 summarize_map_reduce, summarize_refine)
 
 
 def __summarize_conversation(conversation_id: str) -> str:
     """
-    Naively summarizes a conversation. The process is as follows:
-
-    1. Get all messages for the conversation
-    2. Join all messages together
-    3. Use a text splitter to chunk the messages
-    4. Use a GPT model to iteratively summarize the conversation
+    Summarizes a conversation incrementally. The process is as follows:
+
+    1. Get the rolling summary of the conversation, if any
+    2. Get the messages after the last summarized message
+    3. Pack whole messages into chunks, up to SummarizationTokenBudget
+       tokens per call
+    4. Use a GPT model to carry on the summary over the chunks,
+       according to SummarizationStrategy: refine summarizes them
+       iteratively, while mapreduce summarizes them concurrently, then
+       merges the summaries
+    5. Save the rolling summary, up to the last message
 
     Args:
         conversation_id (str): The conversation ID
@@ -76,19 +50,52 @@ def __summarize_conversation(conversation_id: str) -> str:
         str: The summarized conversation
     """
     logging.info('Summarizing conversation %s', conversation_id)
-    conversations = ChatMessageDAO.get_all_messages_for_conversation(
-        Services().db_session, conversation_id)
-    combined = '\n'.join([f"{c.sender}: {c.message}" for c in conversations])
-    text_splitter = RecursiveCharacterTextSplitter()
-    return reduce(__obtain_summary, text_splitter.split_text(combined), "")
+    session = Services().db_session
+    rolling = ConversationSummaryDAO.get_summary(session, conversation_id)
+    previous = rolling.summary if rolling else ""
+    conversations = ChatMessageDAO.get_messages_after(
+        session, conversation_id,
+        (rolling.summarized_until, rolling.last_message_id)
+        if rolling else None)
+    if not conversations:
+        logging.info('No new messages since the last summary')
+        return previous
+
+    client = Services().openai_chat_model
+    model = Secrets().get("SummarizationModel")
+    chunks = split_conversation(
+        [f"{c.sender}: {c.message}" for c in conversations], model,
+        int(Secrets().get("SummarizationTokenBudget")))
+    usage = SummaryUsage()
+    if Secrets().get("SummarizationStrategy") == 'mapreduce':
+        summary = summarize_map_reduce(
+            chunks, client, model,
+            int(Secrets().get("SummarizationWorkers")), previous,
+            usage=usage)
+    else:
+        summary = summarize_refine(chunks, client, model, previous,
+                                   usage=usage)
+    logging.info('Summarized %d new messages of conversation %s in %d'
+                 ' chunks: %d calls, %d prompt and %d completion tokens',
+                 len(conversations), conversation_id, len(chunks),
+                 usage.calls, usage.prompt_tokens, usage.completion_tokens)
+
+    ConversationSummaryDAO.save_summary(
+        session, conversation_id, summary, conversations[-1].sent_at,
+        conversations[-1].message_id)
+    return summary
 
 
-def __store_into_index(index: str, data: str) -> None:
+def __store_into_index(index: str, conversation_id: str, data: str) -> None:
     """
-    Stores data into an index. Meant to store summaries for a particular user.
+    Stores the summary of a conversation into an index. Meant to store
+    summaries for a particular user. The conversation ID is the key of
+    the document, so it replaces any earlier summary of the
+    conversation.
 
     Args:
         index (str): The index to store into
+        conversation_id (str): The conversation ID
         data (str): The data to store
     """
     logging.info('Storing into index %s', index)
@@ -99,7 +106,12 @@ def __store_into_index(index: str, data: str) -> None:
         embedding_function=Services().embeddings.embed_query
     )
     vector_store.add_documents(documents=[
-        Document(page_content=data, metadata={'source': 'local'})])
+        Document(page_content=data,
+                 metadata={'source': 'local',
+                           'conversation_id': conversation_id})],
+        keys=[conversation_id])
+    # The index is created on the first summary stored for the user
+    invalidate_index_cache(index)
 
 
 def summarize_and_store(user_id: str, conversation_id: str) -> None:
@@ -111,7 +123,49 @@ def summarize_and_store(user_id: str, conversation_id: str) -> None:
         conversation_id (str): The conversation ID
     """
     index = get_search_index_for_user_id(user_id)
-    __store_into_index(index, __summarize_conversation(conversation_id))
+    __store_into_index(index, conversation_id,
+                       __summarize_conversation(conversation_id))
+
+
+def __queue_summarization(user_id: str,
+                          conversation_id: str) -> SummarizationJobModel:
+    """
+    Queues the summarization of a conversation. The idempotency key is
+    the latest message of the conversation, so the same state of the
+    conversation is only queued once.
+
+    Args:
+        user_id (str): The user ID
+        conversation_id (str): The conversation ID
+
+    Returns:
+        SummarizationJobModel: The job
+    """
+    session = Services().db_session
+    latest = ChatMessageDAO.get_messages_page(session, conversation_id,
+                                              limit=1)
+    idempotency_key = \
+        f"{conversation_id}:{latest[0].message_id if latest else 'empty'}"
+    job, queued = SummarizationJobDAO.queue_job(session, conversation_id,
+                                                idempotency_key)
+    if not queued:
+        logging.info('Summarization job %s is already %s', idempotency_key,
+                     job.status.value)
+        return job
+
+    try:
+        Services().summarization_queue.send({
+            'user_id': user_id,
+            'conversation_id': conversation_id,
+            'idempotency_key': idempotency_key,
+        })
+    except Exception as e:
+        # Lets the job be queued again
+        SummarizationJobDAO.finish_job(session, conversation_id,
+                                       idempotency_key, repr(e))
+        raise
+    logging.info('Queued summarization job %s', idempotency_key)
+    return job
 
 
 def __guards(req: func.HttpRequest
@@ -160,7 +214,9 @@ def __guards(req: func.HttpRequest
 
 def main(req: func.HttpRequest) -> func.HttpResponse:
     """
-    Marks a conversation as completed.
+    Marks a conversation as completed, and queues its summarization
+    (202, with the status of the job). If SummarizationQueue is sync,
+    the conversation is summarized before responding instead.
 
     Args:
         req (func.HttpRequest): The HTTP request
@@ -173,7 +229,15 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
     if done:
         ConversationStatusDAO.mark_conversation_completed(
             req.params['conversation_id'], Services().db_session)
-        summarize_and_store(user_id, conversation_id)
+        if Secrets().get("SummarizationQueue") == 'sync':
+            summarize_and_store(user_id, conversation_id)
+        else:
+            job = __queue_summarization(user_id, conversation_id)
+            return func.HttpResponse(
+                SummarizationStatusResponse.from_model(job).to_json(),
+                status_code=202,
+                mimetype="application/json"
+            )
     else:
         ConversationStatusDAO.mark_conversation_not_completed(
             req.params['conversation_id'], Services().db_session)
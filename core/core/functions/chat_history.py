@@ -3,25 +3,35 @@ Chat History API endpoint.
 """
 
 import logging
+from functools import partial
+from typing import Optional
 
 import azure.functions as func  # type: ignore[import-untyped]
 from models.chat_message import ChatMessageDAO, ChatMessageModel
 from utils.authorise_conversation import authorise_user
-from utils.chat_message import translate_citation_urls
-from utils.get_preauthenticated_blob_url import get_preauthenticated_blob_url
+from utils.chat_message import (BidirectionalChatMessage,
+                                translate_citation_urls)
+from utils.get_preauthenticated_blob_url import (get_container_sas_token,
+                                                 get_preauthenticated_blob_url)
 from utils.get_user_id import get_user_id
-from utils.history import ChatHistoryResponse
+from utils.history import ChatHistoryResponse, HistoryCursor
 from utils.secrets import Secrets
 from utils.services import Services
 
+# Number of messages per page of the chat history
+HISTORY_PAGE_SIZE = 50
 
-def __transform_chat_message_helper(model: ChatMessageModel):
+
+def __transform_chat_message_helper(model: ChatMessageModel,
+                                    container_sas: Optional[str] = None):
     """
     Helper function to transform a chat message model into a
     bidirectional chat message.
 
     Args:
         model (ChatMessageModel): The model to transform
+        container_sas (Optional[str]): The container-scoped token for
+            the citations, if any
 
     Returns:
         BidirectionalChatMessage: The transformed model
@@ -41,39 +51,66 @@ def __transform_chat_message_helper(model: ChatMessageModel):
     bidirectional_chat_message.citations = translate_citation_urls(
         bidirectional_chat_message.citations,
         Services().doc_blob_client,
-        Secrets().get("DocumentProductionContainerName"))
+        Secrets().get("DocumentProductionContainerName"),
+        container_sas)
     return bidirectional_chat_message
 
 
-def get_history_from_db(convesation_id: str) -> map:
+def get_history_from_db(
+        convesation_id: str,
+        cursor: Optional[HistoryCursor] = None
+) -> tuple[list[BidirectionalChatMessage], Optional[HistoryCursor]]:
     """
-    Gets the last 50 messages of the chat history from the database.
+    Gets a page of the chat history from the database; the last 50
+    messages before the cursor, or the last 50 messages if no cursor
+    is given.
 
     Args:
         convesation_id (str): The conversation ID
+        cursor (Optional[HistoryCursor]): The cursor of the page
 
     Returns:
-        map: The chat history
+        tuple[list[BidirectionalChatMessage], Optional[HistoryCursor]]:
+            The chat history, and the cursor of the previous page if
+            there may be one
     """
-    return map(__transform_chat_message_helper,
-               ChatMessageDAO.get_all_messages_for_conversation(
-                   Services().db_session, convesation_id, count=50))
+    models = ChatMessageDAO.get_messages_page(
+        Services().db_session, convesation_id,
+        before=(cursor.sent_at, cursor.message_id) if cursor else None,
+        limit=HISTORY_PAGE_SIZE)
+
+    next_cursor = None
+    if len(models) == HISTORY_PAGE_SIZE:
+        next_cursor = HistoryCursor(models[0].sent_at, models[0].message_id)
+    # One container-scoped token, if enabled, for the whole page
+    container_sas = get_container_sas_token(
+        Services().doc_blob_client,
+        Secrets().get("DocumentProductionContainerName")) \
+        if Secrets().get("CitationSasMode") == 'container' and \
+        any(model.citations for model in models) else None
+    return list(map(partial(__transform_chat_message_helper,
+                            container_sas=container_sas),
+                    models)), next_cursor
 
 
 def handle_request_by_conversation_id(
-    conversation_id: str
+    conversation_id: str,
+    cursor: Optional[HistoryCursor] = None
 ) -> ChatHistoryResponse:
     """
     Handles the request by conversation ID.
 
     Args:
         conversation_id (str): The conversation ID
+        cursor (Optional[HistoryCursor]): The cursor of the page
 
     Returns:
         ChatHistoryResponse: The chat history response
     """
-    return ChatHistoryResponse.from_dict(
-        {"messages": list(get_history_from_db(conversation_id))}
+    messages, next_cursor = get_history_from_db(conversation_id, cursor)
+    return ChatHistoryResponse(
+        messages=messages,
+        next_cursor=next_cursor.encode() if next_cursor else None
     )
 
 
@@ -89,13 +126,20 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
         return func.HttpResponse("", status_code=400)
 
     conversation_id = req.params.get("conversation_id")
+    cursor = None
+    if "cursor" in req.params:
+        try:
+            cursor = HistoryCursor.decode(req.params["cursor"])
+        except ValueError:
+            return func.HttpResponse("Invalid cursor.", status_code=400)
+
     curr_user = get_user_id(req.headers["Auth-Token"])
     assert curr_user is not None
     if not authorise_user(Services().db_session, conversation_id, curr_user):
         return func.HttpResponse("User not authorised.", status_code=401)
 
     return func.HttpResponse(
-        handle_request_by_conversation_id(conversation_id).to_json(),
+        handle_request_by_conversation_id(conversation_id, cursor).to_json(),
         status_code=200,
         mimetype="application/json",
     )
@@ -2,14 +2,22 @@
 Triggers upon an upload to the verification document storage
 """
 import logging
+from typing import Optional
 
+from azure.core.credentials import AzureKeyCredential
 from azure.functions import InputStream
-from langchain.document_loaders.blob_loaders import Blob
-# NOTE: The warning is invalid. DocumentIntelligenceLoader only
-# accepts a filepath; we're working directly with blobs here.
-from langchain_community.document_loaders.pdf import DocumentIntelligenceParser
+from azure.search.documents import SearchClient
 from langchain_community.vectorstores.azuresearch import AzureSearch
+from models.ingestion_cache import IngestedPageModel, IngestionCacheDAO
 from models.pending_uploads import PendingUploadsDAO, PendingUploadsModel
+from utils.chunking import make_chunker
+from utils.embeddings import BatchedEmbeddings
+from utils.get_preauthenticated_blob_url import \
+    get_preauthenticated_blob_url
+from utils.ingestion import analyze_pages, ingest
+from utils.ingestion_cache import (IngestionCache, hash_file,
+                                   ingestion_settings)
+from utils.search_utils import invalidate_index_cache
 from utils.secrets import Secrets
 from utils.services import Services
 from utils.smtp_send_mail import send_file_processed_mail
@@ -36,6 +44,89 @@ def process_outstanding_index(model: PendingUploadsModel) -> None:
         Services().db_session, model.filename)
 
 
+def __find_page(page_hash: str, settings: str
+                ) -> Optional[IngestedPageModel]:
+    """
+    Finds an ingested page. Pages are looked up on the thread parsing
+    the document, so the lookup scopes its own database session.
+    """
+    with Services().db_session_scope():
+        return IngestionCacheDAO.get_page(Services().db_session, page_hash,
+                                          settings)
+
+
+# The settings are locals, to be read once per upload
+# pylint: disable=too-many-locals
+def __ingest(blob: InputStream, source: str, search_index: str,
+             vector_store: AzureSearch,
+             embeddings: BatchedEmbeddings) -> int:
+    """
+    Ingests the blob into the vector store, cloning it if the same
+    file was ingested before, or reusing the chunks of its unchanged
+    pages.
+
+    Returns:
+        int: The number of chunks added
+    """
+    secrets = Secrets()
+    strategy = secrets.get("ChunkingStrategy")
+    chunk_tokens = int(secrets.get("ChunkTokens"))
+    overlap_tokens = int(secrets.get("ChunkOverlapTokens"))
+    batch_size = int(secrets.get("IngestionBatchSize"))
+    settings = ingestion_settings(strategy, chunk_tokens, overlap_tokens)
+    use_cache = secrets.get("IngestionCache") != 'none'
+    clients: dict[str, SearchClient] = {}
+
+    def open_index(index: str) -> SearchClient:
+        if index not in clients:
+            clients[index] = SearchClient(
+                secrets.get("CognitiveSearchEndpoint"), index,
+                AzureKeyCredential(secrets.get("CognitiveSearchKey")))
+        return clients[index]
+
+    def new_cache() -> IngestionCache:
+        return IngestionCache(
+            lambda page_hash: __find_page(page_hash, settings)
+            if use_cache else None,
+            open_index, embeddings)
+
+    file_hash = hash_file(blob)
+    cache = new_cache()
+    count: Optional[int] = None
+    ingested = IngestionCacheDAO.get_file(
+        Services().db_session, file_hash, settings) \
+        if use_cache else None
+    if ingested:
+        logging.info('Cloning %s from %s', source, ingested.search_index)
+        try:
+            count = ingest(cache.clone(ingested, source), vector_store,
+                           batch_size=batch_size)
+        except LookupError as e:
+            # The chunks keep their IDs, so this replaces the clones
+            logging.warning('Cannot clone %s (%s is gone); ingesting it',
+                            source, e)
+            cache = new_cache()
+    if count is None:
+        # Document Intelligence reads the blob itself, once per window
+        container, name = source.split('/', 1)
+        pages = analyze_pages(
+            Services().document_analysis, 'prebuilt-document',
+            lambda: get_preauthenticated_blob_url(
+                Services().doc_blob_client, container, name),
+            source, window=int(secrets.get("IngestionPageWindow")))
+        chunker = make_chunker(strategy, chunk_tokens=chunk_tokens,
+                               overlap_tokens=overlap_tokens)
+        count = ingest(cache.chunk(pages, chunker), vector_store,
+                       batch_size=batch_size)
+    logging.info('Indexed %d chunks, reusing %d pages', count,
+                 cache.reused_pages)
+    if use_cache:
+        IngestionCacheDAO.save_file(Services().db_session, file_hash,
+                                    settings, search_index, source,
+                                    cache.pages)
+    return count
+
+
 def main(blob: InputStream):
     """
     Entrypoint to process blob storage event
@@ -45,18 +136,20 @@ def main(blob: InputStream):
 
     logging.info("Index name: %s", search_index)
 
-    loader = DocumentIntelligenceParser(client=Services().document_analysis,
-                                        model='prebuilt-document')
     secrets = Secrets()
+    embeddings = BatchedEmbeddings(
+        Services().embeddings,
+        batch_size=int(secrets.get("EmbeddingBatchSize")),
+        workers=int(secrets.get("EmbeddingWorkers")))
     vector_store = AzureSearch(
         azure_search_endpoint=secrets.get("CognitiveSearchEndpoint"),
         azure_search_key=secrets.get("CognitiveSearchKey"),
         index_name=search_index,
-        embedding_function=Services().embeddings.embed_query
+        embedding_function=embeddings
     )
-    documents = loader.lazy_parse(Blob.from_data(blob.read()))
     logging.info('Sending to vector store...')
-    vector_store.add_documents(documents=list(documents))
+    __ingest(blob, blob.name, search_index, vector_store, embeddings)
+    invalidate_index_cache(search_index)
 
     model = PendingUploadsDAO.get_pending_uploads_on_filename(
         Services().db_session, search_index)
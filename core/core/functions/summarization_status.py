@@ -0,0 +1,43 @@
+"""
+Summarization status API endpoint.
+
+Clients poll this after marking a conversation as done, until the
+summarization job has completed or failed.
+"""
+
+import logging
+
+import azure.functions as func  # type: ignore[import-untyped]
+from models.summarization_job import (SummarizationJobDAO,
+                                      SummarizationStatusResponse)
+from utils.authorise_conversation import authorise_user
+from utils.get_user_id import get_user_id
+from utils.services import Services
+
+
+def main(req: func.HttpRequest) -> func.HttpResponse:
+    """
+    Gets the status of the summarization job of a conversation.
+
+    Args:
+        req (func.HttpRequest): The HTTP request
+    """
+    logging.info("Summarization Status called with %s", req.method)
+    if "conversation_id" not in req.params:
+        return func.HttpResponse("Missing conversation ID", status_code=400)
+
+    conversation_id = req.params["conversation_id"]
+    curr_user = get_user_id(req.headers["Auth-Token"])
+    assert curr_user is not None
+    if not authorise_user(Services().db_session, conversation_id, curr_user):
+        return func.HttpResponse("User not authorised.", status_code=401)
+
+    job = SummarizationJobDAO.get_job(Services().db_session, conversation_id)
+    if job is None:
+        return func.HttpResponse("No summarization job.", status_code=404)
+
+    return func.HttpResponse(
+        SummarizationStatusResponse.from_model(job).to_json(),
+        status_code=200,
+        mimetype="application/json",
+    )
@@ -0,0 +1,59 @@
+"""
+Summarization worker.
+
+Summarizes completed conversations queued by the chat done endpoint,
+and stores the summaries into the index of the user.
+"""
+
+import json
+import logging
+from typing import Any
+
+import azure.functions as func  # type: ignore[import-untyped]
+from functions.chat_done import summarize_and_store
+from models.summarization_job import SummarizationJobDAO
+from utils.services import Services
+
+
+def process_job(job: dict[str, Any]) -> None:
+    """
+    Summarizes a conversation, unless the job has completed, is
+    running elsewhere or has been superseded. The job is marked as
+    failed, and the error re-raised so the queue retries it, if
+    summarizing fails.
+
+    Args:
+        job (dict[str, Any]): The job, with the user ID, conversation
+            ID and idempotency key
+    """
+    conversation_id = job['conversation_id']
+    idempotency_key = job['idempotency_key']
+    session = Services().db_session
+    if not SummarizationJobDAO.start_job(session, conversation_id,
+                                         idempotency_key):
+        logging.info('Skipping summarization job %s; completed, running'
+                     ' or superseded', idempotency_key)
+        return
+
+    try:
+        summarize_and_store(job['user_id'], conversation_id)
+    except Exception as e:
+        logging.error('Summarization job %s failed: %s', idempotency_key, e)
+        session.rollback()
+        SummarizationJobDAO.finish_job(session, conversation_id,
+                                       idempotency_key, repr(e))
+        raise
+    SummarizationJobDAO.finish_job(session, conversation_id, idempotency_key)
+    logging.info('Summarization job %s completed', idempotency_key)
+
+
+def main(msg: func.QueueMessage) -> None:
+    """
+    Processes a summarization job from the queue.
+
+    Args:
+        msg (func.QueueMessage): The queue message
+    """
+    logging.info('Summarization worker called with message %s (dequeued'
+                 ' %s times)', msg.id, msg.dequeue_count)
+    process_job(json.loads(msg.get_body()))
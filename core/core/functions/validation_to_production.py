@@ -11,6 +11,8 @@ from azure.search.documents.indexes.models import (HnswAlgorithmConfiguration,
                                                    SearchIndex, SimpleField,
                                                    VectorSearch,
                                                    VectorSearchProfile)
+from models.ingestion_cache import IngestionCacheDAO
+from utils.search_utils import invalidate_index_cache
 from utils.services import Services
 
 
@@ -68,6 +70,7 @@ def create_index(index_name: str) -> None:
         SearchIndex(name=index_name, fields=fields,
                     vector_search=vector_search)
     )
+    invalidate_index_cache(index_name)
 
 
 def check_index_exists(index_name: str) -> bool:
@@ -143,10 +146,14 @@ def main(req: HttpRequest) -> HttpResponse:
         create_index(production_index_name)
 
     migrate_documents(validation_index_name, production_index_name)
+    # The validation index is deleted, so cache hits clone from production
+    IngestionCacheDAO.move_index(Services().db_session,
+                                 validation_index_name, production_index_name)
 
     try:
         Services().document_cognitive_search_index.delete_index(
             validation_index_name)
+        invalidate_index_cache(validation_index_name)
         move_document_to_production(validation_index_name)
     except HttpResponseError as err:
         return error_deleting_index(err)
@@ -0,0 +1,25 @@
+"""
+Migrates the database schema. Run this at deploy time, with the same
+environment variables as the function app:
+
+    python migrate.py
+
+Workers then find the schema up to date, and skip all DDL on cold
+start.
+"""
+
+import logging
+
+from models.schema_version import SCHEMA_VERSION
+from utils.db import get_schema_version, migrate_schema
+from utils.services import Services
+
+logging.basicConfig(level=logging.INFO)
+
+if __name__ == '__main__':
+    # Creating the engine already migrates if the schema version
+    # differs, so only migrate here if that did not take
+    engine = Services().db_engine
+    if get_schema_version(engine) != SCHEMA_VERSION:
+        migrate_schema(engine)
+    logging.info('Schema is at version %s', get_schema_version(engine))
@@ -8,5 +8,11 @@ models will not be able to find each other during runtime.
 # pylint: disable=unused-import
 
 from .chat_message import ChatMessageModel  # noqa: F401
+from .conversation_summary import ConversationSummaryModel  # noqa: F401
+from .image_summary import ImageSummaryModel  # noqa: F401
+from .ingestion_cache import (IngestedFileModel,  # noqa: F401
+                              IngestedPageModel)
 from .pending_uploads import PendingUploadsModel  # noqa: F401
+from .schema_version import SchemaVersionModel  # noqa: F401
+from .summarization_job import SummarizationJobModel  # noqa: F401
 from .work_order import MachineModel, WorkOrderModel  # noqa: F401
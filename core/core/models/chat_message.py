@@ -2,12 +2,14 @@
 All data access related functions for chat messages.
 """
 
-from typing import Sequence, Tuple, Literal, cast
+from typing import Optional, Sequence, Tuple, Literal, cast
 from uuid import uuid4
 
 import enum
-from datetime import datetime
-from sqlalchemy import Column, Enum, String, select, JSON
+from datetime import datetime, timedelta
+from openai.types.chat import ChatCompletionMessageParam
+from sqlalchemy import (Column, Enum, Index, String, and_, insert, or_,
+                        select, JSON)
 from sqlalchemy.orm import Mapped, Session, mapped_column
 from utils.chat_message import BidirectionalChatMessage, Citation
 
@@ -15,6 +17,10 @@ from .common import Base
 
 # pylint: disable=too-few-public-methods,too-many-ancestors
 
+# Minimum gap between the sent_at of buffered messages. MSSQL DATETIME
+# rounds to 1/300 of a second, so closer timestamps may tie.
+SENT_AT_STEP = timedelta(milliseconds=4)
+
 
 class SenderTypes(enum.Enum):
     """
@@ -32,9 +38,14 @@ class ChatMessageModel(Base):
     This is modelled after BidirectionalChatMessage, but it is not equivalent.
     """
     __tablename__ = 'chat_messages'
+    # Every history fetch filters on the conversation, ordered by time
+    __table_args__ = (
+        Index('ix_chat_messages_conversation_id_sent_at',
+              'conversation_id', 'sent_at'),
+    )
     message_id: Mapped[str] = mapped_column(String(36), primary_key=True,
                                             default=uuid4)
-    conversation_id: Mapped[str] = mapped_column(default=uuid4)
+    conversation_id: Mapped[str] = mapped_column(String(36), default=uuid4)
     message: Mapped[str] = mapped_column()
     sent_at: Mapped[datetime] = mapped_column()
     is_image: Mapped[bool] = mapped_column(default=False)
@@ -149,6 +160,127 @@ class ChatMessageDAO:
 
         return list(reversed(session.scalars(stmt).all()))
 
+    @staticmethod
+    def get_ai_history(
+            session: Session,
+            conversation_id: str,
+            count: int = 10
+    ) -> list[ChatCompletionMessageParam]:
+        """
+        Gets the latest text messages of a conversation as OpenAI chat
+        messages. Only the sender and message columns are selected, and
+        images are filtered before the limit, so they do not take up
+        history slots. Rows are not loaded into the session.
+
+        Args:
+            session (Session): The database session
+            conversation_id (str): The conversation ID
+            count (int): The maximum number of messages
+
+        Returns:
+            list[ChatCompletionMessageParam]: The messages, oldest first
+        """
+        stmt = select(ChatMessageModel.sender, ChatMessageModel.message) \
+            .where(ChatMessageModel.conversation_id == conversation_id) \
+            .where(ChatMessageModel.is_image.is_(False)) \
+            .order_by(ChatMessageModel.sent_at.desc()) \
+            .limit(count)
+
+        # Should either match ChatCompletionAssistantMessageParam or
+        # ChatCompletionUserMessageParam, so we cast to make typing happy
+        return [
+            cast(ChatCompletionMessageParam,
+                 {'role': 'assistant' if sender == SenderTypes.BOT
+                  else 'user',
+                  'content': message})
+            for sender, message in reversed(session.execute(stmt).all())]
+
+    @staticmethod
+    def get_messages_page(
+            session: Session,
+            conversation_id: str,
+            *,
+            before: Optional[Tuple[datetime, str]] = None,
+            after: Optional[Tuple[datetime, str]] = None,
+            limit: int = 50
+    ) -> Sequence[ChatMessageModel]:
+        """
+        Gets a page of messages for a conversation with keyset
+        pagination. Messages are ordered by (sent_at, message_id), and
+        the cursors are the (sent_at, message_id) of a message; hence,
+        pages stay consistent while new messages arrive.
+
+        Args:
+            session (Session): The database session
+            conversation_id (str): The conversation ID
+
+        Keyword Args:
+            before (Optional[Tuple[datetime, str]]): Only get messages
+                before this cursor, exclusive
+            after (Optional[Tuple[datetime, str]]): Only get messages
+                after this cursor, exclusive
+            limit (int): The maximum number of messages. If only after
+                is given, the oldest messages after the cursor are
+                returned; otherwise, the newest.
+
+        Returns:
+            Sequence[ChatMessageModel]: The messages, oldest first
+        """
+        stmt = select(ChatMessageModel) \
+            .where(ChatMessageModel.conversation_id == conversation_id)
+        if before is not None:
+            stmt = stmt.where(or_(
+                ChatMessageModel.sent_at < before[0],
+                and_(ChatMessageModel.sent_at == before[0],
+                     ChatMessageModel.message_id < before[1])))
+        if after is not None:
+            stmt = stmt.where(or_(
+                ChatMessageModel.sent_at > after[0],
+                and_(ChatMessageModel.sent_at == after[0],
+                     ChatMessageModel.message_id > after[1])))
+
+        if after is not None and before is None:
+            stmt = stmt.order_by(ChatMessageModel.sent_at.asc(),
+                                 ChatMessageModel.message_id.asc()) \
+                .limit(limit)
+            return list(session.scalars(stmt).all())
+
+        stmt = stmt.order_by(ChatMessageModel.sent_at.desc(),
+                             ChatMessageModel.message_id.desc()) \
+            .limit(limit)
+        return list(reversed(session.scalars(stmt).all()))
+
+    @staticmethod
+    def get_messages_after(
+            session: Session,
+            conversation_id: str,
+            after: Optional[Tuple[datetime, str]] = None
+    ) -> Sequence[ChatMessageModel]:
+        """
+        Gets every message of a conversation after a keyset cursor (see
+        get_messages_page).
+
+        Args:
+            session (Session): The database session
+            conversation_id (str): The conversation ID
+            after (Optional[Tuple[datetime, str]]): Only get messages
+                after this cursor, exclusive. If None, all messages
+                are returned
+
+        Returns:
+            Sequence[ChatMessageModel]: The messages, oldest first
+        """
+        stmt = select(ChatMessageModel) \
+            .where(ChatMessageModel.conversation_id == conversation_id)
+        if after is not None:
+            stmt = stmt.where(or_(
+                ChatMessageModel.sent_at > after[0],
+                and_(ChatMessageModel.sent_at == after[0],
+                     ChatMessageModel.message_id > after[1])))
+        stmt = stmt.order_by(ChatMessageModel.sent_at.asc(),
+                             ChatMessageModel.message_id.asc())
+        return list(session.scalars(stmt).all())
+
     @staticmethod
     def save_message(session: Session, message: ChatMessageModel) -> None:
         """
@@ -161,3 +293,71 @@ class ChatMessageDAO:
 
         session.add(message)
         session.commit()
+
+    @staticmethod
+    def save_messages(session: Session,
+                      messages: Sequence[ChatMessageModel]) -> None:
+        """
+        Saves chat messages into the database with one bulk insert, in
+        one transaction.
+
+        Args:
+            session (Session): The database session
+            messages (Sequence[ChatMessageModel]): The messages to save
+        """
+        if not messages:
+            return
+
+        session.execute(insert(ChatMessageModel), [
+            {'message_id': message.message_id or str(uuid4()),
+             'conversation_id': message.conversation_id,
+             'message': message.message,
+             'sent_at': message.sent_at,
+             'is_image': bool(message.is_image),
+             'sender': message.sender,
+             'citations': message.citations or [],
+             'additional_context': message.additional_context or ''}
+            for message in messages])
+        session.commit()
+
+
+class ChatMessageBuffer:
+    """
+    Write-behind buffer for the messages of a chat turn. Messages are
+    collected as the turn progresses, and saved together by flush.
+    The sent_at of every message is kept strictly after the previous
+    one, so the turn is read back in the order it was added.
+    """
+    def __init__(self) -> None:
+        self.__messages: list[ChatMessageModel] = []
+
+    def __len__(self) -> int:
+        return len(self.__messages)
+
+    def add(self, message: ChatMessageModel) -> None:
+        """
+        Adds a message to the buffer.
+
+        Args:
+            message (ChatMessageModel): The message to save later
+        """
+        if self.__messages:
+            message.sent_at = max(
+                message.sent_at, self.__messages[-1].sent_at + SENT_AT_STEP)
+        self.__messages.append(message)
+
+    def flush(self, session: Session) -> None:
+        """
+        Saves all buffered messages in one transaction, and empties the
+        buffer. On failure, the transaction is rolled back and the
+        messages are dropped.
+
+        Args:
+            session (Session): The database session
+        """
+        messages, self.__messages = self.__messages, []
+        try:
+            ChatMessageDAO.save_messages(session, messages)
+        except Exception:
+            session.rollback()
+            raise
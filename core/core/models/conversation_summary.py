@@ -0,0 +1,83 @@
+"""
+The ConversationSummaryModel keeps the rolling summary of a
+conversation, and the last message it covers. When a reopened
+conversation is completed again, only the messages after that are
+summarized.
+"""
+
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import String, Text
+from sqlalchemy.orm import Mapped, Session, mapped_column
+
+from .common import Base
+
+# pylint: disable=too-few-public-methods
+
+
+class ConversationSummaryModel(Base):
+    """
+    Database model for conversation summaries. (summarized_until,
+    last_message_id) is the keyset cursor of the last summarized
+    message (see ChatMessageDAO.get_messages_page).
+    """
+    __tablename__ = 'conversation_summaries'
+    conversation_id: Mapped[str] = mapped_column(String(36),
+                                                 primary_key=True)
+    summary: Mapped[str] = mapped_column(Text)
+    summarized_until: Mapped[datetime] = mapped_column()
+    last_message_id: Mapped[str] = mapped_column(String(36))
+    updated_at: Mapped[datetime] = mapped_column(default=datetime.now,
+                                                 onupdate=datetime.now)
+
+
+class ConversationSummaryDAO:
+    """
+    Methods used with the ConversationSummaryModel. These are
+    namespaced, static methods. (i.e. do not instantitate)
+    """
+    def __init__(self):  # pragma: no cover
+        raise NotImplementedError("do not instantiate")
+
+    @staticmethod
+    def get_summary(session: Session, conversation_id: str
+                    ) -> Optional[ConversationSummaryModel]:
+        """
+        Gets the rolling summary of a conversation.
+
+        Args:
+            session (Session): The database session
+            conversation_id (str): The conversation ID
+
+        Returns:
+            Optional[ConversationSummaryModel]: The summary, or None if
+                the conversation has never been summarized
+        """
+        return session.get(ConversationSummaryModel, conversation_id)
+
+    # pylint: disable=too-many-arguments
+    @staticmethod
+    def save_summary(session: Session, conversation_id: str, summary: str,
+                     summarized_until: datetime,
+                     last_message_id: str) -> None:
+        """
+        Saves the rolling summary of a conversation, replacing any
+        existing one.
+
+        Args:
+            session (Session): The database session
+            conversation_id (str): The conversation ID
+            summary (str): The summary
+            summarized_until (datetime): When the last summarized
+                message was sent
+            last_message_id (str): The ID of the last summarized
+                message
+        """
+        session.merge(ConversationSummaryModel(
+            conversation_id=conversation_id,
+            summary=summary,
+            summarized_until=summarized_until,
+            last_message_id=last_message_id,
+            updated_at=datetime.now()))
+        session.commit()
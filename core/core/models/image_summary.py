@@ -0,0 +1,63 @@
+"""
+The ImageSummaryModel caches the GPT-4 Vision summaries of images,
+keyed by a hash of the image.
+"""
+
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import String, Text
+from sqlalchemy.orm import Mapped, Session, mapped_column
+
+from .common import Base
+
+# pylint: disable=too-few-public-methods
+
+
+class ImageSummaryModel(Base):
+    """
+    Database model for cached image summaries.
+    """
+    __tablename__ = 'image_summaries'
+    image_hash: Mapped[str] = mapped_column(String(80), primary_key=True)
+    summary: Mapped[str] = mapped_column(Text)
+    created_at: Mapped[datetime] = mapped_column(default=datetime.now)
+
+
+class ImageSummaryDAO:
+    """
+    Methods used with the ImageSummaryModel. These are namespaced,
+    static methods. (i.e. do not instantitate)
+    """
+    def __init__(self):  # pragma: no cover
+        raise NotImplementedError("do not instantiate")
+
+    @staticmethod
+    def get_summary(session: Session, image_hash: str) -> Optional[str]:
+        """
+        Gets the cached summary of an image.
+
+        Args:
+            session (Session): The database session
+            image_hash (str): The hash of the image
+
+        Returns:
+            Optional[str]: The summary, or None if not cached
+        """
+        model = session.get(ImageSummaryModel, image_hash)
+        return model.summary if model is not None else None
+
+    @staticmethod
+    def save_summary(session: Session, image_hash: str,
+                     summary: str) -> None:
+        """
+        Saves the summary of an image, replacing any existing one.
+
+        Args:
+            session (Session): The database session
+            image_hash (str): The hash of the image
+            summary (str): The summary
+        """
+        session.merge(ImageSummaryModel(image_hash=image_hash,
+                                        summary=summary))
+        session.commit()
@@ -0,0 +1,152 @@
+"""
+The ingestion cache records the files and pages that have been
+ingested into a search index, by the SHA-256 of their content. A
+manual uploaded again (e.g. for another machine) is then cloned from
+the index it was ingested into, and a revision reuses the vectors of
+its unchanged pages (see utils.ingestion_cache).
+
+Both are keyed by the ingestion settings too (chunking and embedding
+model), as the chunks differ for every setting.
+"""
+
+import json
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import String, Text, update
+from sqlalchemy.orm import Mapped, Session, mapped_column
+
+from .common import Base
+
+# pylint: disable=too-few-public-methods
+
+
+class IngestedFileModel(Base):
+    """
+    Database model for ingested files. page_hashes is the JSON list of
+    the hashes of its pages, in order.
+    """
+    __tablename__ = 'ingested_files'
+    file_hash: Mapped[str] = mapped_column(String(64), primary_key=True)
+    settings: Mapped[str] = mapped_column(String(255), primary_key=True)
+    search_index: Mapped[str] = mapped_column(String(255))
+    page_hashes: Mapped[str] = mapped_column(Text)
+    created_at: Mapped[datetime] = mapped_column(default=datetime.now)
+
+
+class IngestedPageModel(Base):
+    """
+    Database model for ingested pages. The chunks of the page are
+    those of its page number in the source document, in the search
+    index (see utils.chunking.chunk_id).
+    """
+    __tablename__ = 'ingested_pages'
+    page_hash: Mapped[str] = mapped_column(String(64), primary_key=True)
+    settings: Mapped[str] = mapped_column(String(255), primary_key=True)
+    search_index: Mapped[str] = mapped_column(String(255))
+    source: Mapped[str] = mapped_column(String(255))
+    page: Mapped[int] = mapped_column()
+    chunks: Mapped[int] = mapped_column()
+    created_at: Mapped[datetime] = mapped_column(default=datetime.now)
+
+
+class IngestionCacheDAO:
+    """
+    Methods used with the IngestedFileModel and IngestedPageModel.
+    These are namespaced, static methods. (i.e. do not instantitate)
+    """
+    def __init__(self):  # pragma: no cover
+        raise NotImplementedError("do not instantiate")
+
+    @staticmethod
+    def get_file(session: Session, file_hash: str, settings: str
+                 ) -> Optional[IngestedFileModel]:
+        """
+        Gets an ingested file.
+
+        Args:
+            session (Session): The database session
+            file_hash (str): The SHA-256 of the file
+            settings (str): The ingestion settings
+
+        Returns:
+            Optional[IngestedFileModel]: The file, or None if it has
+                not been ingested with the settings
+        """
+        return session.get(IngestedFileModel, (file_hash, settings))
+
+    @staticmethod
+    def get_page(session: Session, page_hash: str, settings: str
+                 ) -> Optional[IngestedPageModel]:
+        """
+        Gets an ingested page.
+
+        Args:
+            session (Session): The database session
+            page_hash (str): The hash of the page
+            settings (str): The ingestion settings
+
+        Returns:
+            Optional[IngestedPageModel]: The page, or None if it has
+                not been ingested with the settings
+        """
+        return session.get(IngestedPageModel, (page_hash, settings))
+
+    # pylint: disable=too-many-arguments
+    @staticmethod
+    def save_file(session: Session, file_hash: str, settings: str,
+                  search_index: str, source: str,
+                  pages: list[tuple[str, int, int]]) -> None:
+        """
+        Saves an ingested file and its pages, replacing any previous
+        record of them, so they are cloned from the latest index.
+
+        Args:
+            session (Session): The database session
+            file_hash (str): The SHA-256 of the file
+            settings (str): The ingestion settings
+            search_index (str): The index it was ingested into
+            source (str): The source in the metadata of its chunks
+            pages (list[tuple[str, int, int]]): The hash, number and
+                number of chunks of every page, in order
+        """
+        session.merge(IngestedFileModel(
+            file_hash=file_hash,
+            settings=settings,
+            search_index=search_index,
+            page_hashes=json.dumps([page_hash for page_hash, _, _ in pages]),
+            created_at=datetime.now()))
+        for page_hash, number, chunks in pages:
+            session.merge(IngestedPageModel(
+                page_hash=page_hash,
+                settings=settings,
+                search_index=search_index,
+                source=source,
+                page=number,
+                chunks=chunks,
+                created_at=datetime.now()))
+        session.commit()
+
+    @staticmethod
+    def move_index(session: Session, search_index: str,
+                   new_search_index: str) -> None:
+        """
+        Records that the chunks of an index have been moved to another
+        (e.g. when a manual is promoted to production), so files and
+        pages are cloned from the new index. Chunks keep their IDs when
+        moved.
+
+        Args:
+            session (Session): The database session
+            search_index (str): The index the chunks were in
+            new_search_index (str): The index the chunks are now in
+        """
+        session.execute(
+            update(IngestedFileModel)
+            .where(IngestedFileModel.search_index == search_index)
+            .values(search_index=new_search_index))
+        session.execute(
+            update(IngestedPageModel)
+            .where(IngestedPageModel.search_index == search_index)
+            .values(search_index=new_search_index))
+        session.commit()
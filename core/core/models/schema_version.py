@@ -0,0 +1,36 @@
+"""
+The SchemaVersionModel records which version of the schema has been
+applied to the database, so that DDL only runs when the models change.
+"""
+
+from datetime import datetime
+
+from sqlalchemy.orm import Mapped, mapped_column
+
+from .common import Base
+
+# Bump this whenever a model (table, column or index) changes, so that
+# the schema is migrated on the next cold start or deployment.
+SCHEMA_VERSION = 6
+
+# New tables and indexes are created automatically. Changes to
+# existing tables need statements (MSSQL) to upgrade a database from
+# an earlier version, keyed by the version they upgrade to.
+SCHEMA_UPGRADES: dict[int, list[str]] = {
+    # conversation_id was VARCHAR(max), which cannot be indexed
+    2: ["IF OBJECT_ID('chat_messages') IS NOT NULL "
+        'ALTER TABLE chat_messages '
+        'ALTER COLUMN conversation_id VARCHAR(36) NOT NULL'],
+}
+
+
+# pylint: disable=too-few-public-methods
+class SchemaVersionModel(Base):
+    """
+    Database model for the applied schema versions. The highest
+    version is the current one.
+    """
+    __tablename__ = 'schema_version'
+    version: Mapped[int] = mapped_column(primary_key=True,
+                                         autoincrement=False)
+    applied_at: Mapped[datetime] = mapped_column(default=datetime.now)
@@ -0,0 +1,220 @@
+"""
+The SummarizationJobModel tracks the summarization of a completed
+conversation, which runs in the background.
+
+There is one job per conversation. Its idempotency key identifies the
+state of the conversation being summarized, so marking a conversation
+as done twice does not summarize it twice, while a conversation that
+has moved on since is summarized again.
+"""
+
+import enum
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Optional
+
+from dataclasses_json import DataClassJsonMixin, config
+from sqlalchemy import Enum, String, Text, and_, or_, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Mapped, Session, mapped_column
+
+from .common import Base
+
+# A running job not updated for this long is presumed lost (e.g. its
+# worker was stopped), and may be started again. Longer than the
+# timeout of a function.
+RUNNING_LEASE = timedelta(minutes=15)
+
+
+class SummarizationJobStatus(enum.Enum):
+    """
+    Enum representing the status of a summarization job.
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    COMPLETED = 'completed'
+    FAILED = 'failed'
+
+
+# pylint: disable=too-few-public-methods
+class SummarizationJobModel(Base):
+    """
+    Database model for summarization jobs.
+    """
+    __tablename__ = 'summarization_jobs'
+    conversation_id: Mapped[str] = mapped_column(String(36),
+                                                 primary_key=True)
+    idempotency_key: Mapped[str] = mapped_column(String(100))
+    status: Mapped[SummarizationJobStatus] = mapped_column(
+        Enum(SummarizationJobStatus))
+    attempts: Mapped[int] = mapped_column(default=0)
+    error: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    updated_at: Mapped[datetime] = mapped_column(default=datetime.now,
+                                                 onupdate=datetime.now)
+
+
+@dataclass
+class SummarizationStatusResponse(DataClassJsonMixin):
+    """
+    The status of a summarization job, as polled by clients.
+    """
+    conversation_id: str = field(metadata=config(
+        field_name="conversationId"))
+    status: str
+    updated_at: datetime = field(metadata=config(
+        field_name="updatedAt",
+        encoder=datetime.isoformat,
+        decoder=datetime.fromisoformat))
+
+    @staticmethod
+    def from_model(model: SummarizationJobModel
+                   ) -> 'SummarizationStatusResponse':
+        """
+        Creates a response from a job.
+        """
+        return SummarizationStatusResponse(
+            conversation_id=model.conversation_id,
+            status=model.status.value,
+            updated_at=model.updated_at)
+
+
+class SummarizationJobDAO:
+    """
+    Methods used with the SummarizationJobModel. These are namespaced,
+    static methods. (i.e. do not instantitate)
+    """
+    def __init__(self):  # pragma: no cover
+        raise NotImplementedError("do not instantiate")
+
+    @staticmethod
+    def get_job(session: Session,
+                conversation_id: str) -> Optional[SummarizationJobModel]:
+        """
+        Gets the summarization job of a conversation.
+
+        Args:
+            session (Session): The database session
+            conversation_id (str): The conversation ID
+
+        Returns:
+            Optional[SummarizationJobModel]: The job, or None if the
+                conversation has never been summarized
+        """
+        return session.get(SummarizationJobModel, conversation_id)
+
+    @staticmethod
+    def queue_job(session: Session, conversation_id: str,
+                  idempotency_key: str) -> tuple[SummarizationJobModel, bool]:
+        """
+        Records a queued job, unless a job with the same idempotency key
+        is already queued, running or completed. Concurrent calls queue
+        the job once.
+
+        Args:
+            session (Session): The database session
+            conversation_id (str): The conversation ID
+            idempotency_key (str): Identifies the state of the
+                conversation to summarize
+
+        Returns:
+            tuple[SummarizationJobModel, bool]: The job, and whether it
+                was queued (i.e. it should be sent to the queue)
+        """
+        job = session.get(SummarizationJobModel, conversation_id)
+        if job is None:
+            job = SummarizationJobModel(
+                conversation_id=conversation_id,
+                idempotency_key=idempotency_key,
+                status=SummarizationJobStatus.QUEUED,
+                attempts=0,
+                error=None,
+                updated_at=datetime.now())
+            session.add(job)
+            try:
+                session.commit()
+                return job, True
+            except IntegrityError:
+                # Another call inserted the job first
+                session.rollback()
+                job = session.get(SummarizationJobModel, conversation_id)
+                assert job is not None
+                return job, False
+        if job.idempotency_key == idempotency_key \
+                and job.status != SummarizationJobStatus.FAILED:
+            return job, False
+
+        # Only replaces the job as it was read, so that of a concurrent
+        # call is left alone
+        result = session.execute(
+            update(SummarizationJobModel)
+            .where(SummarizationJobModel.conversation_id == conversation_id)
+            .where(SummarizationJobModel.idempotency_key ==
+                   job.idempotency_key)
+            .where(SummarizationJobModel.status == job.status)
+            .values(idempotency_key=idempotency_key,
+                    status=SummarizationJobStatus.QUEUED,
+                    attempts=0,
+                    error=None,
+                    updated_at=datetime.now()))
+        session.commit()
+        session.refresh(job)
+        return job, result.rowcount == 1  # type: ignore[attr-defined]
+
+    @staticmethod
+    def start_job(session: Session, conversation_id: str,
+                  idempotency_key: str) -> bool:
+        """
+        Marks a job as running, if it still has the idempotency key and
+        is queued or failed, or has been running for longer than
+        RUNNING_LEASE. Queue messages may be delivered more than once,
+        and a newer job supersedes an older one.
+
+        Args:
+            session (Session): The database session
+            conversation_id (str): The conversation ID
+            idempotency_key (str): The idempotency key of the message
+
+        Returns:
+            bool: True if the job should run, False otherwise
+        """
+        result = session.execute(
+            update(SummarizationJobModel)
+            .where(SummarizationJobModel.conversation_id == conversation_id)
+            .where(SummarizationJobModel.idempotency_key == idempotency_key)
+            .where(or_(
+                SummarizationJobModel.status.in_(
+                    [SummarizationJobStatus.QUEUED,
+                     SummarizationJobStatus.FAILED]),
+                and_(SummarizationJobModel.status ==
+                     SummarizationJobStatus.RUNNING,
+                     SummarizationJobModel.updated_at <
+                     datetime.now() - RUNNING_LEASE)))
+            .values(status=SummarizationJobStatus.RUNNING,
+                    attempts=SummarizationJobModel.attempts + 1,
+                    updated_at=datetime.now()))
+        session.commit()
+        return result.rowcount == 1  # type: ignore[attr-defined]
+
+    @staticmethod
+    def finish_job(session: Session, conversation_id: str,
+                   idempotency_key: str,
+                   error: Optional[str] = None) -> None:
+        """
+        Marks a job as completed, or failed if there is an error. Jobs
+        superseded in the meantime are left alone.
+
+        Args:
+            session (Session): The database session
+            conversation_id (str): The conversation ID
+            idempotency_key (str): The idempotency key of the message
+            error (Optional[str]): The error, if the job failed
+        """
+        session.execute(
+            update(SummarizationJobModel)
+            .where(SummarizationJobModel.conversation_id == conversation_id)
+            .where(SummarizationJobModel.idempotency_key == idempotency_key)
+            .values(status=SummarizationJobStatus.COMPLETED
+                    if error is None else SummarizationJobStatus.FAILED,
+                    error=error,
+                    updated_at=datetime.now()))
+        session.commit()
@@ -2,14 +2,18 @@
 Module to test the chat endpoint
 """
 
+import time
 from datetime import datetime
+from threading import Event
 from typing import Optional, Tuple
 from unittest.mock import MagicMock, PropertyMock, create_autospec, patch
 
 from azure.core.exceptions import ResourceNotFoundError
+from core.functions import chat
 from core.functions.chat import (
-    main, process_message, shadow_msg_to_db, strip_all_citations,
-    ws_log_and_send_error, ws_send_message)
+    DOCUMENT_PROMPT, is_summary_empty, main, process_message,
+    shadow_msg_to_db, strip_all_citations, ws_log_and_send_error,
+    ws_send_message)
 from core.utils.chat_message import ChatMessage
 from core.utils.web_pub_sub_interfaces import \
     WebPubSubConnectionContext
@@ -17,6 +21,7 @@ from core.utils.web_pub_sub_interfaces import \
     WebPubSubRequest
 from openai.types.chat.chat_completion import (ChatCompletion,
                                                ChatCompletionMessage, Choice)
+from openai.types.chat.chat_completion_chunk import ChatCompletionChunk
 
 from base_test_case import BaseTestCase
 
@@ -38,6 +43,8 @@ class TestChat(BaseTestCase):
         self.ai_client = self.services_mock.return_value.openai_chat_model
         self.image_summary = self.services_mock.return_value.\
             image_summary_model
+        self.services_mock.return_value.image_summary_cache.get_or_create\
+            .side_effect = lambda image, create: create()
         self.does_index_exist = patch('core.functions.chat.does_index_exist',
                                       return_value=True).start()
 
@@ -205,10 +212,10 @@ class TestChat(BaseTestCase):
         with patch('core.functions.chat.ws_send_message') as m, \
              patch('core.functions.chat.compress_image') as n, \
              patch('core.functions.chat.save_to_blob') as s, \
-             patch('core.functions.chat.is_url_encoded_image') as v, \
+             patch('core.functions.chat.decode_url_encoded_image') as v, \
              patch('core.functions.chat.shadow_msg_to_db') as shadow:
             n.return_value = b'compressed'
-            v.return_value = True
+            v.return_value = memoryview(b'image')
             self.image_summary.get_image_summary.return_value = 'summary'
 
             process_message(message, '123')
@@ -225,6 +232,41 @@ class TestChat(BaseTestCase):
         # reset for other tests to use
         mocked_create.reset_mock()
 
+    def test_process_message_image_uploads_while_summarising(self):
+        """
+        The blob upload runs while the image is summarised, and a
+        failed upload falls back to the data URL
+        """
+        mocked_create, message = self.__create_mock_chat_completion(
+            'hi', True, 'other-index', True)
+        message.message = 'data:/image/png;base64,Y2x1ZWxlc3M='
+        process_image = getattr(chat, '__process_message_image')
+        uploading = Event()
+
+        def upload(*_):
+            uploading.set()
+            time.sleep(0.05)
+            raise RuntimeError('blob storage is down')
+
+        def summarise(_):
+            # Only returns if the upload started before it finished
+            self.assertTrue(uploading.wait(1))
+            return 'summary'
+
+        with patch('core.functions.chat.ws_send_message'), \
+             patch('core.functions.chat.compress_image',
+                   return_value=b'compressed'), \
+             patch('core.functions.chat.save_to_blob', side_effect=upload), \
+             patch('core.functions.chat.decode_url_encoded_image',
+                   return_value=memoryview(b'image')):
+            self.image_summary.get_image_summary.side_effect = summarise
+            filename, summary = process_image(message, '123')
+
+        self.assertEqual(filename, message.message)
+        self.assertEqual(summary, 'summary')
+        self.image_summary.get_image_summary.side_effect = None
+        mocked_create.reset_mock()
+
     def test_process_message_sad_image_1(self):
         """
         Image not actually an image
@@ -250,9 +292,9 @@ class TestChat(BaseTestCase):
         message.message = 'data:/image/png;base64,Y2x1ZWxlc3M='
         with patch('core.functions.chat.ws_send_message'), \
              patch('core.functions.chat.compress_image') as n, \
-             patch('core.functions.chat.is_url_encoded_image') as v, \
+             patch('core.functions.chat.decode_url_encoded_image') as v, \
              self.assertRaises(OSError):
-            v.return_value = True
+            v.return_value = memoryview(b'image')
             n.side_effect = OSError('trigger error')
             process_message(message, '123')
 
@@ -269,12 +311,12 @@ class TestChat(BaseTestCase):
         with patch('core.functions.chat.ws_send_message'), \
              patch('core.functions.chat.compress_image') as n, \
              patch('core.functions.chat.save_to_blob'), \
-             patch('core.functions.chat.is_url_encoded_image') as v, \
+             patch('core.functions.chat.decode_url_encoded_image') as v, \
              patch('core.functions.chat.shadow_msg_to_db'), \
              self.assertRaises(RuntimeError):
             self.image_summary.get_image_summary.side_effect = RuntimeError(
                 "some error")
-            v.return_value = True
+            v.return_value = memoryview(b'image')
             n.return_value = b'compressed'
             process_message(message, '123')
 
@@ -309,6 +351,302 @@ class TestChat(BaseTestCase):
         self.does_index_exist.side_effect = None
         mocked_create.reset_mock()
 
+    @patch('core.functions.chat.get_search_index_for_user_id',
+           return_value='summary-index')
+    @patch('core.functions.chat.ws_send_message')
+    def test_process_message_concurrent_empty_summary(self, m, _hasher):
+        """
+        In concurrent mode, an empty summary reuses the speculative
+        document index response
+        """
+        mocked_create, message = self.__create_mock_chat_completion(
+            'NONE', True, 'other-index')
+        self.secrets_mock.return_value.get.side_effect = \
+            lambda x: 'concurrent' if x == 'ChatRetrievalMode' else 'secret'
+
+        process_message(message, '123')
+        m.assert_called_once()
+
+        # 3 tries on each index, and no re-query with the summary
+        self.assertEqual(mocked_create.call_count, 6)
+        document_calls = [
+            call for call in mocked_create.call_args_list
+            if call.kwargs['extra_body']['data_sources'][0]['parameters']
+            ['indexName'] == 'other-index']
+        self.assertEqual(len(document_calls), 3)
+        for call in document_calls:
+            self.assertEqual(call.kwargs['extra_body']['data_sources'][0]
+                             ['parameters']['roleInformation'],
+                             DOCUMENT_PROMPT)
+
+        self.secrets_mock.return_value.get.side_effect = None
+        mocked_create.reset_mock()
+
+    @patch('core.functions.chat.get_search_index_for_user_id',
+           return_value='summary-index')
+    @patch('core.functions.chat.ws_send_message')
+    def test_process_message_concurrent_with_summary(self, m, _hasher):
+        """
+        In concurrent mode, a non-empty summary discards the
+        speculative response and queries the document index again
+        """
+        mocked_create, message = self.__create_mock_chat_completion(
+            'hi', True, 'other-index')
+        self.secrets_mock.return_value.get.side_effect = \
+            lambda x: 'concurrent' if x == 'ChatRetrievalMode' else 'secret'
+
+        process_message(message, '123')
+        m.assert_called_once()
+
+        self.assertEqual(mocked_create.call_count, 9)
+        self.assertEqual(mocked_create.call_args_list[-1].kwargs
+                         ['extra_body']['data_sources'][0]['parameters']
+                         ['roleInformation'], DOCUMENT_PROMPT + 'hi')
+
+        self.secrets_mock.return_value.get.side_effect = None
+        mocked_create.reset_mock()
+
+    @patch('core.functions.chat.get_search_index_for_user_id',
+           return_value='summary-index')
+    @patch('core.functions.chat.ws_log_and_send_error')
+    @patch('core.functions.chat.ws_send_message')
+    def test_process_message_concurrent_speculative_fails(self, m, error,
+                                                          _hasher):
+        """
+        In concurrent mode, a failed speculative response sends no
+        error if the summary is used instead
+        """
+        mocked_create, message = self.__create_mock_chat_completion(
+            'hi', True, 'other-index')
+        self.secrets_mock.return_value.get.side_effect = \
+            lambda x: 'concurrent' if x == 'ChatRetrievalMode' else 'secret'
+        document_checks = []
+
+        def index_exists(index: str, _client) -> bool:
+            # Only the speculative query misses the document index
+            if index != 'other-index':
+                return True
+            document_checks.append(index)
+            return len(document_checks) > 1
+
+        self.does_index_exist.side_effect = index_exists
+
+        process_message(message, '123')
+
+        error.assert_not_called()
+        m.assert_called_once()
+        self.assertIn('hi', m.call_args[0][0])
+        self.assertEqual(len(document_checks), 2)
+
+        self.does_index_exist.side_effect = None
+        self.secrets_mock.return_value.get.side_effect = None
+        mocked_create.reset_mock()
+
+    @staticmethod
+    def __make_completion(citations: int) -> MagicMock:
+        completion = MagicMock()
+        completion.choices[0].message.context = {
+            'citations': [{}] * citations}
+        completion.choices.__len__.return_value = 1
+        return completion
+
+    def test_history_windows_serial(self):
+        """
+        Serial mode stops at the first window with citations
+        """
+        responses = {10: self.__make_completion(0),
+                     5: self.__make_completion(2),
+                     1: self.__make_completion(3)}
+        create = MagicMock(side_effect=responses.get)
+        best = getattr(chat, '__query_history_windows_serially')(create)
+        self.assertIs(best, responses[5])
+        self.assertEqual(create.call_count, 2)
+
+    def test_history_windows_parallel(self):
+        """
+        Parallel mode fires every window, and returns the first one
+        with citations
+        """
+        responses = {10: self.__make_completion(0),
+                     5: self.__make_completion(0),
+                     1: self.__make_completion(1)}
+        create = MagicMock(side_effect=responses.get)
+        best = getattr(chat, '__query_history_windows_concurrently')(
+            create, 0)
+        self.assertIs(best, responses[1])
+        self.assertEqual(create.call_count, 3)
+
+    def test_history_windows_parallel_no_winner(self):
+        """
+        Without citations anywhere, ties favour the larger window
+        """
+        responses = {10: self.__make_completion(0),
+                     5: self.__make_completion(0),
+                     1: self.__make_completion(0)}
+        create = MagicMock(side_effect=responses.get)
+        best = getattr(chat, '__query_history_windows_concurrently')(
+            create, 0)
+        self.assertIs(best, responses[10])
+        self.assertEqual(create.call_count, 3)
+
+    def test_history_windows_parallel_failed_window(self):
+        """
+        A failing window is ignored if another window answers, and
+        re-raised only if every window fails
+        """
+        responses = {5: self.__make_completion(0),
+                     1: self.__make_completion(0)}
+
+        def throttled_largest_window(max_history: int) -> MagicMock:
+            if max_history == 10:
+                raise RuntimeError('429')
+            return responses[max_history]
+
+        best = getattr(chat, '__query_history_windows_concurrently')(
+            MagicMock(side_effect=throttled_largest_window), 0)
+        self.assertIs(best, responses[5])
+
+        with self.assertRaisesRegex(RuntimeError, '429'):
+            getattr(chat, '__query_history_windows_concurrently')(
+                MagicMock(side_effect=RuntimeError('429')), 0)
+
+    def test_history_windows_hedged(self):
+        """
+        Hedged mode only launches the next window once the delay has
+        passed
+        """
+        responses = {10: self.__make_completion(1),
+                     5: self.__make_completion(1),
+                     1: self.__make_completion(1)}
+
+        def slow_largest_window(max_history: int) -> MagicMock:
+            if max_history == 10:
+                time.sleep(0.5)
+            return responses[max_history]
+
+        create = MagicMock(side_effect=slow_largest_window)
+        best = getattr(chat, '__query_history_windows_concurrently')(
+            create, 0.05)
+        self.assertIs(best, responses[5])
+        self.assertEqual(create.call_count, 2)
+
+        create = MagicMock(side_effect=responses.get)
+        best = getattr(chat, '__query_history_windows_concurrently')(
+            create, 0.5)
+        self.assertIs(best, responses[10])
+        self.assertEqual(create.call_count, 1)
+
+    @staticmethod
+    def __make_stream(citations: list[dict], *contents: str) -> MagicMock:
+        chunks = [{'choices': [{'index': 0, 'delta': {
+            'role': 'assistant', 'context': {'citations': citations}}}]}]
+        chunks += [{'choices': [{'index': 0, 'delta': {'content': content}}]}
+                   for content in contents]
+        stream = MagicMock()
+        stream.__iter__.return_value = [
+            ChatCompletionChunk.model_validate({
+                'id': 'id', 'created': 0, 'model': 'model',
+                'object': 'chat.completion.chunk', **chunk})
+            for chunk in chunks]
+        return stream
+
+    @patch('core.functions.chat.get_search_index_for_user_id',
+           return_value='summary-index')
+    @patch('core.functions.chat.shadow_msg_to_db')
+    @patch('core.functions.chat.ws_send_message')
+    def test_process_message_streaming(self, m, shadow, _hasher):
+        """
+        In streaming mode, deltas are sent as they arrive, windows
+        without citations are abandoned, and the full response is
+        sent and saved once
+        """
+        _, message = self.__create_mock_chat_completion(
+            'NONE', True, 'other-index')
+        summary_create = self.ai_client.chat.completions.create
+        citation = {'content': 'c', 'title': None, 'url': None,
+                    'filepath': None, 'chunk_id': None}
+        streams = [self.__make_stream([], 'abandoned'),
+                   self.__make_stream([citation], 'h', 'i')]
+        self.ai_client.chat.completions.create = MagicMock(
+            side_effect=lambda **kwargs: streams.pop(0)
+            if kwargs['stream'] else summary_create(**kwargs))
+        self.secrets_mock.return_value.get.side_effect = \
+            lambda x: 'true' if x == 'ChatStreaming' else 'secret'
+
+        with patch('core.functions.chat.translate_citation_urls',
+                   side_effect=lambda citations, *_: citations):
+            process_message(message, '123')
+
+        sent = [call.args[0] for call in m.call_args_list]
+        self.assertEqual(len(sent), 3)
+        self.assertIn('"type": "delta"', sent[0])
+        self.assertIn('"body": "h"', sent[0])
+        self.assertIn('"body": "i"', sent[1])
+        self.assertIn('"body": "hi"', sent[2])
+        self.assertIn('"type": "message"', sent[2])
+        self.assertNotIn('abandoned', ''.join(sent))
+
+        # user message, then the bot message with its citation
+        self.assertEqual(shadow.call_count, 2)
+        self.assertEqual(shadow.call_args.args[1], 'hi')
+        self.assertEqual(len(shadow.call_args.args[4]), 1)
+
+        self.secrets_mock.return_value.get.side_effect = None
+
+    @patch('core.functions.chat.get_search_index_for_user_id',
+           return_value='summary-index')
+    @patch('core.functions.chat.shadow_msg_to_db')
+    @patch('core.functions.chat.ws_send_message')
+    def test_process_message_streaming_no_citations(self, m, shadow,
+                                                    _hasher):
+        """
+        In streaming mode, if no window has citations, the largest
+        window is requested again and streamed
+        """
+        _, message = self.__create_mock_chat_completion(
+            'NONE', True, 'other-index')
+        summary_create = self.ai_client.chat.completions.create
+        streams = [self.__make_stream([], 'ten'),
+                   self.__make_stream([], 'five'),
+                   self.__make_stream([], 'one'),
+                   self.__make_stream([], 'h', 'i')]
+        stream_calls = []
+
+        def create(**kwargs):
+            if not kwargs['stream']:
+                return summary_create(**kwargs)
+            stream_calls.append(len(kwargs['messages']))
+            return streams.pop(0)
+
+        self.ai_client.chat.completions.create = MagicMock(
+            side_effect=create)
+        self.secrets_mock.return_value.get.side_effect = \
+            lambda x: 'true' if x == 'ChatStreaming' else 'secret'
+        history = [{'role': 'user', 'content': str(i)} for i in range(11)]
+
+        with patch('core.functions.chat.db_history_to_ai_history',
+                   return_value=history):
+            process_message(message, '123')
+
+        # 11 messages of history and the new one, cut to each window
+        self.assertEqual(stream_calls, [10, 5, 1, 10])
+        sent = [call.args[0] for call in m.call_args_list]
+        self.assertEqual(len(sent), 3)
+        self.assertIn('"body": "hi"', sent[2])
+        for abandoned in ('ten', 'five', 'one'):
+            self.assertNotIn(abandoned, ''.join(sent))
+        self.assertEqual(shadow.call_args.args[1], 'hi')
+
+        self.secrets_mock.return_value.get.side_effect = None
+
+    def test_is_summary_empty(self):
+        """
+        Empty summaries and NONE are both treated as no summary
+        """
+        self.assertTrue(is_summary_empty(''))
+        self.assertTrue(is_summary_empty(' NONE.\n'))
+        self.assertFalse(is_summary_empty('The user fixed a boiler.'))
+
     @patch('core.functions.chat.ws_log_and_send_error')
     def test_process_message_sad_1(self, m):
         """
@@ -372,6 +710,32 @@ class TestChat(BaseTestCase):
             send_to_connection.assert_called_once_with(
                 '123', 'text', content_type='application/json')
 
+    @patch('core.functions.chat.get_search_index_for_user_id',
+           return_value='validation-index')
+    def test_process_message_saves_turn_after_response(self, _hasher):
+        """
+        The user and bot messages are saved together, once the
+        response has been sent
+        """
+        mocked_create, message = self.__create_mock_chat_completion(
+            'hi', True, None)
+        manager = MagicMock()
+        with patch('core.functions.chat.ws_send_message',
+                   manager.send), \
+                patch('core.functions.chat.ChatMessageDAO.save_messages',
+                      manager.save), \
+                patch('core.functions.chat.ChatMessageDAO.save_message',
+                      manager.save_one):
+            process_message(message, '123')
+
+        self.assertEqual([call[0] for call in manager.mock_calls],
+                         ['send', 'save'])
+        saved = manager.save.call_args.args[1]
+        self.assertEqual([m.message for m in saved], ['blah', 'hi'])
+        self.assertLess(saved[0].sent_at, saved[1].sent_at)
+
+        mocked_create.reset_mock()
+
     @patch('core.functions.chat.ChatMessageDAO.save_message')
     def test_shadow_msg_to_db(self, m):
         """
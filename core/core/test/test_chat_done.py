@@ -2,13 +2,23 @@
 Module to test the chat being done
 """
 
+import json
+from collections import namedtuple
+from datetime import datetime
+from types import SimpleNamespace
 from unittest.mock import patch
 
 import azure.functions as func
+from core.functions import chat_done
 from core.functions.chat_done import main, summarize_and_store
+from core.models.summarization_job import (SummarizationJobModel,
+                                           SummarizationJobStatus)
 
 from base_test_case import BaseTestCase
 
+ChatMessage = namedtuple('ChatMessage',
+                         ['sender', 'message', 'sent_at', 'message_id'])
+
 
 # too many arguments stems from the patching annotations.  it doesn't
 # make sense to cut down on the number of things to patch seeing as
@@ -39,7 +49,14 @@ class TestChatDone(BaseTestCase):
     def test_main_happy(self, gui_mock, csdao_mock, authorise_mock,
                         sas_mock):
         """Parses the expected ChatMessage from input"""
-        main(self.request)
+        self.secrets_mock.return_value.get.side_effect = \
+            lambda x: 'sync' if x == 'SummarizationQueue' else 'secret'
+        self.addCleanup(setattr, self.secrets_mock.return_value.get,
+                        'side_effect', None)
+
+        response = main(self.request)
+
+        self.assertEqual(response.status_code, 200)
 
         sas_mock.assert_called_once()
         authorise_mock.assert_called_once()
@@ -119,3 +136,208 @@ class TestChatDone(BaseTestCase):
 
         sc_mock.assert_called_once()
         sii_mock.assert_called_once()
+
+    @patch('core.functions.chat_done.summarize_refine',
+           return_value='refined')
+    @patch('core.functions.chat_done.summarize_map_reduce',
+           return_value='mapped')
+    @patch('core.functions.chat_done.split_conversation',
+           return_value=['chunk'])
+    @patch('core.functions.chat_done.ConversationSummaryDAO')
+    @patch('core.functions.chat_done.ChatMessageDAO')
+    def test_summarize_conversation_refine(self, dao_mock, csdao_mock,
+                                           sc_mock, smr_mock, sr_mock):
+        """Refines the summary by default, and saves it"""
+        csdao_mock.get_summary.return_value = None
+        dao_mock.get_messages_after.return_value = [
+            ChatMessage('user', 'hello', datetime(2024, 1, 1), '1'),
+            ChatMessage('bot', 'hi', datetime(2024, 1, 2), '2')]
+
+        summary = getattr(chat_done, '__summarize_conversation')('123')
+
+        self.assertEqual(summary, 'refined')
+        self.assertIsNone(dao_mock.get_messages_after.call_args.args[2])
+        self.assertEqual(sc_mock.call_args.args[0],
+                         ['user: hello', 'bot: hi'])
+        sr_mock.assert_called_once()
+        self.assertEqual(sr_mock.call_args.args[0], ['chunk'])
+        self.assertEqual(sr_mock.call_args.args[3], '')
+        self.assertIsNotNone(sr_mock.call_args.kwargs['usage'])
+        smr_mock.assert_not_called()
+        csdao_mock.save_summary.assert_called_once_with(
+            self.services_mock.return_value.db_session, '123', 'refined',
+            datetime(2024, 1, 2), '2')
+
+    @patch('core.functions.chat_done.summarize_refine',
+           return_value='refined')
+    @patch('core.functions.chat_done.summarize_map_reduce',
+           return_value='mapped')
+    @patch('core.functions.chat_done.split_conversation',
+           return_value=['chunk'])
+    @patch('core.functions.chat_done.ConversationSummaryDAO')
+    @patch('core.functions.chat_done.ChatMessageDAO')
+    def test_summarize_conversation_map_reduce(self, dao_mock, csdao_mock,
+                                               sc_mock, smr_mock, sr_mock):
+        """Summarizes concurrently with the configured workers"""
+        csdao_mock.get_summary.return_value = None
+        dao_mock.get_messages_after.return_value = [
+            ChatMessage('user', 'hello', datetime(2024, 1, 1), '1')]
+        self.secrets_mock.return_value.get.side_effect = lambda x: {
+            'SummarizationStrategy': 'mapreduce',
+            'SummarizationWorkers': '8',
+            'SummarizationTokenBudget': '4000'}.get(x, 'secret')
+        self.addCleanup(setattr, self.secrets_mock.return_value.get,
+                        'side_effect', None)
+
+        summary = getattr(chat_done, '__summarize_conversation')('123')
+
+        self.assertEqual(summary, 'mapped')
+        smr_mock.assert_called_once()
+        self.assertEqual(smr_mock.call_args.args[2], 'secret')
+        self.assertEqual(smr_mock.call_args.args[3], 8)
+        self.assertEqual(sc_mock.call_args.args[1:], ('secret', 4000))
+        sr_mock.assert_not_called()
+
+    @patch('core.functions.chat_done.summarize_refine',
+           return_value='refined')
+    @patch('core.functions.chat_done.split_conversation',
+           side_effect=lambda messages, model, budget: messages)
+    @patch('core.functions.chat_done.ConversationSummaryDAO')
+    @patch('core.functions.chat_done.ChatMessageDAO')
+    def test_summarize_conversation_incremental(self, dao_mock, csdao_mock,
+                                                _sc_mock, sr_mock):
+        """Only summarizes the messages after the rolling summary"""
+        csdao_mock.get_summary.return_value = SimpleNamespace(
+            summary='before', summarized_until=datetime(2024, 1, 1),
+            last_message_id='1')
+        dao_mock.get_messages_after.return_value = [
+            ChatMessage('user', 'again', datetime(2024, 1, 3), '3')]
+
+        summary = getattr(chat_done, '__summarize_conversation')('123')
+
+        self.assertEqual(summary, 'refined')
+        self.assertEqual(dao_mock.get_messages_after.call_args.args[1:],
+                         ('123', (datetime(2024, 1, 1), '1')))
+        self.assertEqual(sr_mock.call_args.args[0], ['user: again'])
+        self.assertEqual(sr_mock.call_args.args[3], 'before')
+        csdao_mock.save_summary.assert_called_once_with(
+            self.services_mock.return_value.db_session, '123', 'refined',
+            datetime(2024, 1, 3), '3')
+
+    @patch('core.functions.chat_done.summarize_refine')
+    @patch('core.functions.chat_done.ConversationSummaryDAO')
+    @patch('core.functions.chat_done.ChatMessageDAO')
+    def test_summarize_conversation_no_new_messages(self, dao_mock,
+                                                    csdao_mock, sr_mock):
+        """Reuses the rolling summary without calling the model"""
+        csdao_mock.get_summary.return_value = SimpleNamespace(
+            summary='before', summarized_until=datetime(2024, 1, 1),
+            last_message_id='1')
+        dao_mock.get_messages_after.return_value = []
+
+        summary = getattr(chat_done, '__summarize_conversation')('123')
+
+        self.assertEqual(summary, 'before')
+        sr_mock.assert_not_called()
+        csdao_mock.save_summary.assert_not_called()
+
+    def test_store_into_index(self):
+        """Upserts the summary under the conversation ID"""
+        self.as_patch.reset_mock()
+
+        with patch('core.functions.chat_done.invalidate_index_cache') \
+                as iic_mock:
+            getattr(chat_done, '__store_into_index')('index', '123',
+                                                     'summary')
+
+        add_documents = self.as_patch.return_value.add_documents
+        add_documents.assert_called_once()
+        self.assertEqual(add_documents.call_args.kwargs['keys'], ['123'])
+        document = add_documents.call_args.kwargs['documents'][0]
+        self.assertEqual(document.page_content, 'summary')
+        self.assertEqual(document.metadata['conversation_id'], '123')
+        iic_mock.assert_called_once_with('index')
+
+    @patch('core.functions.chat_done.summarize_and_store')
+    @patch('core.functions.chat_done.SummarizationJobDAO')
+    @patch('core.functions.chat_done.ChatMessageDAO')
+    @patch('core.functions.chat_done.authorise_user', return_value=True)
+    @patch('core.functions.chat_done.ConversationStatusDAO')
+    @patch('core.functions.chat_done.get_user_id', return_value='123')
+    def test_main_queues_summarization(self, gui_mock, csdao_mock,
+                                       authorise_mock, cmdao_mock,
+                                       sjdao_mock, sas_mock):
+        """Queues the summarization, keyed by the latest message"""
+        cmdao_mock.get_messages_page.return_value = [
+            SimpleNamespace(message_id='789')]
+        sjdao_mock.queue_job.return_value = (self.make_job(), True)
+        queue = self.services_mock.return_value.summarization_queue
+        queue.send.reset_mock()
+
+        response = main(self.request)
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(json.loads(response.get_body()), {
+            'conversationId': '123', 'status': 'queued',
+            'updatedAt': '2024-01-01T00:00:00'})
+        csdao_mock.mark_conversation_completed.assert_called_once()
+        authorise_mock.assert_called_once()
+        gui_mock.assert_called_once()
+        sjdao_mock.queue_job.assert_called_once_with(
+            self.services_mock.return_value.db_session, '123', '123:789')
+        queue.send.assert_called_once_with({
+            'user_id': '123', 'conversation_id': '123',
+            'idempotency_key': '123:789'})
+        sas_mock.assert_not_called()
+
+    @patch('core.functions.chat_done.SummarizationJobDAO')
+    @patch('core.functions.chat_done.ChatMessageDAO')
+    @patch('core.functions.chat_done.authorise_user', return_value=True)
+    @patch('core.functions.chat_done.ConversationStatusDAO')
+    @patch('core.functions.chat_done.get_user_id', return_value='123')
+    def test_main_does_not_queue_twice(self, _gui_mock, _csdao_mock,
+                                       _authorise_mock, cmdao_mock,
+                                       sjdao_mock):
+        """Returns the existing job of the same idempotency key"""
+        cmdao_mock.get_messages_page.return_value = []
+        sjdao_mock.queue_job.return_value = (
+            self.make_job(SummarizationJobStatus.RUNNING), False)
+        queue = self.services_mock.return_value.summarization_queue
+        queue.send.reset_mock()
+
+        response = main(self.request)
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(json.loads(response.get_body())['status'],
+                         'running')
+        self.assertEqual(sjdao_mock.queue_job.call_args.args[2],
+                         '123:empty')
+        queue.send.assert_not_called()
+
+    @patch('core.functions.chat_done.SummarizationJobDAO')
+    @patch('core.functions.chat_done.ChatMessageDAO')
+    @patch('core.functions.chat_done.authorise_user', return_value=True)
+    @patch('core.functions.chat_done.ConversationStatusDAO')
+    @patch('core.functions.chat_done.get_user_id', return_value='123')
+    def test_main_queue_failure(self, _gui_mock, _csdao_mock,
+                                _authorise_mock, cmdao_mock, sjdao_mock):
+        """Marks the job as failed, so it can be queued again"""
+        cmdao_mock.get_messages_page.return_value = []
+        sjdao_mock.queue_job.return_value = (self.make_job(), True)
+        queue = self.services_mock.return_value.summarization_queue
+        queue.send.side_effect = RuntimeError('queue down')
+        self.addCleanup(setattr, queue.send, 'side_effect', None)
+
+        with self.assertRaises(RuntimeError):
+            main(self.request)
+
+        sjdao_mock.finish_job.assert_called_once()
+        self.assertIn('queue down', sjdao_mock.finish_job.call_args.args[3])
+
+    @staticmethod
+    def make_job(status=SummarizationJobStatus.QUEUED):
+        """Makes a summarization job of conversation 123"""
+        return SummarizationJobModel(conversation_id='123',
+                                     idempotency_key='123:789',
+                                     status=status,
+                                     updated_at=datetime(2024, 1, 1))
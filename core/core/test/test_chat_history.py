@@ -2,6 +2,8 @@
 Module to test the chat history endpoint
 """
 
+import base64
+from datetime import datetime
 from unittest.mock import create_autospec, patch
 
 import azure.functions as func  # type: ignore[import-untyped]
@@ -9,7 +11,7 @@ from core.functions.chat_history import (get_history_from_db,  # noqa: E402
                                          handle_request_by_conversation_id,
                                          main)
 from core.models.chat_message import ChatMessageModel, Citation
-from core.utils.history import ChatHistoryResponse
+from core.utils.history import ChatHistoryResponse, HistoryCursor
 
 from base_test_case import BaseTestCase
 
@@ -80,13 +82,12 @@ class TestChatHistory(BaseTestCase):
         """
         with patch(
                 'models.chat_message.ChatMessageDAO'
-                '.get_all_messages_for_conversation'
+                '.get_messages_page'
         ) as m, patch(
             'core.utils.get_preauthenticated_blob_url'
             '.get_preauthenticated_blob_url'
         ) as n:
-            # need to list it to consume the map
-            list(get_history_from_db('123'))
+            get_history_from_db('123')
             m.assert_called_once()
             n.assert_not_called()
 
@@ -100,7 +101,7 @@ class TestChatHistory(BaseTestCase):
         """
         with patch(
                 'models.chat_message.ChatMessageDAO'
-                '.get_all_messages_for_conversation'
+                '.get_messages_page'
         ) as m, patch(
             'core.functions.chat_history.get_preauthenticated_blob_url'
         ) as n:
@@ -112,8 +113,7 @@ class TestChatHistory(BaseTestCase):
                 citations=[],
                 is_image=True
             )]
-            # need to list it to consume the map
-            list(get_history_from_db('123'))
+            get_history_from_db('123')
             m.assert_called_once()
             n.assert_called_once()
 
@@ -125,7 +125,7 @@ class TestChatHistory(BaseTestCase):
         """
         with patch(
                 'models.chat_message.ChatMessageDAO'
-                '.get_all_messages_for_conversation'
+                '.get_messages_page'
         ) as m, patch(
             'core.functions.chat_history.translate_citation_urls'
         ) as n:
@@ -138,11 +138,41 @@ class TestChatHistory(BaseTestCase):
                 is_image=False
             )]
             m.return_value[0].citations[0].filepath = 'test'
-            # need to list it to consume the map
-            list(get_history_from_db('123'))
+            get_history_from_db('123')
             m.assert_called_once()
             n.assert_called_once()
 
+    def test_get_history_from_db_container_sas(self):
+        """
+        In container mode, one token is signed for the whole page
+        """
+        self.secrets_mock.return_value.get.side_effect = \
+            lambda x: 'container' if x == 'CitationSasMode' else 'secret'
+        with patch(
+                'models.chat_message.ChatMessageDAO'
+                '.get_messages_page'
+        ) as m, patch(
+            'core.functions.chat_history.get_container_sas_token',
+            return_value='token'
+        ) as sign, patch(
+            'core.functions.chat_history.translate_citation_urls'
+        ) as n:
+            m.return_value = [ChatMessageModel(
+                conversation_id='123',
+                message='hello world',
+                sent_at=123,
+                sender='bot',
+                citations=[{'content': 'c', 'title': None, 'url': None,
+                            'filepath': 'manual.pdf', 'chunk_id': None}],
+                is_image=False
+            ) for _ in range(3)]
+            get_history_from_db('123')
+            sign.assert_called_once()
+            self.assertEqual(n.call_count, 3)
+            self.assertEqual(n.call_args.args[3], 'token')
+
+        self.secrets_mock.return_value.get.side_effect = None
+
     def test_handle_request(self):
         """
         Handling a request should eventually call the DAO to obtain
@@ -150,7 +180,7 @@ class TestChatHistory(BaseTestCase):
         """
         with patch(
                 'models.chat_message.ChatMessageDAO'
-                '.get_all_messages_for_conversation'
+                '.get_messages_page'
         ) as m:
             m.return_value = [ChatMessageModel(
                 conversation_id='123',
@@ -163,3 +193,68 @@ class TestChatHistory(BaseTestCase):
             response = handle_request_by_conversation_id('123')
             m.assert_called_once()
             self.assertEqual(response.messages[0].message, 'hello world')
+
+    def test_main_cursor(self):
+        """
+        The cursor parameter is decoded and passed on
+        """
+        cursor = HistoryCursor(datetime(2024, 1, 1), 'abc')
+        with patch(
+                'core.functions.chat_history.handle_request_by_conversation_id'
+        ) as m:
+            m.return_value = ChatHistoryResponse(messages=[])
+            response = main(
+                func.HttpRequest(
+                    'GET', "/api/chat/history",
+                    params={'conversation_id': '123',
+                            'cursor': cursor.encode()},
+                    headers={'Auth-Token': 'test_token'},
+                    body=b''))
+
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(m.call_args[0][1].sent_at, cursor.sent_at)
+            self.assertEqual(m.call_args[0][1].message_id, cursor.message_id)
+
+    def test_main_invalid_cursor(self):
+        """
+        Malformed cursors are a bad request, including valid JSON that
+        is not a cursor
+        """
+        for cursor in ['zzz'] + [
+                base64.urlsafe_b64encode(payload).decode()
+                for payload in (b'1', b'[]', b'null', b'"x"', b'{}',
+                                b'{"sentAt": 1, "messageId": "a"}',
+                                b'{"sentAt": "x", "messageId": "a"}')]:
+            with self.subTest(cursor=cursor):
+                response = main(
+                    func.HttpRequest(
+                        'GET', "/api/chat/history",
+                        params={'conversation_id': '123', 'cursor': cursor},
+                        headers={'Auth-Token': 'test_token'},
+                        body=b''))
+                self.assertEqual(response.status_code, 400)
+
+    def test_handle_request_next_cursor(self):
+        """
+        A full page carries the cursor of its oldest message
+        """
+        with patch(
+                'models.chat_message.ChatMessageDAO'
+                '.get_messages_page'
+        ) as m, patch('core.functions.chat_history.HISTORY_PAGE_SIZE', 1):
+            m.return_value = [ChatMessageModel(
+                message_id='456',
+                conversation_id='123',
+                message='hello world',
+                sent_at=datetime(2024, 1, 1),
+                citations=[],
+                sender='bot',
+                is_image=False
+            )]
+            response = handle_request_by_conversation_id('123')
+            self.assertEqual(HistoryCursor.decode(response.next_cursor),
+                             HistoryCursor(datetime(2024, 1, 1), '456'))
+
+            m.return_value = []
+            response = handle_request_by_conversation_id('123')
+            self.assertIsNone(response.next_cursor)
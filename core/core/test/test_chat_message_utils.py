@@ -33,3 +33,24 @@ class TestChatMessageUtils(BaseTestCase):
                                                       'nomatter')
         gpbu.assert_called()
         self.assertEqual(translated_citation[0].filepath, 'ret')
+
+    @patch('core.utils.chat_message.get_preauthenticated_blob_url')
+    @patch('azure.storage.blob.BlobServiceClient')
+    def test_translate_citation_urls_container_sas(self, bsc, gpbu):
+        """
+        With a container-scoped token, no blob is signed on its own
+        """
+        bsc.get_container_client.return_value.url = \
+            'https://account/container'
+        citations = [
+            Citation(title='', url='', chunk_id='', content='hello',
+                     filepath=filepath)
+            for filepath in ['manual.pdf', 'dir/my manual.pdf']
+        ]
+        translated = translate_citation_urls(citations, bsc, 'container',
+                                             'sv=token')
+        gpbu.assert_not_called()
+        self.assertEqual(
+            [citation.filepath for citation in translated],
+            ['https://account/container/manual.pdf?sv=token',
+             'https://account/container/dir/my%20manual.pdf?sv=token'])
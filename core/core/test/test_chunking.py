@@ -0,0 +1,114 @@
+"""
+Tests the chunking of uploaded documents
+"""
+
+from core.utils.chunking import (HeadingChunker, PageChunker, TokenChunker,
+                                 chunk_id, make_chunker)
+from langchain_core.documents import Document
+
+from base_test_case import BaseTestCase
+
+
+def count_words(text: str) -> int:
+    """
+    Counts words as tokens.
+    """
+    return len(text.split())
+
+
+def make_page(number: int, text: str) -> Document:
+    """
+    Makes a page of the manual.
+    """
+    return Document(page_content=text,
+                    metadata={'source': 'manual', 'page': number})
+
+
+class TestChunking(BaseTestCase):
+    """
+    Tests the chunkers
+    """
+    def test_page(self):
+        """
+        Keeps every page as a chunk
+        """
+        chunks = list(PageChunker().split([make_page(1, 'a b'),
+                                           make_page(2, 'c')]))
+
+        self.assertEqual([chunk.page_content for chunk in chunks],
+                         ['a b', 'c'])
+        self.assertEqual(chunks[1].metadata,
+                         {'source': 'manual', 'page': 2, 'chunk': 0,
+                          'chunk_id': chunk_id('manual', 2, 0)})
+
+    def test_tokens(self):
+        """
+        Splits pages into chunks of up to chunk_tokens, which overlap
+        """
+        chunker = TokenChunker(4, 1, count_words)
+
+        chunks = list(chunker.split([make_page(1, 'a b c d e f g')]))
+
+        self.assertEqual([chunk.page_content for chunk in chunks],
+                         ['a b c d', 'd e f g'])
+        self.assertEqual([chunk.metadata['chunk'] for chunk in chunks],
+                         [0, 1])
+
+    def test_headings(self):
+        """
+        Splits at headings, and starts every chunk with the headings it
+        falls under, across pages
+        """
+        chunker = HeadingChunker(8, 0, count_words)
+        pages = [
+            make_page(1, '# Manual\n\nIntro text.\n\n## Safety\n\n'
+                         'Isolate the unit first.'),
+            make_page(2, 'Wear gloves and goggles at all times.\n\n'
+                         '## Filters\n\nReplace yearly.'),
+        ]
+
+        chunks = list(chunker.split(pages))
+
+        self.assertEqual(
+            [(chunk.metadata['page'], chunk.metadata['headings'],
+              chunk.page_content) for chunk in chunks],
+            [(1, 'Manual', '# Manual\n\nIntro text.'),
+             (1, 'Manual > Safety',
+              '# Manual\n## Safety\n\nIsolate the unit first.'),
+             (2, 'Manual > Safety',
+              '# Manual\n## Safety\n\nWear gloves and goggles'),
+             (2, 'Manual > Safety',
+              '# Manual\n## Safety\n\nat all times.'),
+             (2, 'Manual > Filters',
+              '# Manual\n## Filters\n\nReplace yearly.')])
+
+    def test_deterministic_ids(self):
+        """
+        Gives the same chunks the same IDs, and different chunks
+        different IDs
+        """
+        pages = [make_page(1, 'a b c d e f g'), make_page(2, 'h i')]
+
+        first = [chunk.metadata['chunk_id'] for chunk in
+                 TokenChunker(4, 0, count_words).split(pages)]
+        second = [chunk.metadata['chunk_id'] for chunk in
+                  TokenChunker(4, 0, count_words).split(pages)]
+
+        self.assertEqual(first, second)
+        self.assertEqual(len(set(first)), 3)
+        self.assertNotEqual(chunk_id('manual', 1, 0),
+                            chunk_id('other', 1, 0))
+
+    def test_make_chunker(self):
+        """
+        Makes the chunker of the strategy, headings by default
+        """
+        self.assertEqual(type(make_chunker('page')).__name__, 'PageChunker')
+        self.assertEqual(type(make_chunker('tokens', 100, 10)).__name__,
+                         'TokenChunker')
+        chunker = make_chunker('headings', 100, 10, count_words)
+        self.assertEqual(type(chunker).__name__, 'HeadingChunker')
+        self.assertEqual((chunker.chunk_tokens, chunker.overlap_tokens),
+                         (100, 10))
+        self.assertEqual(type(make_chunker('unknown')).__name__,
+                         'HeadingChunker')
@@ -4,10 +4,28 @@ Various functions to test stuff in models/.
 Only valuable functions are tested
 """
 
+import tempfile
+import time
+from datetime import datetime, timedelta
+from threading import Barrier, Thread
 from typing import Tuple
-from unittest.mock import MagicMock, patch
+from unittest.mock import DEFAULT, MagicMock, patch
 
-from core.models.chat_message import ChatMessageDAO
+from core.models.chat_message import (SENT_AT_STEP, ChatMessageBuffer,
+                                      ChatMessageDAO, ChatMessageModel,
+                                      SenderTypes)
+from core.models.common import Base
+from core.models.conversation_summary import ConversationSummaryDAO
+from core.models.ingestion_cache import IngestionCacheDAO
+from core.models.schema_version import SCHEMA_VERSION
+from core.models.summarization_job import (RUNNING_LEASE,
+                                           SummarizationJobDAO,
+                                           SummarizationJobStatus)
+from core.utils.db import (create_scoped_session, ensure_schema,
+                           get_schema_version, migrate_schema)
+from core.utils.services import Services
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
 
 from base_test_case import BaseTestCase
 
@@ -65,3 +83,344 @@ class TestDB(BaseTestCase):
         Tests the range with both start and end
         """
         self.assertEqual(self.run_get_all_messages_with_range((1, 999)), 3)
+
+    def test_scoped_session_per_thread(self):
+        """
+        Every thread gets its own session, until it is removed
+        """
+        registry = create_scoped_session(create_engine('sqlite://'))
+        session = registry()
+        other_sessions = []
+        thread = Thread(target=lambda: other_sessions.append(registry()))
+        thread.start()
+        thread.join()
+
+        self.assertIs(registry(), session)
+        self.assertIsNot(other_sessions[0], session)
+        registry.remove()
+        self.assertIsNot(registry(), session)
+
+    @patch('core.utils.services.Secrets')
+    @patch('core.utils.services.create_scoped_session')
+    @patch('core.utils.services.create_db_engine')
+    def test_services_db_engine_once(self, cde_mock, css_mock, _secrets):
+        """
+        The engine and the session registry are created once, even
+        when many threads first use them at once
+        """
+        def slow_engine(*_args, **_kwargs):
+            time.sleep(0.05)
+            return MagicMock()
+
+        cde_mock.side_effect = slow_engine
+        css_mock.side_effect = lambda engine: MagicMock()
+        services = object.__new__(Services)
+        services.__init__()
+        barrier = Barrier(8)
+        sessions = []
+
+        def use_session():
+            barrier.wait()
+            sessions.append(services.db_session)
+
+        threads = [Thread(target=use_session) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        cde_mock.assert_called_once()
+        css_mock.assert_called_once_with(services.db_engine)
+        self.assertEqual(len({id(session) for session in sessions}), 1)
+
+    def test_ensure_schema_only_migrates_once(self):
+        """
+        The schema is migrated on the first check, and skipped once
+        the schema version matches
+        """
+        engine = create_engine('sqlite://')
+        self.assertIsNone(get_schema_version(engine))
+        with patch('core.utils.db.migrate_schema',
+                   wraps=migrate_schema) as migrate:
+            ensure_schema(engine)
+            ensure_schema(engine)
+            migrate.assert_called_once()
+        self.assertEqual(get_schema_version(engine), SCHEMA_VERSION)
+
+    def test_migrate_schema_concurrently(self):
+        """
+        A worker skips the migration if another worker migrated the
+        schema while it waited for the lock, and migrating again
+        succeeds
+        """
+        engine = create_engine('sqlite://')
+        migrate_schema(engine)
+        migrate_schema(engine)
+        self.assertEqual(get_schema_version(engine), SCHEMA_VERSION)
+
+        with patch('core.utils.db.get_schema_version',
+                   side_effect=[None, SCHEMA_VERSION]), \
+                patch('core.utils.db.__migrate') as migrate:
+            ensure_schema(engine)
+        migrate.assert_not_called()
+
+    def test_migration_lock(self):
+        """
+        Migrations hold an application lock on MSSQL, and release it
+        """
+        engine = MagicMock()
+        engine.dialect.name = 'mssql'
+        connection = engine.connect.return_value.__enter__.return_value
+        connection.scalar.return_value = 0
+        with patch('core.utils.db.get_schema_version',
+                   return_value=SCHEMA_VERSION):
+            migrate_schema(engine, outdated_only=True)
+        self.assertIn('sp_getapplock', str(connection.scalar.call_args[0][0]))
+        self.assertIn('sp_releaseapplock',
+                      str(connection.execute.call_args[0][0]))
+
+        connection.scalar.return_value = -1
+        with self.assertRaises(RuntimeError):
+            migrate_schema(engine)
+
+    def test_get_messages_page(self):
+        """
+        Pages through messages with keyset cursors, including messages
+        sent at the same time
+        """
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        start = datetime(2024, 1, 1)
+        with Session(engine) as session:
+            for i in range(5):
+                session.add(ChatMessageModel(
+                    message_id=str(i), conversation_id='123',
+                    message=str(i), sender=SenderTypes.USER,
+                    sent_at=start + timedelta(seconds=min(i, 3))))
+            session.add(ChatMessageModel(
+                message_id='other', conversation_id='456', message='',
+                sender=SenderTypes.USER, sent_at=start))
+            session.commit()
+
+            def page(**kwargs) -> list[str]:
+                return [m.message_id for m in
+                        ChatMessageDAO.get_messages_page(
+                            session, '123', limit=2, **kwargs)]
+
+            self.assertEqual(page(), ['3', '4'])
+            cursor = (start + timedelta(seconds=3), '3')
+            self.assertEqual(page(before=cursor), ['1', '2'])
+            self.assertEqual(page(before=(start + timedelta(seconds=1), '1')),
+                             ['0'])
+            self.assertEqual(page(after=(start, '0')), ['1', '2'])
+            self.assertEqual(page(after=cursor), ['4'])
+
+    def test_get_ai_history(self):
+        """
+        Images are skipped before the limit, and rows are returned as
+        OpenAI messages without being loaded into the session
+        """
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        start = datetime(2024, 1, 1)
+        with Session(engine) as session:
+            for i, (sender, is_image) in enumerate([
+                    (SenderTypes.USER, False), (SenderTypes.BOT, False),
+                    (SenderTypes.USER, True), (SenderTypes.BOT, False),
+                    (SenderTypes.USER, True)]):
+                session.add(ChatMessageModel(
+                    message_id=str(i), conversation_id='123',
+                    message=str(i), sender=sender, is_image=is_image,
+                    sent_at=start + timedelta(seconds=i)))
+            session.commit()
+            session.expunge_all()
+
+            self.assertEqual(
+                ChatMessageDAO.get_ai_history(session, '123', 2),
+                [{'role': 'assistant', 'content': '1'},
+                 {'role': 'assistant', 'content': '3'}])
+            self.assertEqual(len(session.identity_map), 0)
+
+    def test_chat_message_buffer(self):
+        """
+        Buffered messages are saved in one transaction, in the order
+        they were added, even if they were added at the same time
+        """
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        start = datetime(2024, 1, 1)
+        buffer = ChatMessageBuffer()
+        for i in range(3):
+            buffer.add(ChatMessageModel(
+                conversation_id='123', message=str(i),
+                sender=SenderTypes.USER, sent_at=start))
+
+        with Session(engine) as session, \
+                patch.object(session, 'commit',
+                             wraps=session.commit) as commit:
+            buffer.flush(session)
+            commit.assert_called_once()
+            self.assertEqual(len(buffer), 0)
+
+            messages = ChatMessageDAO.get_messages_page(session, '123')
+            self.assertEqual([m.message for m in messages], ['0', '1', '2'])
+            self.assertEqual([m.sent_at for m in messages],
+                             [start, start + SENT_AT_STEP,
+                              start + 2 * SENT_AT_STEP])
+
+    def test_summarization_job_lifecycle(self):
+        """
+        A job is only queued and run once per idempotency key, unless it
+        failed, and a newer key supersedes it
+        """
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        with Session(engine) as session:
+            job, queued = SummarizationJobDAO.queue_job(session, '123', 'a')
+            self.assertTrue(queued)
+            self.assertEqual(job.status, SummarizationJobStatus.QUEUED)
+            _, queued = SummarizationJobDAO.queue_job(session, '123', 'a')
+            self.assertFalse(queued)
+
+            self.assertTrue(SummarizationJobDAO.start_job(session, '123',
+                                                          'a'))
+            SummarizationJobDAO.finish_job(session, '123', 'a', 'oops')
+            job = SummarizationJobDAO.get_job(session, '123')
+            self.assertEqual(job.status, SummarizationJobStatus.FAILED)
+            self.assertEqual(job.error, 'oops')
+            self.assertEqual(job.attempts, 1)
+
+            # Failed jobs are retried by the queue, or queued again
+            self.assertTrue(SummarizationJobDAO.start_job(session, '123',
+                                                          'a'))
+            SummarizationJobDAO.finish_job(session, '123', 'a')
+            session.refresh(job)
+            self.assertEqual(job.status, SummarizationJobStatus.COMPLETED)
+            self.assertEqual(job.attempts, 2)
+            self.assertIsNone(job.error)
+            self.assertFalse(SummarizationJobDAO.start_job(session, '123',
+                                                           'a'))
+            _, queued = SummarizationJobDAO.queue_job(session, '123', 'a')
+            self.assertFalse(queued)
+
+            # The conversation moved on; the old message is stale
+            _, queued = SummarizationJobDAO.queue_job(session, '123', 'b')
+            self.assertTrue(queued)
+            self.assertFalse(SummarizationJobDAO.start_job(session, '123',
+                                                           'a'))
+            self.assertIsNone(SummarizationJobDAO.get_job(session, '456'))
+
+    def test_summarization_job_duplicate_delivery(self):
+        """
+        A running job is not started again, unless its lease expired
+        """
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        with Session(engine) as session:
+            SummarizationJobDAO.queue_job(session, '123', 'a')
+            self.assertTrue(SummarizationJobDAO.start_job(session, '123',
+                                                          'a'))
+            self.assertFalse(SummarizationJobDAO.start_job(session, '123',
+                                                           'a'))
+
+            job = SummarizationJobDAO.get_job(session, '123')
+            job.updated_at = datetime.now() - RUNNING_LEASE \
+                - timedelta(minutes=1)
+            session.commit()
+            self.assertTrue(SummarizationJobDAO.start_job(session, '123',
+                                                          'a'))
+            session.refresh(job)
+            self.assertEqual(job.attempts, 2)
+
+    def test_summarization_job_queued_concurrently(self):
+        """
+        A job queued by two calls at once is only queued by one
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            engine = create_engine(f'sqlite:///{directory}/jobs.db')
+            Base.metadata.create_all(engine)
+            with Session(engine) as first, Session(engine) as second:
+                # Both calls read the job before either inserts it
+                with patch.object(second, 'get',
+                                  side_effect=[None, DEFAULT],
+                                  wraps=second.get):
+                    _, queued = SummarizationJobDAO.queue_job(first, '123',
+                                                              'a')
+                    self.assertTrue(queued)
+                    job, queued = SummarizationJobDAO.queue_job(
+                        second, '123', 'a')
+                self.assertFalse(queued)
+                self.assertEqual(job.status, SummarizationJobStatus.QUEUED)
+
+                # Both calls read the failed job before either queues it
+                SummarizationJobDAO.finish_job(first, '123', 'a', 'oops')
+                second.expire_all()
+                SummarizationJobDAO.get_job(second, '123')
+                _, queued = SummarizationJobDAO.queue_job(first, '123', 'a')
+                self.assertTrue(queued)
+                job, queued = SummarizationJobDAO.queue_job(second, '123',
+                                                            'a')
+                self.assertFalse(queued)
+                self.assertEqual(job.status, SummarizationJobStatus.QUEUED)
+            engine.dispose()
+
+    def test_incremental_summary(self):
+        """
+        The rolling summary is a cursor for the messages after the last
+        summarized message, including those sent at the same time
+        """
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        start = datetime(2024, 1, 1)
+        with Session(engine) as session:
+            for i, sent_at in enumerate([start, start + timedelta(seconds=1),
+                                         start + timedelta(seconds=1),
+                                         start + timedelta(seconds=2)]):
+                session.add(ChatMessageModel(
+                    message_id=str(i), conversation_id='123',
+                    message=str(i), sender=SenderTypes.USER,
+                    sent_at=sent_at))
+            session.commit()
+
+            self.assertIsNone(ConversationSummaryDAO.get_summary(session,
+                                                                 '123'))
+            messages = ChatMessageDAO.get_messages_after(session, '123')
+            self.assertEqual([m.message for m in messages],
+                             ['0', '1', '2', '3'])
+
+            ConversationSummaryDAO.save_summary(
+                session, '123', 'summary', messages[1].sent_at,
+                messages[1].message_id)
+            rolling = ConversationSummaryDAO.get_summary(session, '123')
+            self.assertEqual(rolling.summary, 'summary')
+            messages = ChatMessageDAO.get_messages_after(
+                session, '123',
+                (rolling.summarized_until, rolling.last_message_id))
+            self.assertEqual([m.message for m in messages], ['2', '3'])
+
+    def test_ingestion_cache(self):
+        """
+        Files and their pages are recorded per settings, and the latest
+        ingestion replaces the previous one
+        """
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        with Session(engine) as session:
+            self.assertIsNone(IngestionCacheDAO.get_file(session, 'f', 's'))
+
+            IngestionCacheDAO.save_file(session, 'f', 's', 'index1', 'a',
+                                        [('p1', 1, 2), ('p2', 2, 1)])
+            IngestionCacheDAO.save_file(session, 'g', 's', 'index2', 'b',
+                                        [('p1', 1, 2), ('p3', 2, 4)])
+
+            self.assertEqual(
+                IngestionCacheDAO.get_file(session, 'f', 's').page_hashes,
+                '["p1", "p2"]')
+            self.assertIsNone(IngestionCacheDAO.get_file(session, 'f', 't'))
+            page = IngestionCacheDAO.get_page(session, 'p1', 's')
+            self.assertEqual((page.search_index, page.source, page.page,
+                              page.chunks), ('index2', 'b', 1, 2))
+            self.assertEqual(
+                IngestionCacheDAO.get_page(session, 'p2', 's').search_index,
+                'index1')
+            self.assertIsNone(IngestionCacheDAO.get_page(session, 'p3', 't'))
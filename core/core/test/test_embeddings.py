@@ -0,0 +1,141 @@
+"""
+Tests the batched embeddings
+"""
+
+import threading
+from unittest.mock import MagicMock, patch
+
+import httpx
+import openai
+from core.utils.embeddings import BatchedEmbeddings
+from core.utils.image_summary import MAX_RETRIES
+
+from base_test_case import BaseTestCase
+
+
+def make_rate_limit_error(retry_after: str) -> openai.RateLimitError:
+    """
+    Makes a throttled response error.
+    """
+    return openai.RateLimitError(
+        'Too many requests',
+        response=httpx.Response(
+            429, headers={'Retry-After': retry_after},
+            request=httpx.Request('POST', 'https://mock_base/')),
+        body=None)
+
+
+class TestEmbeddings(BaseTestCase):
+    """
+    Tests the batched embeddings
+    """
+    def setUp(self):
+        patcher = patch('core.utils.embeddings.get_token_counter',
+                        return_value=len)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.embeddings = MagicMock()
+        self.embeddings.embed_documents.side_effect = \
+            lambda texts: [[float(text)] for text in texts]
+
+    def test_embed_documents(self):
+        """
+        Embeds in batches, and keeps the order
+        """
+        batched = BatchedEmbeddings(self.embeddings, batch_size=3,
+                                    workers=2)
+        texts = [str(i) for i in range(8)]
+
+        self.assertEqual(batched.embed_documents(texts),
+                         [[float(i)] for i in range(8)])
+        self.assertEqual(
+            [c.args[0] for c in self.embeddings.embed_documents.call_args_list
+             if c.args[0][0] == '0'], [['0', '1', '2']])
+        self.assertEqual(self.embeddings.embed_documents.call_count, 3)
+        self.assertEqual(batched.embedded_chunks, 8)
+        self.assertGreater(batched.embedded_tokens, 0)
+        self.assertGreater(batched.elapsed_seconds, 0)
+        self.assertEqual(batched.embed_documents([]), [])
+
+    def test_embed_documents_bounds_workers(self):
+        """
+        Never makes more concurrent calls than there are workers
+        """
+        active, peak = 0, 0
+        lock = threading.Lock()
+        barrier = threading.Event()
+
+        def embed_documents(texts):
+            nonlocal active, peak
+            with lock:
+                active += 1
+                peak = max(peak, active)
+            barrier.wait(0.01)
+            with lock:
+                active -= 1
+            return [[0.0] for _ in texts]
+
+        self.embeddings.embed_documents.side_effect = embed_documents
+        BatchedEmbeddings(self.embeddings, batch_size=1,
+                          workers=3).embed_documents(['a'] * 12)
+
+        self.assertEqual(peak, 3)
+
+    @patch('core.utils.embeddings.time.sleep')
+    def test_embed_documents_retries(self, sleep_mock):
+        """
+        Retries throttled batches after Retry-After
+        """
+        self.embeddings.embed_documents.side_effect = [
+            make_rate_limit_error('2'), [[1.0]]]
+        batched = BatchedEmbeddings(self.embeddings)
+
+        self.assertEqual(batched.embed_documents(['1']), [[1.0]])
+        self.assertEqual(batched.retries, 1)
+        sleep_mock.assert_called_once()
+        self.assertAlmostEqual(sleep_mock.call_args.args[0], 2, places=1)
+
+    @patch('core.utils.embeddings.time.sleep')
+    def test_embed_documents_gives_up(self, _sleep_mock):
+        """
+        Raises once the retries are spent
+        """
+        self.embeddings.embed_documents.side_effect = \
+            make_rate_limit_error('0')
+        batched = BatchedEmbeddings(self.embeddings)
+
+        with self.assertRaises(openai.RateLimitError):
+            batched.embed_documents(['1'])
+        self.assertEqual(self.embeddings.embed_documents.call_count,
+                         MAX_RETRIES + 1)
+
+    def test_embed_query(self):
+        """
+        Embeds queries as is
+        """
+        self.embeddings.embed_query.return_value = [1.0]
+
+        self.assertEqual(BatchedEmbeddings(self.embeddings)
+                         .embed_query('query'), [1.0])
+        self.embeddings.embed_query.assert_called_once_with('query')
+
+    def test_reuse(self):
+        """
+        Uses vectors handed over instead of embedding their texts, once
+        """
+        batched = BatchedEmbeddings(self.embeddings, batch_size=2)
+        batched.reuse('1', [-1.0])
+        batched.reuse('3', [-3.0])
+
+        self.assertEqual(batched.embed_documents(['0', '1', '2', '3']),
+                         [[0.0], [-1.0], [2.0], [-3.0]])
+        self.embeddings.embed_documents.assert_called_once_with(['0', '2'])
+        self.assertEqual((batched.embedded_chunks, batched.reused_chunks),
+                         (2, 2))
+
+        self.embeddings.embed_documents.reset_mock()
+        self.assertEqual(batched.embed_documents(['1']), [[1.0]])
+        self.embeddings.embed_documents.assert_called_once_with(['1'])
+
+        batched.reuse('4', [-4.0])
+        self.assertEqual(batched.embed_documents(['4']), [[-4.0]])
@@ -8,6 +8,15 @@ from core.models.pending_uploads import PendingUploadsModel
 from base_test_case import BaseTestCase
 
 
+def make_blob(name: str = 'verification/manual') -> MagicMock:
+    """
+    Makes an uploaded blob.
+    """
+    blob = MagicMock()
+    blob.name = name
+    return blob
+
+
 # The test functions uses the decorators, which has many arguments
 # because it is necessary. Invalid lint.
 # pylint: disable=too-many-arguments
@@ -25,38 +34,180 @@ class TestFileUploadTrigger(BaseTestCase):
             filename='test.pdf',
             username='test',
             user_email='test@example.com')
+        patcher = patch('core.functions.file_upload_trigger.hash_file',
+                        return_value='hash')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch(
+            'core.functions.file_upload_trigger.'
+            'get_preauthenticated_blob_url', return_value='url')
+        self.sas_patch = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch(
+            'core.functions.file_upload_trigger.IngestionCacheDAO')
+        self.cache_dao = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.cache_dao.get_file.return_value = None
 
     @patch('core.functions.file_upload_trigger.PendingUploadsDAO')
     @patch('core.functions.file_upload_trigger.AzureSearch')
-    @patch('core.functions.file_upload_trigger.DocumentIntelligenceParser')
+    @patch('core.functions.file_upload_trigger.ingest')
+    @patch('core.functions.file_upload_trigger.analyze_pages')
     @patch('core.functions.file_upload_trigger.process_outstanding_index')
-    @patch('core.functions.file_upload_trigger.Blob.from_data')
-    def test_main(self, blob, poi, dip_patch, as_patch, pud_patch):
+    def test_main(self, poi, ap_patch, ingest, as_patch, pud_patch):
         """
         Trivial test for file upload trigger
         """
-        main(MagicMock())
+        main(make_blob())
         poi.assert_called()
-        dip_patch.assert_called()
+        ap_patch.assert_called()
+        ingest.assert_called_once()
         as_patch.assert_called()
-        blob.assert_called()
         pud_patch.get_pending_uploads_on_filename.assert_called()
 
+    def mock_secrets(self, **secrets):
+        """
+        Mocks the ingestion secrets; the others are '1'.
+        """
+        secrets = {'IngestionPageWindow': '10',
+                   'IngestionBatchSize': '32',
+                   'ChunkingStrategy': 'tokens',
+                   'ChunkTokens': '256',
+                   'ChunkOverlapTokens': '16',
+                   'IngestionCache': 'sql',
+                   **secrets}
+        self.secrets_mock.return_value.get.side_effect = \
+            lambda x: secrets.get(x, '1')
+        self.addCleanup(setattr, self.secrets_mock.return_value.get,
+                        'side_effect', None)
+
+    @patch('core.functions.file_upload_trigger.AzureSearch')
+    @patch('core.functions.file_upload_trigger.ingest')
+    @patch('core.functions.file_upload_trigger.IngestionCache')
+    @patch('core.functions.file_upload_trigger.make_chunker')
+    @patch('core.functions.file_upload_trigger.analyze_pages')
+    @patch('core.functions.file_upload_trigger.process_outstanding_index')
+    def test_streams_pages(self, _poi, ap_patch, mc_patch, ic_patch, ingest,
+                           as_patch):
+        """
+        Streams the pages analysed from the URL of the blob through
+        the chunker into the vector store, in batches, and records them
+        """
+        self.mock_secrets()
+        main(make_blob())
+
+        self.assertEqual(ap_patch.call_args.args[2](),
+                         self.sas_patch.return_value)
+        self.sas_patch.assert_called_once_with(
+            self.services_mock.return_value.doc_blob_client, 'verification',
+            'manual')
+        self.assertEqual(ap_patch.call_args.args[3], 'verification/manual')
+        self.assertEqual(ap_patch.call_args.kwargs['window'], 10)
+        mc_patch.assert_called_once_with('tokens', chunk_tokens=256,
+                                         overlap_tokens=16)
+        cache = ic_patch.return_value
+        cache.chunk.assert_called_once_with(ap_patch.return_value,
+                                            mc_patch.return_value)
+        ingest.assert_called_once_with(cache.chunk.return_value,
+                                       as_patch.return_value, batch_size=32)
+        self.cache_dao.save_file.assert_called_once_with(
+            self.services_mock.return_value.db_session, 'hash',
+            'tokens:256:16:text-embedding-ada-002', 'manual',
+            'verification/manual', cache.pages)
+
     @patch('core.functions.file_upload_trigger.AzureSearch')
+    @patch('core.functions.file_upload_trigger.ingest')
+    @patch('core.functions.file_upload_trigger.IngestionCache')
+    @patch('core.functions.file_upload_trigger.analyze_pages')
     @patch('core.functions.file_upload_trigger.process_outstanding_index')
-    @patch('core.functions.file_upload_trigger.Blob.from_data')
-    def test_search_index_splicing(self, _blob, _poi, as_patch):
+    def test_clones_ingested_file(self, _poi, ap_patch, ic_patch, ingest,
+                                  as_patch):
+        """
+        Clones a file ingested before, without analysing it
+        """
+        self.mock_secrets()
+        ingested = self.cache_dao.get_file.return_value = MagicMock()
+
+        main(make_blob())
+
+        cache = ic_patch.return_value
+        cache.clone.assert_called_once_with(ingested, 'verification/manual')
+        ingest.assert_called_once_with(cache.clone.return_value,
+                                       as_patch.return_value, batch_size=32)
+        ap_patch.assert_not_called()
+        self.sas_patch.assert_not_called()
+        self.cache_dao.save_file.assert_called_once()
+
+    @patch('core.functions.file_upload_trigger.AzureSearch')
+    @patch('core.functions.file_upload_trigger.ingest')
+    @patch('core.functions.file_upload_trigger.IngestionCache')
+    @patch('core.functions.file_upload_trigger.analyze_pages')
+    @patch('core.functions.file_upload_trigger.process_outstanding_index')
+    def test_clone_falls_back(self, _poi, ap_patch, ic_patch, ingest,
+                              _as_patch):
+        """
+        Ingests the file if its pages are no longer in their index
+        """
+        self.mock_secrets()
+        self.cache_dao.get_file.return_value = MagicMock()
+        ingest.side_effect = [LookupError('page 1'), 5]
+
+        main(make_blob())
+
+        self.assertEqual(ic_patch.call_count, 2)
+        ap_patch.assert_called_once()
+        self.assertEqual(ingest.call_args.args[0],
+                         ic_patch.return_value.chunk.return_value)
+
+    @patch('core.functions.file_upload_trigger.AzureSearch')
+    @patch('core.functions.file_upload_trigger.ingest')
+    @patch('core.functions.file_upload_trigger.process_outstanding_index')
+    def test_cache_disabled(self, _poi, _ingest, _as_patch):
+        """
+        Neither looks up nor records files with IngestionCache none
+        """
+        self.mock_secrets(IngestionCache='none')
+
+        main(make_blob())
+
+        self.cache_dao.get_file.assert_not_called()
+        self.cache_dao.save_file.assert_not_called()
+
+    @patch('core.functions.file_upload_trigger.AzureSearch')
+    @patch('core.functions.file_upload_trigger.process_outstanding_index')
+    @patch('core.functions.file_upload_trigger.ingest')
+    def test_search_index_splicing(self, _ingest, _poi, as_patch):
         """
         Tests the splicing of the search index name from the blob name
         """
-        is_spec = MagicMock()
-        is_spec.name = \
-            "document-storage/2788c990-9822-11ee-8918-5dab27c25f8c"
-        main(is_spec)
+        main(make_blob(
+            "document-storage/2788c990-9822-11ee-8918-5dab27c25f8c"))
         as_patch.assert_called()
         self.assertEqual(as_patch.call_args.kwargs['index_name'],
                          "2788c990-9822-11ee-8918-5dab27c25f8c")
 
+    @patch('core.functions.file_upload_trigger.AzureSearch')
+    @patch('core.functions.file_upload_trigger.process_outstanding_index')
+    @patch('core.functions.file_upload_trigger.ingest')
+    def test_batched_embeddings(self, _ingest, _poi, as_patch):
+        """
+        Embeds the chunks of the document in batches
+        """
+        self.secrets_mock.return_value.get.side_effect = \
+            lambda x: {'EmbeddingBatchSize': '32',
+                       'EmbeddingWorkers': '2'}.get(x, '1')
+        self.addCleanup(setattr, self.secrets_mock.return_value.get,
+                        'side_effect', None)
+
+        main(make_blob())
+
+        embeddings = as_patch.call_args.kwargs['embedding_function']
+        self.assertEqual(type(embeddings).__name__, 'BatchedEmbeddings')
+        self.assertIs(embeddings.embeddings,
+                      self.services_mock.return_value.embeddings)
+        self.assertEqual(embeddings.batch_size, 32)
+        self.assertEqual(embeddings.workers, 2)
+
     @patch('core.functions.file_upload_trigger.send_file_processed_mail')
     @patch('models.pending_uploads.PendingUploadsDAO.delete_for_filename')
     def test_process_outstanding_index_done(self,
@@ -2,10 +2,16 @@
 Testing the get_image_summary function in image_summary.py
 """
 
-from unittest.mock import Mock, patch
-from core.utils.image_summary import ImageSummary
+import asyncio
+from unittest.mock import patch
+
+import httpx
+from core.utils.image_summary import (MAX_RETRIES, ImageSummary,
+                                      next_retry_delay, retry_delay)
 from base_test_case import BaseTestCase
 
+SUMMARY_RESPONSE = {'choices': [{'message': {'content': 'mock_content'}}]}
+
 
 class TestImageSummary(BaseTestCase):
     """
@@ -14,43 +20,50 @@ class TestImageSummary(BaseTestCase):
 
     def setUp(self):
         self.img_summary = ImageSummary(
-            "mock_base",
+            "https://mock_base/",
             "mock_key",
             "mock_deployment"
         )
+        self.responses: list[httpx.Response] = []
+        self.requests: list[httpx.Request] = []
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            self.requests.append(request)
+            return self.responses.pop(0)
 
-    @patch('requests.post')
-    @patch('json.loads')
-    def test_get_image_summary(self, loads_patch, post_patch):
+        transport = httpx.MockTransport(handler)
+        self.img_summary.client = httpx.Client(transport=transport)
+        self.img_summary.async_client = httpx.AsyncClient(
+            transport=transport)
+        self.sleep = patch('core.utils.image_summary.time.sleep').start()
+
+    def tearDown(self):
+        super().tearDown()
+        self.sleep.stop()
+
+    def test_get_image_summary(self):
         """
         Trivial test for get_image_summary
         """
         image = "data:image/"
-        mock_response = {'choices': [{'message': {'content': 'mock_content'}}]}
-        post_patch.return_value = Mock()
-        loads_patch.return_value = mock_response
+        self.responses = [httpx.Response(200, json=SUMMARY_RESPONSE)]
         self.assertEqual(self.img_summary.get_image_summary(image),
                          "mock_content")
-        post_patch.assert_called()
-        loads_patch.assert_called()
+        self.assertEqual(len(self.requests), 1)
 
-    @patch('requests.post')
-    @patch('json.loads')
-    def test_get_image_summary_no_response(self, loads_patch, post_patch):
+    def test_get_image_summary_no_response(self):
         """
         Tests that get_image_summary returns an error message when
         there is no response
         """
         image = "data:image/"
-        mock_response = {'choices': [{'message': {'content': None}}]}
-        post_patch.return_value = Mock()
-        loads_patch.return_value = mock_response
+        self.responses = [httpx.Response(
+            200, json={'choices': [{'message': {'content': None}}]})]
         with self.assertRaisesRegex(
                 RuntimeError,
                 "No response generated by GPT-4 Vision. Please try again."):
             self.img_summary.get_image_summary(image)
-        post_patch.assert_called()
-        loads_patch.assert_called()
+        self.assertEqual(len(self.requests), 1)
 
     def test_get_image_summary_invalid_image(self):
         """
@@ -63,3 +76,73 @@ class TestImageSummary(BaseTestCase):
                 "Image string is not valid. "
                 "Please try again with a valid Image."):
             self.img_summary.get_image_summary(image)
+
+    def test_get_image_summary_retries(self):
+        """
+        Throttled and failed requests are retried, honouring
+        Retry-After
+        """
+        self.responses = [
+            httpx.Response(429, headers={'Retry-After': '2'}),
+            httpx.Response(503),
+            httpx.Response(200, json=SUMMARY_RESPONSE)]
+        self.assertEqual(self.img_summary.get_image_summary("data:image/"),
+                         "mock_content")
+        self.assertEqual(len(self.requests), 3)
+        self.assertEqual(self.sleep.call_args_list[0].args[0], 2)
+
+    def test_get_image_summary_gives_up(self):
+        """
+        Retries are bounded, and client errors are not retried
+        """
+        self.responses = [httpx.Response(500)
+                          for _ in range(MAX_RETRIES + 1)]
+        with self.assertRaises(RuntimeError):
+            self.img_summary.get_image_summary("data:image/")
+        self.assertEqual(len(self.requests), MAX_RETRIES + 1)
+
+        self.requests.clear()
+        self.responses = [httpx.Response(400, json={'error': 'bad'})]
+        with self.assertRaises(RuntimeError):
+            self.img_summary.get_image_summary("data:image/")
+        self.assertEqual(len(self.requests), 1)
+
+    def test_get_image_summary_async(self):
+        """
+        The async variant retries the same way
+        """
+        self.responses = [httpx.Response(502),
+                          httpx.Response(200, json=SUMMARY_RESPONSE)]
+
+        async def run() -> str:
+            return await self.img_summary.get_image_summary_async(
+                "data:image/")
+
+        with patch('core.utils.image_summary.asyncio.sleep') as sleep:
+            self.assertEqual(asyncio.run(run()), "mock_content")
+            sleep.assert_awaited_once()
+        self.assertEqual(len(self.requests), 2)
+
+    def test_retry_delay(self):
+        """
+        Without Retry-After, the delay is a jittered exponential backoff
+        """
+        for attempt in range(4):
+            self.assertLessEqual(retry_delay(attempt, None), 2 ** attempt)
+        self.assertEqual(retry_delay(
+            0, httpx.Response(429, headers={'Retry-After': '1000'})), 30)
+        self.assertEqual(retry_delay(
+            0, httpx.Response(429, headers={'Retry-After': 'nonsense'})), 0)
+
+    def test_next_retry_delay(self):
+        """
+        Final responses stop, and unretried connection errors are raised
+        """
+        self.assertIsNone(next_retry_delay(0, httpx.Response(200)))
+        self.assertIsNone(next_retry_delay(0, httpx.Response(400)))
+        self.assertEqual(next_retry_delay(
+            0, httpx.Response(429, headers={'Retry-After': '3'})), 3)
+        error = httpx.ConnectError('refused')
+        self.assertIsNotNone(next_retry_delay(0, None, error))
+        with self.assertRaises(httpx.ConnectError):
+            next_retry_delay(MAX_RETRIES, None, error)
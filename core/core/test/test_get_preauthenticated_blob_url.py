@@ -2,9 +2,11 @@
 Module to test the get_preauthenticated_blob_url function.
 """
 
+from datetime import datetime, timedelta
 from unittest.mock import patch, MagicMock
-from core.utils.get_preauthenticated_blob_url import \
-    get_preauthenticated_blob_url
+from core.utils.get_preauthenticated_blob_url import (
+    MAX_CACHED_URLS, SAS_SAFETY_MARGIN, SasUrlCache, get_container_sas_token,
+    get_preauthenticated_blob_url)
 from base_test_case import BaseTestCase
 
 
@@ -12,6 +14,9 @@ class TestGetPreauthenticatedBlobUrl(BaseTestCase):
     """
     Tests the preauthenticated blob URL function
     """
+    def setUp(self):
+        SasUrlCache().clear()
+
     @patch('core.utils.get_preauthenticated_blob_url.generate_blob_sas')
     def test_preauthenticated_blob_url_generates_tokens(self, m):
         """
@@ -28,3 +33,61 @@ class TestGetPreauthenticatedBlobUrl(BaseTestCase):
                                           'some_file')
         m.assert_called_once()
         self.assertEqual(token, 'some_url?test_token')
+
+    @patch('core.utils.get_preauthenticated_blob_url.generate_blob_sas')
+    def test_preauthenticated_blob_url_is_cached(self, m):
+        """
+        The same blob is only signed once, until it is about to expire
+        """
+        client = MagicMock()
+        client.account_name = 'account'
+        client.get_blob_client.return_value.url = 'some_url'
+        m.return_value = 'test_token'
+
+        for _ in range(3):
+            self.assertEqual(
+                get_preauthenticated_blob_url(client, 'container', 'a.pdf'),
+                'some_url?test_token')
+        m.assert_called_once()
+        self.assertEqual(SasUrlCache().hits, 2)
+
+        get_preauthenticated_blob_url(client, 'container', 'b.pdf')
+        self.assertEqual(m.call_count, 2)
+
+        with patch('core.utils.get_preauthenticated_blob_url.datetime') \
+                as mock_datetime:
+            mock_datetime.utcnow.return_value = \
+                datetime.utcnow() + timedelta(hours=1) - SAS_SAFETY_MARGIN
+            get_preauthenticated_blob_url(client, 'container', 'a.pdf')
+        self.assertEqual(m.call_count, 3)
+
+    def test_sas_url_cache_evicts_least_recently_used(self):
+        """
+        The cache is bounded, and evicts the least recently used URL
+        """
+        cache = SasUrlCache()
+        cache.max_size = 2
+        self.addCleanup(setattr, cache, 'max_size', MAX_CACHED_URLS)
+        expiry = datetime.utcnow() + timedelta(hours=1)
+        cache.put('account', 'container', 'a', 'url_a', expiry)
+        cache.put('account', 'container', 'b', 'url_b', expiry)
+        self.assertEqual(cache.get('account', 'container', 'a'), 'url_a')
+        cache.put('account', 'container', 'c', 'url_c', expiry)
+
+        self.assertIsNone(cache.get('account', 'container', 'b'))
+        self.assertEqual(cache.get('account', 'container', 'a'), 'url_a')
+        self.assertEqual(cache.evictions, 1)
+        self.assertAlmostEqual(cache.hit_rate(), 2 / 3)
+
+    @patch('core.utils.get_preauthenticated_blob_url.generate_container_sas')
+    def test_container_sas_token_is_read_only(self, m):
+        """
+        Container-scoped tokens only grant reading
+        """
+        m.return_value = 'test_token'
+        self.assertEqual(get_container_sas_token(MagicMock(), 'container'),
+                         'test_token')
+        permission = m.call_args.kwargs['permission']
+        self.assertTrue(permission.read)
+        self.assertFalse(permission.write)
+        self.assertFalse(permission.list)
@@ -0,0 +1,109 @@
+"""
+Module to test the image summary cache
+"""
+
+from io import BytesIO
+from unittest.mock import MagicMock
+
+from core.models.common import Base
+from core.utils.image_summary_cache import (ImageSummaryCache,
+                                            InMemorySummaryStore,
+                                            SqlSummaryStore)
+from PIL import Image
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from base_test_case import BaseTestCase
+
+
+def make_png(width: int, height: int, radial: bool = True) -> bytes:
+    """
+    Makes a gradient PNG
+    """
+    gradient = Image.radial_gradient('L') if radial \
+        else Image.linear_gradient('L').rotate(270)
+    img = gradient.resize((width, height))
+    out = BytesIO()
+    img.save(out, format='PNG')
+    return out.getvalue()
+
+
+class TestImageSummaryCache(BaseTestCase):
+    """
+    Tests the image summary cache and its stores
+    """
+    def test_repeated_image_is_summarised_once(self):
+        """
+        The same image is only summarised once
+        """
+        cache = ImageSummaryCache(InMemorySummaryStore())
+        create = MagicMock(return_value='a nameplate')
+        for _ in range(3):
+            self.assertEqual(cache.get_or_create(b'image', create),
+                             'a nameplate')
+        create.assert_called_once()
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+        cache.get_or_create(b'other image', create)
+        self.assertEqual(create.call_count, 2)
+
+    def test_disabled_cache(self):
+        """
+        Without a store, every image is summarised
+        """
+        cache = ImageSummaryCache(None)
+        create = MagicMock(return_value='summary')
+        cache.get_or_create(b'image', create)
+        cache.get_or_create(b'image', create)
+        self.assertEqual(create.call_count, 2)
+
+    def test_store_failures_are_misses(self):
+        """
+        A failing store does not fail the summary
+        """
+        store = MagicMock()
+        store.get.side_effect = RuntimeError('unavailable')
+        store.put.side_effect = RuntimeError('unavailable')
+        cache = ImageSummaryCache(store)
+        self.assertEqual(cache.get_or_create(b'image', lambda: 'summary'),
+                         'summary')
+
+    def test_in_memory_store_evicts_least_recently_used(self):
+        """
+        The in-memory store is bounded
+        """
+        store = InMemorySummaryStore(max_size=2)
+        store.put('a', 'summary a')
+        store.put('b', 'summary b')
+        self.assertEqual(store.get('a'), 'summary a')
+        store.put('c', 'summary c')
+        self.assertIsNone(store.get('b'))
+        self.assertEqual(store.get('a'), 'summary a')
+
+    def test_perceptual_key(self):
+        """
+        Resized copies of an image share a perceptual key, but not a
+        SHA-256 key
+        """
+        perceptual = ImageSummaryCache(None, perceptual=True)
+        exact = ImageSummaryCache(None)
+        small, large = make_png(64, 48), make_png(640, 480)
+
+        self.assertEqual(perceptual.key_for(small), perceptual.key_for(large))
+        self.assertNotEqual(exact.key_for(small), exact.key_for(large))
+        self.assertTrue(perceptual.key_for(small).startswith('dhash:'))
+        self.assertNotEqual(perceptual.key_for(small),
+                            perceptual.key_for(make_png(64, 48, False)))
+
+    def test_sql_store(self):
+        """
+        Summaries are shared through the database
+        """
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        with Session(engine) as session:
+            store = SqlSummaryStore(lambda: session)
+            self.assertIsNone(store.get('sha256:abc'))
+            store.put('sha256:abc', 'summary')
+            store.put('sha256:abc', 'better summary')
+            self.assertEqual(store.get('sha256:abc'), 'better summary')
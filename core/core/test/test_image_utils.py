@@ -6,14 +6,30 @@ import base64
 from io import BytesIO
 
 import puremagic  # type: ignore[import-untyped]
-from core.utils.image_utils import compress_image, is_url_encoded_image
-from PIL import Image
+from core.utils.image_utils import (COMPRESSION_PRESETS, compress_image,
+                                    decode_url_encoded_image,
+                                    get_compression_preset,
+                                    is_url_encoded_image)
+from PIL import ExifTags, Image
 
 from base_test_case import BaseTestCase
 
 IMAGE_BASE64 = "iVBORw0KGgoAAAANSUhEUgAAABwAAAAcCAQAAADYBBcfAAAABGdBTUEAALGPC/xhBQAAACBjSFJNAAB6JgAAgIQAAPoAAACA6AAAdTAAAOpgAAA6mAAAF3CculE8AAAAAmJLR0QA/4ePzL8AAAAJcEhZcwAACxMAAAsTAQCanBgAAAAHdElNRQfoAQgWDyUaICVaAAAEPElEQVQ4y12Ua4iUZRTH/+e97Mw0OzM7e9PddRXNWybebQ3UVrEkqSwSkwKRioI+JKF9KMsEIQhFMAyhDwUVpH3IC2ptaIhiIBmuIZm56wVveaF119vOvO/7/PqwY2jncOD58Jzb/3/O8SWzBYbuei1eL7IndE4PStpChV7KcqQsryr1S5JMJvIWeHOT3uByquuxpK3qbjzcjaaMeYH9Xf5dUXhw9h/7XNF3LnJmt5EkpZTxzJNGNlV9lruWjQOEMDzEUp5jIm1uGE1f5moDNVjO6lQ3UEi9L/swHa5Sz2xeQq45Whntijvjb+KH4+FxfTwumpOMdQ+RPVO9pzg3p5zfYoEkVatujI5NZAeb3GD3Kts4wAFOAFe4wVlmIzJkXTYpUvNijfJVvvImqXVM6rd5lOLdLmQqK2nCCMmzAehhPRlStJKjPkmRO9w6epia/UFqNNmaCRBtJaRAEUNsBJYTcodl+HQwizxiLStdlmJncYQ0yHtaUscrfOBEljzLmM8G+tnOEKaQsAixlW62soOrHKYYiZofJHkjTdq/mktJJ52008gLtNNAgVVcJuEqn5KllhaaaUIsYlc8AvtIKvimk++N/piSpdSrjboh06Nq1wjFkky+zuukSpKkjCao3r3lbT6qKS2mfPQrjlv0s51TQAI4SkTERJRwgGNAImAXut0yo1Y26M6RTLNKyqhNOe2Ur5SQ/TdwyBTrqo7rZ8Xy1Oa2eN/vd3Os9taebJsihdqnZ2SarhVKV1yR1K/P1a2zQuM0SGdUYp0tvVY/STq4GFyEAw6xhnGkqCYkJCSgmiyLWcEmDgGbaWIKf9JI1Uz5bw/hagJlyjigl+v0cKOiPVynXOn8LzLM4zh3XStarpah6n4fXB8RjugBMAZeAyBBBz7XSYA30Wn5yr5e5EKcUAIcjuR/6nDEQAdpLnMH2Ev6opdV67aeC+/6vSSVBfUq5uRk9+F7W6a0MpJ61Z9V6AUaPEu3v67w9GCZSYVXR8R4nhpg001DW1VjBV/Sd5M5FUO58g0S1rKFhIR++oHDiJ1AQhc1+AskNXiTNG2Mjj4PSamSAcosRCyhD4i4xOOMpY+b4N5Ap0e1qs5qVe3n1TxV5xZC5CgTV+DYTpoGZjENn5F0cwvY40Th2ZQk1VhBuSBQfrL1LORmTBJzkz5KwHnW8Q4r+IJ/6IekM6kj/FaSJymlwNLW6Mlqlga/jHOrOeZInHPuXr/gcM4lXyWjCH/cEciTmST5yptI/CVJV/rAy/FrdTPavZl6RGOUpyyTqc+OaIt2X0k2j9xYd+OE59w9kkySVfmNhvCan9R6u+hdro0bKFDLUBoTXUvtmTa0SqFf8KRKRqmokkJDiQK/2k13821vpuz/NLqUEpJHpjy7a/WtGa7GB+dk4r5T3yKpYBnlrSGoD2RSoRJ2vALLaYTf4H0iFJgk/QvX9CRM4Hg5dQAAACV0RVh0ZGF0ZTpjcmVhdGUAMjAyNC0wMS0wOFQyMjoxNToyNyswMDowMNXbtnQAAAAldEVYdGRhdGU6bW9kaWZ5ADIwMjQtMDEtMDhUMjI6MTU6MjcrMDA6MDCkhg7IAAAAAElFTkSuQmCC"  # pylint: disable=line-too-long # noqa: E501
 
 
+def make_jpeg(width: int, height: int, orientation: int = 1,
+              quality: int = 95) -> bytes:
+    """
+    Makes a noisy JPEG with an EXIF orientation
+    """
+    img = Image.merge('RGB', [Image.effect_noise((width, height), 64)] * 3)
+    exif = Image.Exif()
+    exif[ExifTags.Base.Orientation] = orientation
+    out = BytesIO()
+    img.save(out, format='JPEG', quality=quality, exif=exif)
+    return out.getvalue()
+
+
 class TestImageUtils(BaseTestCase):
     """
     Test the image utilities
@@ -56,3 +72,55 @@ class TestImageUtils(BaseTestCase):
 
         fake_encoded_img = "data:/image/png;base64,Y2x1ZWxlc3M="
         self.assertFalse(is_url_encoded_image(fake_encoded_img))
+
+    def test_decode_url_encoded_image(self):
+        """
+        The image is decoded once, into a buffer that compress_image
+        takes as is
+        """
+        decoded = decode_url_encoded_image(
+            f"data:image/png;base64,{IMAGE_BASE64}")
+        assert decoded is not None
+        self.assertEqual(decoded.tobytes(), base64.b64decode(IMAGE_BASE64))
+        self.assertEqual(puremagic.from_string(compress_image(decoded)),
+                         '.jfif')
+
+        self.assertIsNone(decode_url_encoded_image("data:image/png;base64,"))
+        self.assertIsNone(decode_url_encoded_image("data:image/png;base64"))
+        self.assertIsNone(decode_url_encoded_image(
+            "data:image/png;base64,Y2x1ZWxlc3M="))
+        self.assertIsNone(decode_url_encoded_image(
+            f"data:image/png;base64,{IMAGE_BASE64[:-5]}"))
+
+    def test_compress_large_jpeg(self):
+        """
+        Large JPEGs are downscaled (in draft mode) to the exact width
+        """
+        compressed = compress_image(make_jpeg(2400, 1800), 600)
+        self.assertEqual(Image.open(BytesIO(compressed)).size, (600, 450))
+
+    def test_compress_applies_exif_orientation(self):
+        """
+        Images are rotated upright, and resized by their upright width
+        """
+        compressed = compress_image(make_jpeg(2400, 1200, orientation=6),
+                                    600)
+        self.assertEqual(Image.open(BytesIO(compressed)).size, (600, 1200))
+
+        compressed = compress_image(make_jpeg(200, 100, orientation=8), 600)
+        self.assertEqual(Image.open(BytesIO(compressed)).size, (100, 200))
+
+    def test_compression_presets(self):
+        """
+        Lower quality presets produce smaller images, and unknown
+        presets fall back to the default
+        """
+        image = make_jpeg(1200, 900)
+        sizes = [len(compress_image(image, preset.width,
+                                    quality=preset.quality))
+                 for preset in (get_compression_preset('small'),
+                                get_compression_preset('default'),
+                                get_compression_preset('detailed'))]
+        self.assertEqual(sizes, sorted(sizes))
+        self.assertEqual(get_compression_preset('nonsense'),
+                         COMPRESSION_PRESETS['default'])
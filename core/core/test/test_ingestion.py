@@ -0,0 +1,244 @@
+"""
+Tests the streaming ingestion of uploaded documents
+"""
+
+import json
+import threading
+import time
+from unittest.mock import MagicMock
+
+from azure.core.exceptions import HttpResponseError
+from core.utils.ingestion import analyze_pages, batched, ingest, prefetch
+from langchain_core.documents import Document
+
+from base_test_case import BaseTestCase
+
+
+URL = 'https://account.blob.core.windows.net/verification/manual?sas'
+
+
+def make_error(code: str, message: str) -> HttpResponseError:
+    """
+    Makes a Document Intelligence error for a bad request.
+    """
+    response = MagicMock(status_code=400)
+    response.text.return_value = json.dumps({'error': {
+        'code': 'InvalidRequest', 'message': 'Invalid request.',
+        'innererror': {'code': code, 'message': message}}})
+    return HttpResponseError(response=response)
+
+
+def make_client(page_count: int) -> MagicMock:
+    """
+    Makes a Document Intelligence client for a document of page_count
+    pages, which rejects page ranges past its end.
+    """
+    def begin_analyze_document_from_url(model, document_url, pages):
+        # pylint: disable=unused-argument
+        assert document_url == URL
+        first, last = (int(page) for page in pages.split('-'))
+        if first > page_count:
+            raise make_error('InvalidParameter',
+                             'The parameter pages is invalid.')
+        result = []
+        for number in range(first, min(last, page_count) + 1):
+            page = MagicMock(page_number=number)
+            page.lines = [MagicMock(content=f'page {number}'),
+                          MagicMock(content='text')]
+            result.append(page)
+        poller = MagicMock()
+        poller.result.return_value.pages = result
+        poller.result.return_value.paragraphs = None
+        return poller
+
+    client = MagicMock()
+    client.begin_analyze_document_from_url.side_effect = \
+        begin_analyze_document_from_url
+    return client
+
+
+class TestIngestion(BaseTestCase):
+    """
+    Tests the streaming ingestion of uploaded documents
+    """
+    def test_analyze_pages(self):
+        """
+        Analyses the document a window of pages at a time
+        """
+        client = make_client(45)
+
+        pages = list(analyze_pages(client, 'model', lambda: URL,
+                                   'manual', window=20))
+
+        self.assertEqual([page.metadata['page'] for page in pages],
+                         list(range(1, 46)))
+        self.assertEqual(pages[0].page_content, 'page 1 text')
+        self.assertEqual(pages[0].metadata['source'], 'manual')
+        self.assertEqual(
+            [call.kwargs['pages'] for call in
+             client.begin_analyze_document_from_url.call_args_list],
+            ['1-20', '21-40', '41-60'])
+
+    def test_analyze_pages_paragraphs(self):
+        """
+        Separates paragraphs, marks headings, and skips page furniture
+        """
+        def paragraph(role, content, page):
+            return MagicMock(role=role, content=content,
+                             bounding_regions=[MagicMock(page_number=page)])
+
+        client = MagicMock()
+        result = client.begin_analyze_document_from_url.return_value.result
+        result.return_value.pages = [MagicMock(page_number=1),
+                                     MagicMock(page_number=2)]
+        result.return_value.paragraphs = [
+            paragraph('pageHeader', 'ACME Chiller', 1),
+            paragraph('title', 'Service manual', 1),
+            paragraph('sectionHeading', 'Safety', 1),
+            paragraph(None, 'Isolate the unit.', 1),
+            paragraph(None, 'Wear gloves.', 2),
+            paragraph('pageNumber', '2', 2)]
+
+        pages = list(analyze_pages(client, 'model', lambda: URL))
+
+        self.assertEqual(
+            [page.page_content for page in pages],
+            ['# Service manual\n\n## Safety\n\nIsolate the unit.',
+             'Wear gloves.'])
+
+    def test_analyze_pages_whole_windows(self):
+        """
+        Stops when the window after the last page is out of range
+        """
+        client = make_client(40)
+
+        pages = list(analyze_pages(client, 'model', lambda: URL,
+                                   window=20))
+
+        self.assertEqual(len(pages), 40)
+        self.assertEqual(client.begin_analyze_document_from_url.call_count, 3)
+
+    def test_analyze_pages_error(self):
+        """
+        Raises errors of the first window
+        """
+        with self.assertRaises(HttpResponseError):
+            list(analyze_pages(make_client(0), 'model', lambda: URL))
+
+    def test_analyze_pages_bad_request(self):
+        """
+        Raises bad requests of later windows other than page ranges
+        """
+        client = make_client(40)
+        side_effect = client.begin_analyze_document_from_url.side_effect
+
+        def corrupt_second_window(model, document, pages):
+            if pages.startswith('21-'):
+                raise make_error('InvalidContent', 'The file is corrupted.')
+            return side_effect(model, document, pages)
+
+        client.begin_analyze_document_from_url.side_effect = \
+            corrupt_second_window
+
+        with self.assertRaises(HttpResponseError):
+            list(analyze_pages(client, 'model', lambda: URL, window=20))
+
+    def test_analyze_pages_lazily(self):
+        """
+        Analyses the next window only when its pages are needed
+        """
+        client = make_client(45)
+
+        next(analyze_pages(client, 'model', lambda: URL, window=20))
+
+        self.assertEqual(client.begin_analyze_document_from_url.call_count, 1)
+
+    def test_batched(self):
+        """
+        Groups items in order, with a shorter last group
+        """
+        self.assertEqual(list(batched(range(5), 2)), [[0, 1], [2, 3], [4]])
+        self.assertEqual(list(batched([], 2)), [])
+
+    def test_prefetch_bounded(self):
+        """
+        Produces items in order, at most depth items ahead
+        """
+        produced = 0
+        lock = threading.Lock()
+
+        def produce():
+            nonlocal produced
+            for i in range(10):
+                with lock:
+                    produced += 1
+                yield i
+
+        items = []
+        for item in prefetch(produce(), depth=2):
+            time.sleep(0.01)
+            with lock:
+                # The queued items, and the one waiting to be put
+                self.assertLessEqual(produced, len(items) + 1 + 2 + 1)
+            items.append(item)
+
+        self.assertEqual(items, list(range(10)))
+
+    def test_prefetch_error(self):
+        """
+        Raises errors of the producer to the consumer
+        """
+        def produce():
+            yield 1
+            raise ValueError('parse failed')
+
+        items = []
+        with self.assertRaises(ValueError):
+            for item in prefetch(produce()):
+                items.append(item)
+        self.assertEqual(items, [1])
+
+    def test_ingest(self):
+        """
+        Adds the pages in batches, the first before the last page is
+        parsed
+        """
+        parsed = 0
+
+        def parse():
+            nonlocal parsed
+            for i in range(10):
+                parsed += 1
+                yield Document(page_content=str(i))
+
+        vector_store = MagicMock()
+        parsed_when_added = []
+        vector_store.add_documents.side_effect = \
+            lambda batch: parsed_when_added.append(parsed)
+
+        self.assertEqual(ingest(parse(), vector_store, batch_size=2,
+                                depth=1), 10)
+
+        batches = [call.args[0] for call in
+                   vector_store.add_documents.call_args_list]
+        self.assertEqual([[page.page_content for page in batch]
+                          for batch in batches],
+                         [['0', '1'], ['2', '3'], ['4', '5'], ['6', '7'],
+                          ['8', '9']])
+        self.assertLess(parsed_when_added[0], 10)
+
+    def test_ingest_keys(self):
+        """
+        Uploads chunks under their IDs
+        """
+        vector_store = MagicMock()
+        chunks = [Document(page_content=str(i),
+                           metadata={'chunk_id': f'id{i}'})
+                  for i in range(3)]
+
+        ingest(chunks, vector_store, batch_size=2)
+
+        self.assertEqual(
+            [call.kwargs['keys'] for call in
+             vector_store.add_documents.call_args_list],
+            [['id0', 'id1'], ['id2']])
@@ -0,0 +1,206 @@
+"""
+Tests reusing the chunks and vectors of manuals ingested before
+"""
+
+import hashlib
+import json
+import re
+from io import BytesIO
+from unittest.mock import MagicMock
+
+from azure.core.exceptions import HttpResponseError
+from core.models.common import Base
+from core.models.ingestion_cache import (IngestedFileModel,
+                                         IngestedPageModel, IngestionCacheDAO)
+from core.utils.chunking import HeadingChunker, TokenChunker
+from core.utils.ingestion_cache import (IngestionCache, hash_file,
+                                        hash_page, search_key)
+from langchain_core.documents import Document
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from base_test_case import BaseTestCase
+
+
+def count_words(text: str) -> int:
+    """
+    Counts words as tokens.
+    """
+    return len(text.split())
+
+
+def make_pages(*texts: str) -> list[Document]:
+    """
+    Makes the pages of a manual.
+    """
+    return [Document(page_content=text,
+                     metadata={'source': 'old', 'page': number})
+            for number, text in enumerate(texts, 1)]
+
+
+def make_index(chunks: list[Document]) -> MagicMock:
+    """
+    Makes a search client for an index of the chunks, whose vectors
+    are their page and position.
+    """
+    documents = {
+        search_key(chunk.metadata['chunk_id']): {
+            'id': search_key(chunk.metadata['chunk_id']),
+            'content': chunk.page_content,
+            'content_vector': [float(chunk.metadata['page']),
+                               float(chunk.metadata['chunk'])],
+            'metadata': json.dumps(chunk.metadata)}
+        for chunk in chunks}
+
+    def search(search_text, filter, select, top):
+        # pylint: disable=unused-argument,redefined-builtin
+        keys = re.search(r"'([^']*)'", filter).group(1).split(',')
+        return [documents[key] for key in keys if key in documents]
+
+    index = MagicMock()
+    index.search.side_effect = search
+    return index
+
+
+class TestIngestionCache(BaseTestCase):
+    """
+    Tests the ingestion cache
+    """
+    def setUp(self):
+        self.embeddings = MagicMock()
+        self.pages: dict[str, IngestedPageModel] = {}
+        self.index = MagicMock()
+        self.cache = IngestionCache(self.pages.get,
+                                    lambda index: self.index,
+                                    self.embeddings)
+
+    def ingest(self, chunker, pages):
+        """
+        Ingests pages into the 'old' index, and records them.
+        """
+        chunks = []
+        for page in pages:
+            page_hash = hash_page(page, chunker)
+            page_chunks = list(chunker.split([page]))
+            self.pages[page_hash] = IngestedPageModel(
+                page_hash=page_hash, search_index='old', source='old',
+                page=page.metadata['page'], chunks=len(page_chunks))
+            chunks += page_chunks
+        self.index = make_index(chunks)
+
+    def test_hash_file(self):
+        """
+        Hashes the whole file
+        """
+        self.assertEqual(hash_file(BytesIO(b'%PDF' * 10**6)),
+                         hashlib.sha256(b'%PDF' * 10**6).hexdigest())
+
+    def test_hash_page_heading_state(self):
+        """
+        Hashes the headings a page falls under with the page
+        """
+        chunker = HeadingChunker(100, 0, count_words)
+        page = make_pages('Some text.')[0]
+        before = hash_page(page, chunker)
+
+        list(chunker.split(make_pages('## Safety')))
+
+        self.assertNotEqual(hash_page(page, chunker), before)
+
+    def test_chunk_reuses_unchanged_pages(self):
+        """
+        Hands the vectors of unchanged pages to the embeddings, and
+        records every page
+        """
+        self.ingest(TokenChunker(3, 0, count_words),
+                    make_pages('a b c d', 'e f', 'g h'))
+
+        chunks = list(self.cache.chunk(make_pages('a b c d', 'x y', 'g h'),
+                                       TokenChunker(3, 0, count_words)))
+
+        self.assertEqual([chunk.page_content for chunk in chunks],
+                         ['a b c', 'd', 'x y', 'g h'])
+        self.assertEqual([call.args for call in
+                          self.embeddings.reuse.call_args_list],
+                         [('a b c', [1.0, 0.0]), ('d', [1.0, 1.0]),
+                          ('g h', [3.0, 0.0])])
+        self.assertEqual(self.cache.reused_pages, 2)
+        self.assertEqual([(number, count) for _, number, count in
+                          self.cache.pages], [(1, 2), (2, 1), (3, 1)])
+
+    def test_chunk_missing_chunks(self):
+        """
+        Embeds pages whose chunks are no longer in their index
+        """
+        self.ingest(TokenChunker(3, 0, count_words), make_pages('a b'))
+        self.index.search.side_effect = HttpResponseError('gone')
+
+        chunks = list(self.cache.chunk(make_pages('a b'),
+                                       TokenChunker(3, 0, count_words)))
+
+        self.assertEqual(len(chunks), 1)
+        self.embeddings.reuse.assert_not_called()
+        self.assertEqual(self.cache.reused_pages, 0)
+
+    def test_clone(self):
+        """
+        Clones the chunks of every page for the new source
+        """
+        chunker = TokenChunker(3, 0, count_words)
+        pages = make_pages('a b c d', 'e f')
+        self.ingest(chunker, pages)
+        file = IngestedFileModel(page_hashes=json.dumps(
+            [hash_page(page, chunker) for page in pages]))
+
+        chunks = list(self.cache.clone(file, 'new'))
+
+        self.assertEqual([chunk.page_content for chunk in chunks],
+                         ['a b c', 'd', 'e f'])
+        self.assertEqual(
+            [(chunk.metadata['source'], chunk.metadata['page'],
+              chunk.metadata['chunk']) for chunk in chunks],
+            [('new', 1, 0), ('new', 1, 1), ('new', 2, 0)])
+        self.assertNotEqual(chunks[0].metadata['chunk_id'],
+                            list(chunker.split(pages))[0].metadata['chunk_id'])
+        self.assertEqual(self.embeddings.reuse.call_count, 3)
+        self.assertEqual(self.cache.reused_pages, 2)
+
+    def test_clone_missing_page(self):
+        """
+        Raises LookupError if a page was never recorded
+        """
+        file = IngestedFileModel(file_hash='hash',
+                                 page_hashes=json.dumps(['unknown']))
+
+        with self.assertRaises(LookupError):
+            list(self.cache.clone(file, 'new'))
+
+    def test_clone_after_promotion(self):
+        """
+        Clones a file from the production index its validation index
+        was promoted to
+        """
+        chunker = TokenChunker(3, 0, count_words)
+        pages = make_pages('a b c d', 'e f')
+        self.ingest(chunker, pages)
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        with Session(engine) as session:
+            IngestionCacheDAO.save_file(
+                session, 'hash', 's', 'old', 'old',
+                [(hash_page(page, chunker), page.metadata['page'],
+                  self.pages[hash_page(page, chunker)].chunks)
+                 for page in pages])
+            IngestionCacheDAO.move_index(session, 'old', 'production')
+            indexes = {'production': self.index}
+            cache = IngestionCache(
+                lambda page_hash: IngestionCacheDAO.get_page(
+                    session, page_hash, 's'),
+                indexes.__getitem__, self.embeddings)
+
+            chunks = list(cache.clone(
+                IngestionCacheDAO.get_file(session, 'hash', 's'), 'new'))
+
+            self.assertEqual([chunk.page_content for chunk in chunks],
+                             ['a b c', 'd', 'e f'])
+            self.assertEqual(cache.reused_pages, 2)
@@ -0,0 +1,44 @@
+"""
+Tests the job queues
+"""
+
+import json
+from unittest.mock import MagicMock, patch
+
+from core.utils.job_queue import InMemoryJobQueue, StorageJobQueue
+
+from base_test_case import BaseTestCase
+
+
+class TestJobQueue(BaseTestCase):
+    """
+    Tests the job queues
+    """
+    def test_in_memory_job_queue(self):
+        """Processes jobs in order, and carries on after a failure"""
+        processed = []
+
+        def handler(job):
+            if job['fail']:
+                raise RuntimeError('failed')
+            processed.append(job['id'])
+
+        queue = InMemoryJobQueue(handler)
+        for i in range(3):
+            queue.send({'id': i, 'fail': i == 1})
+        queue.join()
+
+        self.assertEqual(processed, [0, 2])
+
+    @patch('core.utils.job_queue.QueueClient')
+    def test_storage_job_queue(self, qc_mock):
+        """Sends jobs as JSON"""
+        client = MagicMock()
+        qc_mock.from_connection_string.return_value = client
+
+        StorageJobQueue('connection', 'jobs').send({'id': 1})
+
+        self.assertEqual(
+            qc_mock.from_connection_string.call_args.args,
+            ('connection', 'jobs'))
+        client.send_message.assert_called_once_with(json.dumps({'id': 1}))
@@ -2,10 +2,12 @@
 Tests the proof of concept function
 """
 
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 
 from azure.core.exceptions import ResourceNotFoundError
-from core.utils.search_utils import is_index_ready, does_index_exist
+from core.utils.search_utils import (NEGATIVE_TTL_SECONDS,
+                                     IndexExistenceCache, does_index_exist,
+                                     invalidate_index_cache, is_index_ready)
 
 from base_test_case import BaseTestCase
 
@@ -60,3 +62,53 @@ class TestSearchUtils(BaseTestCase):
         index_client = MagicMock()
         index_client.get_index.side_effect = ResourceNotFoundError
         self.assertFalse(does_index_exist('test', index_client))
+
+
+class TestIndexExistenceCache(BaseTestCase):
+    """
+    Tests the index existence cache used by does_index_exist
+    """
+    def setUp(self):
+        IndexExistenceCache().clear()
+
+    def test_does_index_exist_is_cached(self):
+        """
+        Repeated checks only hit the index client once
+        """
+        index_client = MagicMock()
+        self.assertTrue(does_index_exist('test', index_client))
+        self.assertTrue(does_index_exist('test', index_client))
+        index_client.get_index.assert_called_once()
+        self.assertEqual(IndexExistenceCache().hits, 1)
+        self.assertEqual(IndexExistenceCache().misses, 1)
+
+    def test_negative_ttl_expires(self):
+        """
+        Missing indexes are rechecked once the negative TTL expires
+        """
+        index_client = MagicMock()
+        index_client.get_index.side_effect = ResourceNotFoundError
+        with patch('core.utils.search_utils.time.monotonic',
+                   return_value=0):
+            self.assertFalse(does_index_exist('test', index_client))
+            self.assertFalse(does_index_exist('test', index_client))
+        index_client.get_index.assert_called_once()
+
+        index_client.get_index.side_effect = None
+        with patch('core.utils.search_utils.time.monotonic',
+                   return_value=NEGATIVE_TTL_SECONDS):
+            self.assertTrue(does_index_exist('test', index_client))
+        self.assertEqual(index_client.get_index.call_count, 2)
+
+    def test_invalidate_index_cache(self):
+        """
+        Invalidated indexes are rechecked
+        """
+        index_client = MagicMock()
+        index_client.get_index.side_effect = ResourceNotFoundError
+        self.assertFalse(does_index_exist('test', index_client))
+
+        index_client.get_index.side_effect = None
+        invalidate_index_cache('test')
+        self.assertTrue(does_index_exist('test', index_client))
+        self.assertEqual(index_client.get_index.call_count, 2)
@@ -0,0 +1,214 @@
+"""
+Tests the conversation summarization strategies
+"""
+
+import threading
+import time
+from unittest.mock import MagicMock, patch
+
+from core.utils import summarization
+from core.utils.summarization import (MAP_PROMPT, MERGE_PROMPT,
+                                      SUMMARIZATION_PROMPT,
+                                      SUMMARY_TOKEN_RESERVE, SummaryUsage,
+                                      pack_messages,
+                                      split_conversation,
+                                      summarize_map_reduce, summarize_refine)
+
+from base_test_case import BaseTestCase
+
+
+def count_words(text: str) -> int:
+    """
+    Counts words as tokens.
+    """
+    return len(text.split())
+
+
+def make_client(delay: float = 0) -> MagicMock:
+    """
+    Makes an OpenAI client that summarizes by labelling its input.
+    """
+    def create(model, messages):  # pylint: disable=unused-argument
+        time.sleep(delay)
+        prompt, content = messages[0]['content'], messages[-1]['content']
+        if prompt == MAP_PROMPT:
+            summary = f'map({content})'
+        elif prompt == MERGE_PROMPT:
+            summary = f"merge({'+'.join(content.split(chr(10) * 2))})"
+        else:
+            summary = f"{messages[1]['content']}>{content}"
+        response = MagicMock()
+        response.choices[0].message.content = summary
+        response.usage.prompt_tokens = len(content)
+        response.usage.completion_tokens = len(summary)
+        return response
+
+    client = MagicMock()
+    client.chat.completions.create.side_effect = create
+    return client
+
+
+class TestSummarization(BaseTestCase):
+    """
+    Tests the summarization strategies
+    """
+    def test_refine(self):
+        """
+        Refines the summary with every chunk, in order
+        """
+        client = make_client()
+
+        summary = summarize_refine(['a', 'b', 'c'], client, 'model')
+
+        self.assertEqual(summary, '>a>b>c')
+        self.assertEqual(client.chat.completions.create.call_count, 3)
+        messages = client.chat.completions.create.call_args.kwargs[
+            'messages']
+        self.assertEqual(messages[0]['content'], SUMMARIZATION_PROMPT)
+
+    def test_map_reduce(self):
+        """
+        Summarizes every chunk, then merges the summaries in order, four
+        at a time
+        """
+        client = make_client()
+        chunks = [str(i) for i in range(6)]
+
+        summary = summarize_map_reduce(chunks, client, 'model')
+
+        self.assertEqual(
+            summary,
+            'merge(merge(map(0)+map(1)+map(2)+map(3))'
+            '+merge(map(4)+map(5)))')
+        # 6 chunks, 2 merges, then 1 final merge
+        self.assertEqual(client.chat.completions.create.call_count, 9)
+
+    def test_refine_previous(self):
+        """
+        Carries on from the previous summary
+        """
+        client = make_client()
+
+        self.assertEqual(
+            summarize_refine(['c'], client, 'model', 'before'), 'before>c')
+
+    def test_map_reduce_previous(self):
+        """
+        Merges the previous summary first, or returns it if there are
+        no chunks
+        """
+        client = make_client()
+
+        self.assertEqual(
+            summarize_map_reduce(['a', 'b'], client, 'model',
+                                 previous='before'),
+            'merge(before+map(a)+map(b))')
+        client.chat.completions.create.reset_mock()
+        self.assertEqual(
+            summarize_map_reduce([], client, 'model', previous='before'),
+            'before')
+        client.chat.completions.create.assert_not_called()
+
+    def test_map_reduce_single_chunk(self):
+        """
+        Does not merge a single summary
+        """
+        client = make_client()
+
+        self.assertEqual(summarize_map_reduce(['a'], client, 'model'),
+                         'map(a)')
+        self.assertEqual(client.chat.completions.create.call_count, 1)
+
+    def test_map_reduce_leftover_is_not_merged_alone(self):
+        """
+        Carries a lone partial summary to the next level unchanged
+        """
+        client = make_client()
+        chunks = [str(i) for i in range(5)]
+
+        summary = summarize_map_reduce(chunks, client, 'model')
+
+        self.assertEqual(
+            summary, 'merge(merge(map(0)+map(1)+map(2)+map(3))+map(4))')
+        self.assertEqual(client.chat.completions.create.call_count, 7)
+
+    def test_map_reduce_empty(self):
+        """
+        Summarizes an empty conversation without calling the model
+        """
+        client = make_client()
+
+        self.assertEqual(summarize_map_reduce([], client, 'model'), '')
+        client.chat.completions.create.assert_not_called()
+
+    def test_map_reduce_bounds_workers(self):
+        """
+        Never makes more concurrent calls than there are workers
+        """
+        client = make_client(0.01)
+        active, peak = 0, 0
+        lock = threading.Lock()
+        create = client.chat.completions.create.side_effect
+
+        def counting_create(**kwargs):
+            nonlocal active, peak
+            with lock:
+                active += 1
+                peak = max(peak, active)
+            try:
+                return create(**kwargs)
+            finally:
+                with lock:
+                    active -= 1
+
+        client.chat.completions.create.side_effect = counting_create
+
+        summarize_map_reduce([str(i) for i in range(12)], client, 'model',
+                             workers=3)
+
+        self.assertEqual(peak, 3)
+
+    def test_usage(self):
+        """
+        Tallies the calls and tokens reported by the model
+        """
+        client = make_client()
+        usage = SummaryUsage()
+
+        summarize_map_reduce(['ab', 'c'], client, 'model', usage=usage)
+        summarize_refine(['d'], client, 'model', usage=usage)
+
+        # map(ab), map(c), merge(map(ab)+map(c)), >d
+        self.assertEqual(usage.calls, 4)
+        self.assertEqual(usage.prompt_tokens, 2 + 1 + 15 + 1)
+        self.assertEqual(usage.completion_tokens, 7 + 6 + 21 + 2)
+        self.assertEqual(usage.total_tokens, 55)
+
+    def test_pack_messages(self):
+        """
+        Packs whole messages up to the budget, and splits messages over
+        the budget on their own
+        """
+        messages = ['a b', 'c d e', 'f', 'g h i j k l m', 'n o']
+
+        self.assertEqual(pack_messages(messages, 5, count_words),
+                         ['a b\nc d e', 'f', 'g h i j k', 'l m', 'n o'])
+        self.assertEqual(pack_messages(messages, 100, count_words),
+                         ['\n'.join(messages)])
+        self.assertEqual(pack_messages([], 5, count_words), [])
+
+    def test_split_conversation(self):
+        """
+        Leaves room for the prompt and the summary thus far
+        """
+        prompt_tokens = max(count_words(prompt) for prompt in (
+            SUMMARIZATION_PROMPT, MAP_PROMPT, MERGE_PROMPT))
+        budget = prompt_tokens + SUMMARY_TOKEN_RESERVE + 3
+
+        with patch.object(summarization, 'get_token_counter',
+                          return_value=count_words):
+            self.assertEqual(
+                split_conversation(['a b', 'c d', 'e'], 'model', budget),
+                ['a b', 'c d\ne'])
+            with self.assertRaises(ValueError):
+                split_conversation(['a'], 'model', budget - 3)
@@ -0,0 +1,83 @@
+"""
+Tests the summarization status API
+"""
+
+import json
+from datetime import datetime
+from unittest.mock import patch
+
+import azure.functions as func
+from core.functions.summarization_status import main
+from core.models.summarization_job import (SummarizationJobModel,
+                                           SummarizationJobStatus)
+
+from base_test_case import BaseTestCase
+
+
+class TestSummarizationStatus(BaseTestCase):
+    """
+    Tests the summarization status API
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.secrets_and_services_mock(
+            'core.functions.summarization_status', no_secret=True)
+
+    @staticmethod
+    def make_request(params: dict) -> func.HttpRequest:
+        """Makes a request to the endpoint"""
+        return func.HttpRequest(method='GET',
+                                url='/api/summarization_status',
+                                params=params, body=b'',
+                                headers={'Auth-Token': '123'})
+
+    @patch('core.functions.summarization_status.SummarizationJobDAO')
+    @patch('core.functions.summarization_status.authorise_user',
+           return_value=True)
+    @patch('core.functions.summarization_status.get_user_id',
+           return_value='123')
+    def test_main(self, _gui_mock, _authorise_mock, sjdao_mock):
+        """Gets the status of the job"""
+        sjdao_mock.get_job.return_value = SummarizationJobModel(
+            conversation_id='456', idempotency_key='456:789',
+            status=SummarizationJobStatus.COMPLETED,
+            updated_at=datetime(2024, 1, 1))
+
+        response = main(self.make_request({'conversation_id': '456'}))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.get_body()), {
+            'conversationId': '456', 'status': 'completed',
+            'updatedAt': '2024-01-01T00:00:00'})
+
+    @patch('core.functions.summarization_status.SummarizationJobDAO')
+    @patch('core.functions.summarization_status.authorise_user',
+           return_value=True)
+    @patch('core.functions.summarization_status.get_user_id',
+           return_value='123')
+    def test_main_no_job(self, _gui_mock, _authorise_mock, sjdao_mock):
+        """The conversation has never been summarized"""
+        sjdao_mock.get_job.return_value = None
+
+        response = main(self.make_request({'conversation_id': '456'}))
+
+        self.assertEqual(response.status_code, 404)
+
+    @patch('core.functions.summarization_status.SummarizationJobDAO')
+    @patch('core.functions.summarization_status.authorise_user',
+           return_value=False)
+    @patch('core.functions.summarization_status.get_user_id',
+           return_value='123')
+    def test_main_unauthorised(self, _gui_mock, _authorise_mock,
+                               sjdao_mock):
+        """Only the owner of the conversation can poll it"""
+        response = main(self.make_request({'conversation_id': '456'}))
+
+        self.assertEqual(response.status_code, 401)
+        sjdao_mock.get_job.assert_not_called()
+
+    def test_main_no_conversation_id(self):
+        """The conversation ID is required"""
+        response = main(self.make_request({}))
+
+        self.assertEqual(response.status_code, 400)
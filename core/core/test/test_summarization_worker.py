@@ -0,0 +1,72 @@
+"""
+Tests the summarization worker
+"""
+
+import json
+from unittest.mock import patch
+
+import azure.functions as func
+from core.functions.summarization_worker import main, process_job
+
+from base_test_case import BaseTestCase
+
+JOB = {'user_id': '123', 'conversation_id': '456',
+       'idempotency_key': '456:789'}
+
+
+class TestSummarizationWorker(BaseTestCase):
+    """
+    Tests the summarization worker
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.secrets_and_services_mock('core.functions.summarization_worker',
+                                      no_secret=True)
+
+    @patch('core.functions.summarization_worker.summarize_and_store')
+    @patch('core.functions.summarization_worker.SummarizationJobDAO')
+    def test_process_job(self, sjdao_mock, sas_mock):
+        """Summarizes the conversation, and completes the job"""
+        sjdao_mock.start_job.return_value = True
+
+        process_job(JOB)
+
+        session = self.services_mock.return_value.db_session
+        sjdao_mock.start_job.assert_called_once_with(session, '456',
+                                                     '456:789')
+        sas_mock.assert_called_once_with('123', '456')
+        sjdao_mock.finish_job.assert_called_once_with(session, '456',
+                                                      '456:789')
+
+    @patch('core.functions.summarization_worker.summarize_and_store')
+    @patch('core.functions.summarization_worker.SummarizationJobDAO')
+    def test_process_job_skipped(self, sjdao_mock, sas_mock):
+        """Skips completed or superseded jobs"""
+        sjdao_mock.start_job.return_value = False
+
+        process_job(JOB)
+
+        sas_mock.assert_not_called()
+        sjdao_mock.finish_job.assert_not_called()
+
+    @patch('core.functions.summarization_worker.summarize_and_store',
+           side_effect=RuntimeError('search down'))
+    @patch('core.functions.summarization_worker.SummarizationJobDAO')
+    def test_process_job_failed(self, sjdao_mock, _sas_mock):
+        """Fails the job, and re-raises so the queue retries"""
+        sjdao_mock.start_job.return_value = True
+
+        with self.assertRaises(RuntimeError):
+            process_job(JOB)
+
+        self.services_mock.return_value.db_session.rollback \
+            .assert_called_once()
+        sjdao_mock.finish_job.assert_called_once()
+        self.assertIn('search down', sjdao_mock.finish_job.call_args.args[3])
+
+    @patch('core.functions.summarization_worker.process_job')
+    def test_main(self, pj_mock):
+        """Parses the job from the queue message"""
+        main(func.QueueMessage(body=json.dumps(JOB)))
+
+        pj_mock.assert_called_once_with(JOB)
@@ -0,0 +1,32 @@
+"""
+Tests counting tokens
+"""
+
+from unittest.mock import patch
+
+from core.utils.tokens import get_token_counter
+
+from base_test_case import BaseTestCase
+
+
+class TestTokens(BaseTestCase):
+    """
+    Tests counting tokens
+    """
+    @patch('core.utils.tokens.tiktoken')
+    def test_get_token_counter(self, tiktoken_mock):
+        """
+        Falls back to the default encoding for unknown models, and to
+        estimates if the encoding cannot be downloaded
+        """
+        get_token_counter.cache_clear()
+        self.addCleanup(get_token_counter.cache_clear)
+        tiktoken_mock.encoding_for_model.side_effect = KeyError('model')
+        tiktoken_mock.get_encoding.return_value.encode.side_effect = \
+            lambda text, disallowed_special: text.split()
+
+        self.assertEqual(get_token_counter('deployment')('a b c'), 3)
+        tiktoken_mock.get_encoding.assert_called_once_with('cl100k_base')
+
+        tiktoken_mock.get_encoding.side_effect = OSError('offline')
+        self.assertEqual(get_token_counter('offline')('abcdefghi'), 3)
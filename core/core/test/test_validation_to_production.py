@@ -2,6 +2,8 @@
 Module for testing the validation_to_production endpoint.
 """
 
+from unittest.mock import patch
+
 from azure.core.exceptions import HttpResponseError
 from azure.functions import HttpRequest
 from core.functions.validation_to_production import main  # noqa: E402
@@ -30,7 +32,8 @@ class TestValidationToProduction(BaseTestCase):
             }
         )
 
-    def test_main(self):
+    @patch('core.functions.validation_to_production.IngestionCacheDAO')
+    def test_main(self, ica_patch):
         """
         Tests that the endpoint returns a 200 when authorized and validation
         index exists
@@ -61,6 +64,8 @@ class TestValidationToProduction(BaseTestCase):
             start_copy_from_url.assert_called()
         cog_search_client.list_index_names.assert_called()
         sc_patch.return_value.upload_documents.assert_called()
+        ica_patch.move_index.assert_called_once_with(
+            self.services_mock.return_value.db_session, 'test', 'mock-index')
 
     def test_validation_index_not_found(self):
         """
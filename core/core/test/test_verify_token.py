@@ -2,10 +2,12 @@
 Tests the verify_token function in core.utils.verify_token
 """
 
+import time
 from unittest.mock import patch
 
 import jwt
-from core.utils.verify_token import verify_token
+from core.utils.get_user_id import get_user_id
+from core.utils.verify_token import TokenVerifier, verify_token
 
 from base_test_case import BaseTestCase
 
@@ -33,6 +35,7 @@ class TestVerifyToken(BaseTestCase):
             'ClerkAZPList': 'test'
         }
         self.secrets_mock.return_value.get.side_effect = lambda x: env_mocks[x]
+        TokenVerifier().clear()
 
     @patch('jwt.decode', return_value={'azp': 'test'})
     @patch('jwt.get_unverified_header', return_value={'alg': 'HS256'})
@@ -43,7 +46,8 @@ class TestVerifyToken(BaseTestCase):
         """
         self.assertTrue(verify_token(self.token))
         jwt_guh_patch.assert_called_once_with(self.token)
-        jwt_decode_patch.assert_called_once_with(self.token, key=self.key,
+        jwt_decode_patch.assert_called_once_with(self.token,
+                                                 key=self.key.encode(),
                                                  algorithms='HS256')
 
     @patch('jwt.decode', return_value={'azp': 'not_test'})
@@ -55,7 +59,7 @@ class TestVerifyToken(BaseTestCase):
         """
         self.assertEqual(verify_token(self.token), False)
         jwt_guh_patch.assert_called()
-        jwt_decode_patch.assert_called_with(self.token, key=self.key,
+        jwt_decode_patch.assert_called_with(self.token, key=self.key.encode(),
                                             algorithms='HS256')
 
     @patch('jwt.decode', side_effect=Exception)
@@ -67,5 +71,45 @@ class TestVerifyToken(BaseTestCase):
         """
         self.assertEqual(verify_token(self.token), False)
         jwt_guh_patch.assert_called()
-        jwt_decode_patch.assert_called_with(self.token, key=self.key,
+        jwt_decode_patch.assert_called_with(self.token, key=self.key.encode(),
                                             algorithms='HS256')
+
+    def test_claims_are_cached(self):
+        """
+        Verifying a token then getting its user ID only decodes once
+        """
+        token = jwt.encode({'azp': 'test', 'sub': 'user',
+                            'exp': int(time.time()) + 60},
+                           self.key, algorithm='HS256')
+        with patch('jwt.decode', wraps=jwt.decode) as jwt_decode_patch:
+            self.assertTrue(verify_token(token))
+            self.assertEqual(TokenVerifier().get_user_id(token), 'user')
+            jwt_decode_patch.assert_called_once()
+        self.assertEqual(TokenVerifier().hits, 1)
+
+    def test_expired_claims_are_not_cached(self):
+        """
+        Expired tokens are rejected, even if previously cached
+        """
+        token = jwt.encode({'azp': 'test', 'sub': 'user',
+                            'exp': int(time.time()) + 60},
+                           self.key, algorithm='HS256')
+        self.assertTrue(verify_token(token))
+        with patch('core.utils.verify_token.time.time',
+                   return_value=time.time() + 120), \
+             patch('jwt.decode',
+                   side_effect=jwt.exceptions.ExpiredSignatureError):
+            self.assertFalse(verify_token(token))
+        self.assertEqual(TokenVerifier().hits, 0)
+
+    def test_get_user_id(self):
+        """
+        Tests that get_user_id returns the subject of a valid token, and
+        None otherwise
+        """
+        token = jwt.encode({'sub': 'user', 'exp': int(time.time()) + 60},
+                           self.key, algorithm='HS256')
+        with patch('core.utils.get_user_id.TokenVerifier',
+                   new=TokenVerifier):
+            self.assertEqual(get_user_id(token), 'user')
+            self.assertIsNone(get_user_id('invalid'))
@@ -9,7 +9,8 @@ from typing import Literal
 from azure.storage.blob import BlobServiceClient
 
 from dataclasses_json import DataClassJsonMixin, config
-from utils.get_preauthenticated_blob_url import get_preauthenticated_blob_url
+from utils.get_preauthenticated_blob_url import (get_blob_url_with_token,
+                                                 get_preauthenticated_blob_url)
 
 
 @dataclass
@@ -74,6 +75,18 @@ class ResponseChatMessage(DataClassJsonMixin):
     type: str = 'message'
 
 
+@dataclass
+class ResponseDeltaMessage(DataClassJsonMixin):
+    """
+    Represents an incremental chunk of a streamed response. The full
+    response, along with its citations, is always sent afterwards as a
+    ResponseChatMessage.
+    """
+    body: str
+    conversation_id: str = field(metadata=config(field_name="conversationId"))
+    type: str = 'delta'
+
+
 @dataclass
 class ResponseErrorMessage(DataClassJsonMixin):
     """
@@ -85,7 +98,9 @@ class ResponseErrorMessage(DataClassJsonMixin):
 
 def translate_citation_urls(citations: list[Citation],
                             blob_service_client: BlobServiceClient,
-                            container: str) -> list[Citation]:
+                            container: str,
+                            container_sas: Optional[str] = None
+                            ) -> list[Citation]:
     """
     Immutabily translates citation URLs to preauthenticated blob URLs
     to the filepaths of the given citations.
@@ -94,17 +109,27 @@ def translate_citation_urls(citations: list[Citation],
         citations (list[Citation]): The citations to translate
         blob_service_client (BlobServiceClient): The blob service client
         container (str): The container to use
+        container_sas (Optional[str]): A container-scoped token (see
+            get_container_sas_token). If given, it is appended to
+            every filepath, instead of signing each blob.
     """
+    container_url = blob_service_client.get_container_client(
+        container).url if container_sas is not None and citations else ''
+
+    def __preauthenticate(filepath: str) -> str:
+        if container_sas is not None:
+            return get_blob_url_with_token(container_url, filepath,
+                                           container_sas)
+        return get_preauthenticated_blob_url(blob_service_client,
+                                             container, filepath)
+
     def __transform_helper(citation: Citation):
         return Citation(
             content=citation.content,
             title=citation.title,
             url=citation.url,
-            filepath=get_preauthenticated_blob_url(
-                blob_service_client,
-                container,
-                citation.filepath
-            ) if citation.filepath is not None else '',
+            filepath=__preauthenticate(citation.filepath)
+            if citation.filepath is not None else '',
             chunk_id=citation.chunk_id
         )
 
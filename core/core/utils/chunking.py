@@ -0,0 +1,227 @@
+"""
+Chunking of the pages of uploaded documents, before they are embedded.
+
+A page of a manual can run to thousands of tokens over several
+procedures. Embedded whole, they blur together, and a retrieved page
+crowds the other documents out of the context of the model. Chunkers
+split pages into chunks of up to a number of tokens, which overlap, so
+a sentence cut at a boundary is whole in one of them:
+
+- PageChunker keeps a chunk per page, as pages were indexed before.
+- TokenChunker splits every page by tokens, at paragraph, line, then
+  word boundaries.
+- HeadingChunker also splits at the headings found by Document
+  Intelligence (see utils.ingestion.analyze_pages), and starts every
+  chunk with the headings it falls under, carried across pages.
+
+Every chunk gets a deterministic ID from its document, page and
+position, so a retried upload replaces its chunks rather than
+duplicating them.
+"""
+
+import hashlib
+import re
+from abc import ABC, abstractmethod
+from typing import Callable, Iterable, Iterator, Optional
+
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain_core.documents import Document
+from utils.embeddings import EMBEDDING_MODEL
+from utils.tokens import get_token_counter
+
+# Upper bound of tokens per chunk, and tokens shared by adjacent chunks
+CHUNK_TOKENS = 512
+CHUNK_OVERLAP_TOKENS = 64
+CHUNKING_STRATEGIES = ('page', 'tokens', 'headings')
+# The Markdown headings of analyze_pages
+HEADING_PATTERN = re.compile(r'^(#{1,6}) (.+)$', re.MULTILINE)
+
+
+def chunk_id(source: Optional[str], page: int, ordinal: int) -> str:
+    """
+    Gets the ID of a chunk, which is the same whenever the same
+    document is chunked the same way.
+
+    Args:
+        source (Optional[str]): The document (e.g. the blob name)
+        page (int): The page of the chunk
+        ordinal (int): The position of the chunk on the page, from 0
+
+    Returns:
+        str: The ID
+    """
+    return hashlib.sha256(f'{source}:{page}:{ordinal}'.encode()).hexdigest()
+
+
+class Chunker(ABC):
+    """
+    Splits the pages of a document into chunks.
+    """
+    @abstractmethod
+    def split_page(self, page: Document) -> list[Document]:
+        """
+        Splits a page into chunks.
+
+        Args:
+            page (Document): The page
+
+        Returns:
+            list[Document]: The chunks, with only their own metadata
+        """
+
+    def split(self, pages: Iterable[Document]) -> Iterator[Document]:
+        """
+        Splits pages into chunks, lazily. The metadata of a chunk are
+        those of its page, its position on the page (chunk) and its ID
+        (chunk_id).
+
+        Args:
+            pages (Iterable[Document]): The pages, in order
+
+        Returns:
+            Iterator[Document]: The chunks, in order
+        """
+        for page in pages:
+            for ordinal, chunk in enumerate(self.split_page(page)):
+                chunk.metadata = {
+                    **page.metadata,
+                    **chunk.metadata,
+                    'chunk': ordinal,
+                    'chunk_id': chunk_id(page.metadata.get('source'),
+                                         page.metadata.get('page', 0),
+                                         ordinal)}
+                yield chunk
+
+    def state(self) -> str:
+        """
+        Gets what the chunks of the next page depend on, besides the
+        page itself (see HeadingChunker).
+
+        Returns:
+            str: The state
+        """
+        return ''
+
+
+class PageChunker(Chunker):  # pylint: disable=too-few-public-methods
+    """
+    Keeps every page as a chunk.
+    """
+    def split_page(self, page: Document) -> list[Document]:
+        return [Document(page_content=page.page_content)]
+
+
+class TokenChunker(Chunker):  # pylint: disable=too-few-public-methods
+    """
+    Splits pages into chunks of up to chunk_tokens tokens.
+    """
+    def __init__(self, chunk_tokens: int = CHUNK_TOKENS,
+                 overlap_tokens: int = CHUNK_OVERLAP_TOKENS,
+                 count_tokens: Optional[Callable[[str], int]] = None
+                 ) -> None:
+        self.chunk_tokens = chunk_tokens
+        self.overlap_tokens = overlap_tokens
+        self.count_tokens = count_tokens \
+            or get_token_counter(EMBEDDING_MODEL)
+
+    def split_text(self, text: str, budget: int) -> list[str]:
+        """
+        Splits text into chunks of up to budget tokens.
+
+        Args:
+            text (str): The text
+            budget (int): Upper bound of tokens per chunk
+
+        Returns:
+            list[str]: The chunks
+        """
+        return RecursiveCharacterTextSplitter(
+            chunk_size=budget,
+            chunk_overlap=min(self.overlap_tokens, budget // 2),
+            length_function=self.count_tokens).split_text(text)
+
+    def split_page(self, page: Document) -> list[Document]:
+        return [Document(page_content=text) for text in
+                self.split_text(page.page_content, self.chunk_tokens)]
+
+
+class HeadingChunker(TokenChunker):
+    """
+    Splits pages at their headings, then into chunks of up to
+    chunk_tokens tokens, each starting with the headings it falls
+    under. The headings carry over to the next pages, so use a
+    HeadingChunker per document.
+    """
+    def __init__(self, chunk_tokens: int = CHUNK_TOKENS,
+                 overlap_tokens: int = CHUNK_OVERLAP_TOKENS,
+                 count_tokens: Optional[Callable[[str], int]] = None
+                 ) -> None:
+        super().__init__(chunk_tokens, overlap_tokens, count_tokens)
+        # (level, heading) of the current section and its parents
+        self.headings: list[tuple[int, str]] = []
+
+    def __sections(self, text: str) -> Iterator[tuple[str, str, str]]:
+        """
+        Splits text at its headings.
+
+        Returns:
+            Iterator[tuple[str, str, str]]: The headings (in Markdown,
+                and as a path) and the body of every section
+        """
+        start = 0
+        for match in HEADING_PATTERN.finditer(text):
+            yield (*self.__context(), text[start:match.start()])
+            level = len(match.group(1))
+            while self.headings and self.headings[-1][0] >= level:
+                self.headings.pop()
+            self.headings.append((level, match.group(2).strip()))
+            start = match.end()
+        yield (*self.__context(), text[start:])
+
+    def __context(self) -> tuple[str, str]:
+        return ('\n'.join(f"{'#' * level} {heading}"
+                          for level, heading in self.headings),
+                ' > '.join(heading for _, heading in self.headings))
+
+    def state(self) -> str:
+        return self.__context()[0]
+
+    def split_page(self, page: Document) -> list[Document]:
+        chunks: list[Document] = []
+        for context, path, body in self.__sections(page.page_content):
+            if not body.strip():
+                continue
+            # Long headings leave at least half of the chunk to the body
+            budget = max(self.chunk_tokens - self.count_tokens(context),
+                         self.chunk_tokens // 2)
+            chunks.extend(
+                Document(page_content=f'{context}\n\n{text}'
+                         if context else text,
+                         metadata={'headings': path})
+                for text in self.split_text(body.strip(), budget))
+        return chunks
+
+
+def make_chunker(strategy: str, chunk_tokens: int = CHUNK_TOKENS,
+                 overlap_tokens: int = CHUNK_OVERLAP_TOKENS,
+                 count_tokens: Optional[Callable[[str], int]] = None
+                 ) -> Chunker:
+    """
+    Makes a chunker for a document.
+
+    Args:
+        strategy (str): page, tokens, or headings (the default)
+        chunk_tokens (int): Upper bound of tokens per chunk
+        overlap_tokens (int): Tokens shared by adjacent chunks
+        count_tokens (Optional[Callable[[str], int]]): Counts the
+            tokens of a text; the tokenizer of the embedding model by
+            default
+
+    Returns:
+        Chunker: The chunker
+    """
+    if strategy == 'page':
+        return PageChunker()
+    if strategy == 'tokens':
+        return TokenChunker(chunk_tokens, overlap_tokens, count_tokens)
+    return HeadingChunker(chunk_tokens, overlap_tokens, count_tokens)
@@ -3,21 +3,184 @@ Common database methods, including the estabishment of the DB session.
 
 This is written in the context of functional apps, so the assumption
 is that the caller will only need the session.
+
+The Functions host may run several invocations concurrently on one
+worker. Hence, the engine owns a connection pool, and every thread
+gets its own session through a scoped session. Remove the session of
+the thread once each invocation is done (see Services.db_session_scope).
+
+Creating the schema issues catalog queries for every table. To keep
+them off the cold start, the applied schema version is stored in the
+database, and DDL only runs when it differs from SCHEMA_VERSION. The
+schema can also be migrated at deploy time with `python migrate.py`.
+
+Every worker cold starts at once after a deployment, so migrations
+hold an application lock (on MSSQL), and are skipped by the workers
+that find the schema migrated once they get it.
 """
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, Session
+import logging
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+from sqlalchemy import Engine, create_engine, func, inspect, select, text
+from sqlalchemy.exc import DBAPIError, IntegrityError
+from sqlalchemy.orm import Session, scoped_session, sessionmaker
+from sqlalchemy.pool import QueuePool
 from models.common import Base
+from models.schema_version import (SCHEMA_UPGRADES, SCHEMA_VERSION,
+                                   SchemaVersionModel)
 
+# The application lock held while migrating, and how long to wait for it
+MIGRATION_LOCK = 'schema_migration'
+MIGRATION_LOCK_TIMEOUT_MS = 120000
 
-def create_session(
+
+def get_schema_version(engine: Engine) -> Optional[int]:
+    """
+    Gets the schema version applied to the database.
+
+    Args:
+        engine (Engine): The database engine
+
+    Returns:
+        Optional[int]: The schema version, or None if the schema has
+            never been migrated
+    """
+    try:
+        with engine.connect() as connection:
+            return connection.scalar(
+                select(func.max(  # pylint: disable=not-callable
+                    SchemaVersionModel.version)))
+    except DBAPIError:
+        # The schema version table does not exist yet
+        return None
+
+
+@contextmanager
+def __migration_lock(engine: Engine) -> Iterator[None]:
+    """
+    Holds the migration lock of the database, waiting up to
+    MIGRATION_LOCK_TIMEOUT_MS for it, so only one worker migrates at a
+    time. Only MSSQL has application locks; other databases are not
+    locked.
+    """
+    if engine.dialect.name != 'mssql':
+        yield
+        return
+
+    with engine.connect() as connection:
+        # The lock is owned by the connection, not a transaction, as
+        # the migration runs on other connections
+        result = connection.scalar(
+            text("SET NOCOUNT ON; DECLARE @result INT;"
+                 " EXEC @result = sp_getapplock @Resource = :resource,"
+                 " @LockMode = 'Exclusive', @LockOwner = 'Session',"
+                 " @LockTimeout = :timeout; SELECT @result"),
+            {'resource': MIGRATION_LOCK, 'timeout': MIGRATION_LOCK_TIMEOUT_MS})
+        if result is None or result < 0:
+            raise RuntimeError(
+                f'Cannot get the migration lock (sp_getapplock {result})')
+        try:
+            yield
+        finally:
+            connection.execute(
+                text("EXEC sp_releaseapplock @Resource = :resource,"
+                     " @LockOwner = 'Session'"),
+                {'resource': MIGRATION_LOCK})
+
+
+def migrate_schema(engine: Engine, *, outdated_only: bool = False) -> None:
+    """
+    Upgrades existing tables, creates all missing tables and indexes,
+    then records SCHEMA_VERSION as applied. Holds the migration lock
+    throughout.
+
+    Args:
+        engine (Engine): The database engine
+
+    Keyword Args:
+        outdated_only (bool): Skip the migration if the schema version
+            is SCHEMA_VERSION once the lock is held, i.e. another
+            worker has migrated it
+    """
+    with __migration_lock(engine):
+        version = get_schema_version(engine)
+        if outdated_only and version == SCHEMA_VERSION:
+            logging.info('Schema was migrated to version %d meanwhile',
+                         SCHEMA_VERSION)
+            return
+        __migrate(engine, version)
+
+
+def __migrate(engine: Engine, version: Optional[int]) -> None:
+    """
+    Migrates the schema from the version (see migrate_schema).
+    """
+    logging.info('Migrating schema to version %d', SCHEMA_VERSION)
+    if version is None and any(inspect(engine).has_table(table)
+                               for table in Base.metadata.tables):
+        # Databases created before schema versions were recorded
+        version = 0
+
+    if version is not None:
+        with engine.begin() as connection:
+            for upgrade_version, statements in sorted(
+                    SCHEMA_UPGRADES.items()):
+                if version < upgrade_version:
+                    logging.info('Upgrading schema to version %d',
+                                 upgrade_version)
+                    for statement in statements:
+                        connection.execute(text(statement))
+
+    Base.metadata.create_all(engine)
+    # create_all only creates the indexes of new tables
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+
+    with Session(engine) as session:
+        session.add(SchemaVersionModel(version=SCHEMA_VERSION))
+        try:
+            session.commit()
+        except IntegrityError:
+            # Already recorded (e.g. by migrate.py, or without a lock)
+            session.rollback()
+
+
+def ensure_schema(engine: Engine) -> None:
+    """
+    Migrates the schema, only if the applied schema version differs
+    from SCHEMA_VERSION.
+
+    Args:
+        engine (Engine): The database engine
+    """
+    start = time.perf_counter()
+    version = get_schema_version(engine)
+    if version != SCHEMA_VERSION:
+        logging.info('Schema version is %s, expected %d', version,
+                     SCHEMA_VERSION)
+        migrate_schema(engine, outdated_only=True)
+    logging.info('Schema check took %.1f ms',
+                 (time.perf_counter() - start) * 1000)
+
+
+# pylint: disable=too-many-arguments
+def create_db_engine(
         server_url: str,
         database_name: str,
         username: str,
         password: str,
-        self_signed: bool) -> Session:  # pragma: no cover
+        self_signed: bool,
+        *,
+        pool_size: int = 5,
+        max_overflow: int = 10,
+        pool_recycle: int = 1800,
+        pool_pre_ping: bool = True) -> Engine:  # pragma: no cover
     """
-    Creates a database session.
+    Creates a database engine backed by a connection pool.
 
     Args:
         server_url (str): The server URL
@@ -26,15 +189,63 @@ def create_session(
         password (str): The password
         self_signed (bool): Indiciates if the cetificate is self-signed
 
+    Keyword Args:
+        pool_size (int): Connections kept open in the pool
+        max_overflow (int): Connections allowed beyond the pool size
+        pool_recycle (int): Seconds before a connection is replaced
+        pool_pre_ping (bool): Whether to test connections before use
+
     Returns:
-        Session: The database session
+        Engine: The database engine
     """
-    # This instantiates the session, and cannot be unit tested.
+    # This instantiates the engine, and cannot be unit tested.
     engine = create_engine(
         f"mssql+pyodbc://{username}:{password}@{server_url}/{database_name}"
         f"?driver=ODBC+Driver+17+for+SQL+Server"
         f"&Encrypt=yes"
-        f"&TrustServerCertificate={'yes' if self_signed else 'no'}"
+        f"&TrustServerCertificate={'yes' if self_signed else 'no'}",
+        poolclass=QueuePool,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_recycle=pool_recycle,
+        pool_pre_ping=pool_pre_ping
     )
-    Base.metadata.create_all(engine)
-    return sessionmaker(bind=engine)()
+    ensure_schema(engine)
+    return engine
+
+
+def create_session(
+        server_url: str,
+        database_name: str,
+        username: str,
+        password: str,
+        self_signed: bool) -> Session:  # pragma: no cover
+    """
+    Creates a database session.
+
+    Args:
+        server_url (str): The server URL
+        database_name (str): The database name
+        username (str): The username
+        password (str): The password
+        self_signed (bool): Indiciates if the cetificate is self-signed
+
+    Returns:
+        Session: The database session
+    """
+    return sessionmaker(bind=create_db_engine(
+        server_url, database_name, username, password, self_signed))()
+
+
+def create_scoped_session(engine: Engine) -> scoped_session[Session]:
+    """
+    Creates a thread-local session registry. Calling the registry (or
+    any Session method on it) uses the session of the current thread.
+
+    Args:
+        engine (Engine): The database engine
+
+    Returns:
+        scoped_session[Session]: The session registry
+    """
+    return scoped_session(sessionmaker(bind=engine))
@@ -0,0 +1,147 @@
+"""
+Batched embeddings for indexing documents.
+
+Embedding the chunks of a manual one by one takes a round trip per
+chunk. BatchedEmbeddings embeds them in batches through
+embed_documents, on a bounded worker pool. Throttled (429) and failed
+batches are retried with the backoff of GPT-4 Vision requests; a
+throttled batch also pauses the other workers, so they do not run
+into the same rate limit. Vectors known already (e.g. of chunks cloned
+from another index) can be handed over with reuse, to skip embedding
+their texts.
+"""
+
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from typing import Optional
+
+import httpx
+import openai
+from langchain_core.embeddings import Embeddings
+from utils.image_summary import MAX_RETRIES, retry_delay
+from utils.tokens import get_token_counter
+
+# Texts per embed_documents call
+EMBEDDING_BATCH_SIZE = 16
+# Concurrent embed_documents calls
+EMBEDDING_WORKERS = 4
+EMBEDDING_MODEL = 'text-embedding-ada-002'
+# Errors worth retrying; the batch may succeed later
+RETRY_ERRORS = (openai.RateLimitError, openai.APIConnectionError,
+                openai.InternalServerError)
+
+
+# The counters are attributes, like those of the caches
+# pylint: disable=too-many-instance-attributes
+class BatchedEmbeddings(Embeddings):
+    """
+    Wraps embeddings to embed documents in concurrent batches, and
+    tallies the throughput.
+    """
+    def __init__(self, embeddings: Embeddings,
+                 batch_size: int = EMBEDDING_BATCH_SIZE,
+                 workers: int = EMBEDDING_WORKERS) -> None:
+        self.embeddings = embeddings
+        self.batch_size = max(batch_size, 1)
+        self.workers = max(workers, 1)
+        self.embedded_chunks = 0
+        self.embedded_tokens = 0
+        self.elapsed_seconds = 0.0
+        self.retries = 0
+        self.reused_chunks = 0
+        self.__resume_at = 0.0
+        self.__reusable: dict[str, list[float]] = {}
+        self.__lock = Lock()
+
+    def reuse(self, text: str, vector: list[float]) -> None:
+        """
+        Uses the vector the next time the text is embedded, instead of
+        embedding it.
+
+        Args:
+            text (str): The text
+            vector (list[float]): Its embedding
+        """
+        with self.__lock:
+            self.__reusable[text] = vector
+
+    def __throttle(self, delay: float) -> None:
+        """
+        Pauses every worker for the delay.
+        """
+        with self.__lock:
+            self.retries += 1
+            self.__resume_at = max(self.__resume_at,
+                                   time.monotonic() + delay)
+
+    def __wait_if_throttled(self) -> None:
+        with self.__lock:
+            delay = self.__resume_at - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def __embed_batch(self, batch: list[str]) -> list[list[float]]:
+        attempt = 0
+        while True:
+            self.__wait_if_throttled()
+            try:
+                return self.embeddings.embed_documents(batch)
+            except RETRY_ERRORS as e:
+                if attempt >= MAX_RETRIES:
+                    raise
+                response: Optional[httpx.Response] = getattr(
+                    e, 'response', None)
+                delay = retry_delay(attempt, response)
+                logging.warning('Embedding request failed (%s), retrying'
+                                ' in %.1f s', type(e).__name__, delay)
+                self.__throttle(delay)
+                attempt += 1
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        """
+        Embeds texts in batches, keeping their order.
+
+        Args:
+            texts (list[str]): The texts to embed
+
+        Returns:
+            list[list[float]]: The embedding of every text
+        """
+        if not texts:
+            return []
+
+        start = time.perf_counter()
+        with self.__lock:
+            reused = {i: self.__reusable.pop(text)
+                      for i, text in enumerate(texts)
+                      if text in self.__reusable}
+        pending = [text for i, text in enumerate(texts) if i not in reused]
+        batches = [pending[i:i + self.batch_size]
+                   for i in range(0, len(pending), self.batch_size)]
+        embedded: list[list[float]] = []
+        if batches:
+            with ThreadPoolExecutor(
+                    max_workers=min(self.workers, len(batches))) as executor:
+                embedded = [vector for batch in executor.map(
+                    self.__embed_batch, batches) for vector in batch]
+        elapsed = max(time.perf_counter() - start, 1e-6)
+
+        count_tokens = get_token_counter(EMBEDDING_MODEL)
+        tokens = sum(count_tokens(text) for text in pending)
+        with self.__lock:
+            self.embedded_chunks += len(pending)
+            self.embedded_tokens += tokens
+            self.reused_chunks += len(reused)
+            self.elapsed_seconds += elapsed
+        logging.info('Embedded %d chunks (%d tokens) in %d batches in %.1f'
+                     ' s: %.1f chunks/s, %.0f tokens/s; reused %d',
+                     len(pending), tokens, len(batches), elapsed,
+                     len(pending) / elapsed, tokens / elapsed, len(reused))
+        vectors = iter(embedded)
+        return [reused[i] if i in reused else next(vectors)
+                for i in range(len(texts))]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embeddings.embed_query(text)
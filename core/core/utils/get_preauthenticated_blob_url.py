@@ -1,34 +1,192 @@
 """
 Utility for preauthenticated url's from blob storage.
+
+Signing a SAS is an HMAC over the blob path, and the same blobs (e.g.
+the manual cited by most responses) are signed over and over. Hence,
+SasUrlCache reuses a signed URL until shortly before it expires.
+Alternatively, a container-scoped token can be signed once, and
+appended to the URLs of many blobs in that container.
 """
 
 import logging
+from collections import OrderedDict
 from datetime import timedelta, datetime
+from threading import Lock
+from typing import Optional
+
+from urllib.parse import quote
 
 from azure.storage.blob import (BlobSasPermissions, BlobServiceClient,
-                                generate_blob_sas)
+                                ContainerSasPermissions, generate_blob_sas,
+                                generate_container_sas)
+from utils.singleton import Singleton
+
+# How long a signed URL is valid for
+SAS_LIFETIME = timedelta(hours=1)
+# A cached URL is not handed out within this margin of its expiry, so
+# clients have time to use it
+SAS_SAFETY_MARGIN = timedelta(minutes=10)
+# Upper bound of URLs to remember. The least recently used is evicted.
+MAX_CACHED_URLS = 1024
+# How long a container-scoped token is valid for. It grants access to
+# the whole container, so it is kept short, and signed per response.
+CONTAINER_SAS_LIFETIME = timedelta(minutes=15)
+
+
+class SasUrlCache(metaclass=Singleton):
+    """
+    Process-wide LRU cache of pre-authenticated blob URLs, keyed by
+    (account, container, blob).
+    """
+    def __init__(self, max_size: int = MAX_CACHED_URLS,
+                 safety_margin: timedelta = SAS_SAFETY_MARGIN) -> None:
+        self.max_size = max_size
+        self.safety_margin = safety_margin
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.__entries: OrderedDict[tuple[str, str, str],
+                                    tuple[str, datetime]] = OrderedDict()
+        self.__lock = Lock()
+
+    def get(self, account: str, container: str,
+            blob: str) -> Optional[str]:
+        """
+        Gets a cached URL, if it is not about to expire.
+
+        Args:
+            account (str): The storage account name
+            container (str): The container name
+            blob (str): The blob name
+
+        Returns:
+            Optional[str]: The URL, or None if not cached or about to
+                expire
+        """
+        key = (account, container, blob)
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None or \
+                    entry[1] - self.safety_margin <= datetime.utcnow():
+                self.misses += 1
+                return None
+            self.__entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    # pylint: disable=too-many-arguments
+    def put(self, account: str, container: str, blob: str, url: str,
+            expiry: datetime) -> None:
+        """
+        Remembers a URL until its expiry.
+
+        Args:
+            account (str): The storage account name
+            container (str): The container name
+            blob (str): The blob name
+            url (str): The pre-authenticated URL
+            expiry (datetime): When the SAS of the URL expires (UTC)
+        """
+        key = (account, container, blob)
+        with self.__lock:
+            self.__entries[key] = (url, expiry)
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.max_size:
+                self.__entries.popitem(last=False)
+                self.evictions += 1
+
+    def hit_rate(self) -> float:
+        """
+        Gets the ratio of lookups served from the cache.
+        """
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def clear(self) -> None:
+        """
+        Forgets all URLs, and resets the counters.
+        """
+        with self.__lock:
+            self.__entries.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
 
 
 def get_preauthenticated_blob_url(blob_service_client: BlobServiceClient,
                                   container_name: str,
                                   filename: str) -> str:
     """
-    Gets a pre-authenticated URL from the blob container
+    Gets a pre-authenticated URL from the blob container. The URL is
+    cached by SasUrlCache.
 
     Args:
         filename (str): Filename to get the URL for
     """
+    cache = SasUrlCache()
+    url = cache.get(blob_service_client.account_name, container_name,
+                    filename)
+    if url is not None:
+        return url
+
     logging.info("Obtaining pre-authenticated URL for %s", filename)
 
     blob_client = blob_service_client.get_blob_client(
         container_name, filename)
 
+    expiry = datetime.utcnow() + SAS_LIFETIME
     sas_token = generate_blob_sas(
         account_name=blob_client.account_name,
         container_name=blob_client.container_name,
         blob_name=blob_client.blob_name,
         account_key=blob_client.credential.account_key,
         permission=BlobSasPermissions(read=True),
-        expiry=datetime.utcnow() + timedelta(hours=1)
+        expiry=expiry
     )
-    return f"{blob_client.url}?{sas_token}"
+    url = f"{blob_client.url}?{sas_token}"
+    cache.put(blob_service_client.account_name, container_name, filename,
+              url, expiry)
+    logging.info("SAS URL cache hit rate: %.2f (%d evictions)",
+                 cache.hit_rate(), cache.evictions)
+    return url
+
+
+def get_container_sas_token(blob_service_client: BlobServiceClient,
+                            container_name: str) -> str:
+    """
+    Signs a short-lived, read-only SAS token for a whole container.
+
+    Args:
+        blob_service_client (BlobServiceClient): The blob service client
+        container_name (str): The container name
+
+    Returns:
+        str: The SAS token
+    """
+    logging.info("Obtaining container-scoped token for %s", container_name)
+    container_client = blob_service_client.get_container_client(
+        container_name)
+    return generate_container_sas(
+        account_name=container_client.account_name,
+        container_name=container_client.container_name,
+        account_key=container_client.credential.account_key,
+        permission=ContainerSasPermissions(read=True),
+        expiry=datetime.utcnow() + CONTAINER_SAS_LIFETIME
+    )
+
+
+def get_blob_url_with_token(container_url: str, filename: str,
+                            sas_token: str) -> str:
+    """
+    Builds the URL of a blob, pre-authenticated by a container-scoped
+    token.
+
+    Args:
+        container_url (str): The URL of the container
+        filename (str): Filename to get the URL for
+        sas_token (str): The container-scoped SAS token
+
+    Returns:
+        str: The pre-authenticated URL
+    """
+    return f"{container_url}/{quote(filename, safe='~/')}?{sas_token}"
@@ -2,15 +2,61 @@
 Utiltiies for the message history endpoint
 """
 
-from dataclasses import dataclass
-from dataclasses_json import DataClassJsonMixin
+import base64
+import binascii
+import json
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Optional
+
+from dataclasses_json import DataClassJsonMixin, config
 
 from .chat_message import BidirectionalChatMessage
 
 
+@dataclass
+class HistoryCursor(DataClassJsonMixin):
+    """
+    Points at a message in the chat history, for keyset
+    pagination. Clients only ever see the opaque encoded string.
+    """
+    sent_at: datetime = field(metadata=config(
+        field_name="sentAt",
+        encoder=datetime.isoformat,
+        decoder=datetime.fromisoformat))
+    message_id: str = field(metadata=config(field_name="messageId"))
+
+    def encode(self) -> str:
+        """
+        Encodes the cursor into an opaque string.
+        """
+        return base64.urlsafe_b64encode(self.to_json().encode()).decode()
+
+    @staticmethod
+    def decode(cursor: str) -> 'HistoryCursor':
+        """
+        Decodes a cursor from its opaque string.
+
+        Raises:
+            ValueError: If the cursor is malformed
+        """
+        try:
+            payload = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            # Any JSON decodes, e.g. 1, [] or null
+            if not isinstance(payload, dict):
+                raise TypeError(f'{type(payload).__name__} is not a cursor')
+            return HistoryCursor.from_dict(payload)
+        except (binascii.Error, KeyError, TypeError, AttributeError,
+                ValueError) as e:
+            raise ValueError('Malformed cursor') from e
+
+
 @dataclass
 class ChatHistoryResponse(DataClassJsonMixin):
     """
     Represents the response from the chat history endpoint.
     """
     messages: list[BidirectionalChatMessage]
+    # Pass as the cursor to get the previous page, if there may be one
+    next_cursor: Optional[str] = field(
+        default=None, metadata=config(field_name="nextCursor"))
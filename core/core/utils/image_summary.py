@@ -1,22 +1,140 @@
 """
 Module to get image summary from GPT-4 Vision
+
+ImageSummary keeps pooled HTTP clients, so connections (and their TLS
+handshakes) are reused across images. Throttled (429) and failed (5xx)
+requests are retried with jittered exponential backoff, honouring
+Retry-After.
 """
-import json
+import asyncio
 import logging
-import requests
+import random
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+import httpx
+
+# Statuses worth retrying; the request may succeed later
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Errors of requests that could not connect, also worth retrying
+RETRY_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout)
+MAX_RETRIES = 3
+# The backoff doubles from this, up to MAX_RETRY_DELAY_SECONDS
+RETRY_BASE_DELAY_SECONDS = 1.0
+MAX_RETRY_DELAY_SECONDS = 30.0
+# Generating a summary can take a while, but connecting should not
+CONNECT_TIMEOUT_SECONDS = 10.0
+READ_TIMEOUT_SECONDS = 120.0
+MAX_CONNECTIONS = 10
+
+
+def retry_delay(attempt: int, response: Optional[httpx.Response]) -> float:
+    """
+    Gets how long to wait before retrying. Retry-After is honoured if
+    the response has it; otherwise, the delay is the exponential
+    backoff with full jitter.
+
+    Args:
+        attempt (int): The number of the attempt that failed, from 0
+        response (Optional[httpx.Response]): The failed response, if
+            the request got one
+
+    Returns:
+        float: The delay in seconds
+    """
+    retry_after = response.headers.get('Retry-After') \
+        if response is not None else None
+    if retry_after is not None:
+        try:
+            delay = float(retry_after)
+        except ValueError:
+            try:
+                delay = (parsedate_to_datetime(retry_after)
+                         - datetime.now(timezone.utc)).total_seconds()
+            except (TypeError, ValueError):
+                delay = 0
+        return min(max(delay, 0), MAX_RETRY_DELAY_SECONDS)
+
+    return random.uniform(0, min(RETRY_BASE_DELAY_SECONDS * 2 ** attempt,
+                                 MAX_RETRY_DELAY_SECONDS))
+
+
+def should_retry(attempt: int, response: Optional[httpx.Response]) -> bool:
+    """
+    Checks if a request should be retried. Requests that could not
+    connect (no response) and retryable statuses are retried, until
+    MAX_RETRIES is reached.
+    """
+    if attempt >= MAX_RETRIES:
+        return False
+    return response is None or response.status_code in RETRY_STATUSES
+
+
+def next_retry_delay(attempt: int, response: Optional[httpx.Response],
+                     error: Optional[Exception] = None) -> Optional[float]:
+    """
+    Decides what follows an attempt, for both the sync and async
+    requests: the delay before retrying it, or None if the response is
+    final. The error of a request that could not connect is raised if
+    it should not be retried.
+
+    Args:
+        attempt (int): The number of the attempt, from 0
+        response (Optional[httpx.Response]): The response, if the
+            request got one
+        error (Optional[Exception]): The error, if it did not
+
+    Returns:
+        Optional[float]: The delay in seconds, or None to stop
+    """
+    if not should_retry(attempt, response):
+        if error is not None:
+            raise error
+        return None
+    delay = retry_delay(attempt, response)
+    logging.warning('GPT-4 Vision request failed (%s), retrying in %.1f s',
+                    response.status_code if response is not None
+                    else 'no connection', delay)
+    return delay
 
 
 class ImageSummary:
     """
     Class to get image summary from GPT-4 Vision
     """
-    def __init__(self, base_url: str, api_key: str, deployment_name: str):
+    # pylint: disable=too-many-arguments
+    def __init__(self, base_url: str, api_key: str, deployment_name: str,
+                 connect_timeout: float = CONNECT_TIMEOUT_SECONDS,
+                 read_timeout: float = READ_TIMEOUT_SECONDS):
         self.endpoint = (f"{base_url}openai/deployments/{deployment_name}"
                          "/chat/completions?api-version=2023-12-01-preview")
         self.headers = {
             "Content-Type": "application/json",
             "api-key": api_key
         }
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self.limits = httpx.Limits(max_connections=MAX_CONNECTIONS,
+                                   max_keepalive_connections=MAX_CONNECTIONS)
+        self.client = httpx.Client(headers=self.headers,
+                                   timeout=self.timeout, limits=self.limits)
+        self.__async_client: Optional[httpx.AsyncClient] = None
+
+    @property
+    def async_client(self) -> httpx.AsyncClient:
+        """
+        Gets the pooled async client, creating it on first use.
+        """
+        if self.__async_client is None:
+            self.__async_client = httpx.AsyncClient(
+                headers=self.headers, timeout=self.timeout,
+                limits=self.limits)
+        return self.__async_client
+
+    @async_client.setter
+    def async_client(self, client: httpx.AsyncClient) -> None:
+        self.__async_client = client
 
     def generate_request(self, image: str) -> dict:
         """
@@ -60,31 +178,73 @@ class ImageSummary:
             "max_tokens": 2000
         }
 
-    def get_image_summary(self, image: str) -> str:
-        """
-        Function to get image summary from GPT-4 Vision
-        """
-        data = self.generate_request(image)
+    @staticmethod
+    def __validate(image: str) -> None:
         if not image.startswith("data:image/"):
             raise RuntimeError(
                 "Image string is not valid."
                 " Please try again with a valid Image.")
 
-        response = requests.post(self.endpoint,
-                                 headers=self.headers,
-                                 data=json.dumps(data),
-                                 timeout=600)
-        response = json.loads(response.text)
-
+    @staticmethod
+    def __parse_summary(response: httpx.Response) -> str:
         message = None
         try:
             # Guaranteed to be correct because of the schema
-            message = response['choices'][0]['message']['content']  # type: ignore # pylint: disable=line-too-long # noqa: E501
-        except (KeyError, AttributeError):
-            logging.error("Malformed response from GPT-4 vision."
-                          " Defaulting to none")
+            message = response.json()['choices'][0]['message']['content']  # type: ignore # pylint: disable=line-too-long # noqa: E501
+        except (KeyError, AttributeError, IndexError, TypeError,
+                ValueError):
+            logging.error("Malformed response from GPT-4 vision (%d)."
+                          " Defaulting to none", response.status_code)
 
         if message is None:
             raise RuntimeError(
                 "No response generated by GPT-4 Vision. Please try again.")
         return message
+
+    def get_image_summary(self, image: str) -> str:
+        """
+        Function to get image summary from GPT-4 Vision
+        """
+        data = self.generate_request(image)
+        self.__validate(image)
+
+        attempt = 0
+        while True:
+            response, error = None, None
+            try:
+                response = self.client.post(self.endpoint, json=data)
+            except RETRY_ERRORS as e:
+                error = e
+            delay = next_retry_delay(attempt, response, error)
+            if delay is None:
+                break
+            time.sleep(delay)
+            attempt += 1
+
+        assert response is not None
+        return self.__parse_summary(response)
+
+    async def get_image_summary_async(self, image: str) -> str:
+        """
+        Function to get image summary from GPT-4 Vision, without
+        blocking the event loop
+        """
+        data = self.generate_request(image)
+        self.__validate(image)
+
+        attempt = 0
+        while True:
+            response, error = None, None
+            try:
+                response = await self.async_client.post(self.endpoint,
+                                                        json=data)
+            except RETRY_ERRORS as e:
+                error = e
+            delay = next_retry_delay(attempt, response, error)
+            if delay is None:
+                break
+            await asyncio.sleep(delay)
+            attempt += 1
+
+        assert response is not None
+        return self.__parse_summary(response)
@@ -0,0 +1,171 @@
+"""
+Caches GPT-4 Vision image summaries, keyed by a hash of the image.
+
+Summarising an image takes tens of seconds, yet technicians often send
+the same photo (e.g. a nameplate) again. The hash is either the SHA-256
+of the compressed image, so only identical images hit, or its
+difference hash, so near-identical photos hit as well.
+
+Summaries are kept in a pluggable SummaryStore: in-process (LRU), or in
+the database, where they are shared by every worker.
+"""
+
+import hashlib
+import logging
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from threading import Lock
+from typing import Callable, Optional, Union
+
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+
+from models.image_summary import ImageSummaryDAO
+from utils.image_utils import difference_hash
+
+# Upper bound of summaries to keep in memory
+MAX_CACHED_SUMMARIES = 256
+
+
+class SummaryStore(ABC):
+    """
+    Stores image summaries by key.
+    """
+    @abstractmethod
+    def get(self, key: str) -> Optional[str]:
+        """
+        Gets a summary.
+
+        Args:
+            key (str): The key of the image
+
+        Returns:
+            Optional[str]: The summary, or None if not stored
+        """
+
+    @abstractmethod
+    def put(self, key: str, summary: str) -> None:
+        """
+        Stores a summary.
+
+        Args:
+            key (str): The key of the image
+            summary (str): The summary
+        """
+
+
+class InMemorySummaryStore(SummaryStore):
+    """
+    Stores summaries in the process, evicting the least recently used.
+    """
+    def __init__(self, max_size: int = MAX_CACHED_SUMMARIES) -> None:
+        self.max_size = max_size
+        self.__entries: OrderedDict[str, str] = OrderedDict()
+        self.__lock = Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self.__lock:
+            summary = self.__entries.get(key)
+            if summary is not None:
+                self.__entries.move_to_end(key)
+            return summary
+
+    def put(self, key: str, summary: str) -> None:
+        with self.__lock:
+            self.__entries[key] = summary
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.max_size:
+                self.__entries.popitem(last=False)
+
+
+class SqlSummaryStore(SummaryStore):
+    """
+    Stores summaries in the image_summaries table.
+    """
+    def __init__(self, session: Callable[[], Session]) -> None:
+        """
+        Args:
+            session (Callable[[], Session]): Gets the database session
+                to use, e.g. the session of the current thread
+        """
+        self.__session = session
+
+    def get(self, key: str) -> Optional[str]:
+        return ImageSummaryDAO.get_summary(self.__session(), key)
+
+    def put(self, key: str, summary: str) -> None:
+        session = self.__session()
+        try:
+            ImageSummaryDAO.save_summary(session, key, summary)
+        except SQLAlchemyError:
+            session.rollback()
+            raise
+
+
+class ImageSummaryCache:
+    """
+    Looks up image summaries before they are generated. Failures of
+    the store are logged, and treated as misses.
+    """
+    def __init__(self, store: Optional[SummaryStore],
+                 perceptual: bool = False) -> None:
+        """
+        Args:
+            store (Optional[SummaryStore]): Where summaries are kept,
+                or None to disable caching
+            perceptual (bool): Whether images are keyed by their
+                difference hash, instead of their SHA-256
+        """
+        self.store = store
+        self.perceptual = perceptual
+        self.hits = 0
+        self.misses = 0
+
+    def key_for(self, image: Union[bytes, memoryview]) -> str:
+        """
+        Gets the key of an image.
+
+        Args:
+            image (Union[bytes, memoryview]): The image
+
+        Returns:
+            str: The key, prefixed by the kind of hash
+        """
+        if self.perceptual:
+            return f'dhash:{difference_hash(image)}'
+        return f'sha256:{hashlib.sha256(image).hexdigest()}'
+
+    def get_or_create(self, image: Union[bytes, memoryview],
+                      create: Callable[[], str]) -> str:
+        """
+        Gets the cached summary of an image, or creates and caches it.
+
+        Args:
+            image (Union[bytes, memoryview]): The image being summarised
+            create (Callable[[], str]): Generates the summary
+
+        Returns:
+            str: The summary
+        """
+        if self.store is None:
+            return create()
+
+        key = self.key_for(image)
+        try:
+            summary = self.store.get(key)
+        except Exception:  # pylint: disable=broad-exception-caught
+            logging.exception('Unable to read image summary cache')
+            summary = None
+
+        if summary is not None:
+            self.hits += 1
+            logging.info('Image summary cache hit for %s', key)
+            return summary
+
+        self.misses += 1
+        summary = create()
+        try:
+            self.store.put(key, summary)
+        except Exception:  # pylint: disable=broad-exception-caught
+            logging.exception('Unable to write image summary cache')
+        return summary
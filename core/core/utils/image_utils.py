@@ -1,27 +1,176 @@
 """
 Utilities for image processing.
+
+Images arrive as data URLs of up to tens of megabytes. They are
+validated by sniffing only the header, then decoded exactly once; the
+decoded buffer is passed on as a memoryview, so it is not copied again
+on its way to compress_image.
+
+compress_image only needs a small image. JPEGs are decoded in draft
+mode, where the decoder downscales by up to 8x while decoding, and the
+remaining resize first reduces by an integer factor (reducing_gap).
 """
 
 import base64
+import binascii
+import math
+from dataclasses import dataclass
 from io import BytesIO
+from typing import Optional, Union
 
 import puremagic  # type: ignore[import-untyped]
-from PIL import Image
+from PIL import ExifTags, Image, ImageOps
 
+# EXIF orientations that rotate the image by 90 or 270 degrees
+TRANSPOSED_ORIENTATIONS = {5, 6, 7, 8}
+# Resampling starts from at least this multiple of the target size;
+# the rest of the reduction is done by fast integer reduction
+REDUCING_GAP = 2.0
 
-def is_url_encoded_image(body: str) -> bool:
+
+@dataclass(frozen=True)
+class CompressionPreset:
     """
-    Checks if the image is a URL encoded image.
+    Width to resize to, and JPEG quality to compress with.
     """
-    if not body.startswith('data:image/') or ',' not in body:
-        return False
+    width: int
+    quality: int
+
 
-    decoded = base64.b64decode(body.split(',')[1])
-    magic_detection = puremagic.magic_string(decoded)
+COMPRESSION_PRESETS = {
+    # Enough for the image summary and the chat history
+    'default': CompressionPreset(width=600, quality=75),
+    # Keeps small print (e.g. rating plates) legible
+    'detailed': CompressionPreset(width=1024, quality=85),
+    'small': CompressionPreset(width=400, quality=60),
+}
+
+# The difference hash compares DIFFERENCE_HASH_SIZE squared pairs of
+# neighbouring pixels, hence 64 bits
+DIFFERENCE_HASH_SIZE = 8
+
+# Bytes sniffed for magic numbers. Covers the headers of the image types
+# known to puremagic, and is a multiple of 3 to decode without padding.
+IMAGE_HEADER_BYTES = 384
+
+
+def __is_image_header(header: bytes) -> bool:
+    try:
+        magic_detection = puremagic.magic_string(header)
+    except (ValueError, puremagic.PureError):
+        # puremagic raises on empty or unidentified input
+        return False
     return not len(magic_detection) == 0 and \
         magic_detection[0].mime_type.startswith('image')
 
 
+def decode_url_encoded_image(body: str) -> Optional[memoryview]:
+    """
+    Validates and decodes a URL encoded image. Only the header is
+    decoded to check that it is an image; the whole image is then
+    decoded once.
+
+    Args:
+        body (str): The data URL
+
+    Returns:
+        Optional[memoryview]: The decoded image, or None if it is not
+            a URL encoded image
+    """
+    if not body.startswith('data:image/'):
+        return None
+    start = body.find(',') + 1
+    if start == 0:
+        return None
+
+    try:
+        header = base64.b64decode(
+            body[start:start + IMAGE_HEADER_BYTES // 3 * 4])
+        if not __is_image_header(header):
+            return None
+        return memoryview(base64.b64decode(body[start:]))
+    except binascii.Error:
+        return None
+
+
+def is_url_encoded_image(body: str) -> bool:
+    """
+    Checks if the image is a URL encoded image.
+    """
+    return decode_url_encoded_image(body) is not None
+
+
+def __as_stream(content: Union[bytes, memoryview]) -> BytesIO:
+    """
+    Wraps the content in a stream. BytesIO shares the buffer of bytes
+    objects instead of copying them, so a memoryview over a whole bytes
+    object is unwrapped first.
+    """
+    if isinstance(content, memoryview) and \
+            isinstance(content.obj, bytes) and \
+            content.nbytes == len(content.obj):
+        return BytesIO(content.obj)
+    return BytesIO(content)
+
+
+def difference_hash(content: Union[bytes, memoryview]) -> str:
+    """
+    Computes a perceptual (difference) hash of an image. Visually
+    similar images, e.g. the same photo re-encoded or resized, have the
+    same hash.
+
+    Args:
+        content (Union[bytes, memoryview]): The image
+
+    Returns:
+        str: The 64-bit hash, in hex
+    """
+    img = Image.open(__as_stream(content))
+    img.draft('L', (DIFFERENCE_HASH_SIZE + 1, DIFFERENCE_HASH_SIZE))
+    pixels = list(img.convert('L').resize(
+        (DIFFERENCE_HASH_SIZE + 1, DIFFERENCE_HASH_SIZE),
+        Image.Resampling.LANCZOS).getdata())
+
+    bits = 0
+    for row in range(DIFFERENCE_HASH_SIZE):
+        for column in range(DIFFERENCE_HASH_SIZE):
+            left = pixels[row * (DIFFERENCE_HASH_SIZE + 1) + column]
+            bits = (bits << 1) | (left > pixels[
+                row * (DIFFERENCE_HASH_SIZE + 1) + column + 1])
+    return f'{bits:016x}'
+
+
+def get_compression_preset(name: str) -> CompressionPreset:
+    """
+    Gets a compression preset by name, or the default preset if there
+    is no such preset.
+
+    Args:
+        name (str): The preset name
+
+    Returns:
+        CompressionPreset: The preset
+    """
+    return COMPRESSION_PRESETS.get(name, COMPRESSION_PRESETS['default'])
+
+
+def __draft(img: Image.Image, max_width: int) -> None:
+    """
+    Asks the decoder (JPEG only) to downscale while decoding, to no
+    less than the size the image will be resized to.
+    """
+    width, height = img.size
+    oriented_width = width
+    if img.getexif().get(ExifTags.Base.Orientation) in \
+            TRANSPOSED_ORIENTATIONS:
+        oriented_width = height
+    if oriented_width <= max_width:
+        return
+
+    scale = max_width / oriented_width
+    img.draft('RGB', (math.ceil(width * scale), math.ceil(height * scale)))
+
+
 def __resize_if_needed(img: Image.Image, max_width: int) -> Image.Image:
     width, height = img.size
     if width <= max_width:
@@ -29,23 +178,35 @@ def __resize_if_needed(img: Image.Image, max_width: int) -> Image.Image:
 
     aspect_ratio = height / width
     new_height = int(max_width * aspect_ratio)
-    return img.resize((max_width, new_height))
+    return img.resize((max_width, new_height), reducing_gap=REDUCING_GAP)
 
 
-def compress_image(content: bytes, resized_width: int = 600) -> bytes:
+def compress_image(content: Union[bytes, memoryview],
+                   resized_width: int = 600, *,
+                   quality: int = 75) -> bytes:
     """
-    Calls a library to resize then compress the content.
+    Calls a library to resize then compress the content. The image is
+    rotated upright according to its EXIF orientation.
 
     Args:
-        content (bytes): Content to compress
+        content (Union[bytes, memoryview]): Content to compress
+        resized_width (int): The maximum width of the image
+
+    Keyword Args:
+        quality (int): The JPEG quality, from 0 to 95
 
     Returns:
         bytes: The compressed image
     """
     # doing it this way because we want PIL to infer the image, and also
     # automatically compress the image when saving
-    img_stream = BytesIO(content)
+    img = Image.open(__as_stream(content))
+    __draft(img, resized_width)
+    ImageOps.exif_transpose(img, in_place=True)
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+
     out_stream = BytesIO()
-    __resize_if_needed(Image.open(img_stream).convert('RGB'),
-                       resized_width).save(out_stream, format='JPEG')
+    __resize_if_needed(img, resized_width).save(
+        out_stream, format='JPEG', quality=quality)
     return out_stream.getvalue()
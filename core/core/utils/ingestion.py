@@ -0,0 +1,225 @@
+"""
+Streaming ingestion of uploaded documents into a search index.
+
+The document is analysed a window of pages at a time, with Document
+Intelligence reading it from its URL, so the worker never uploads it.
+Its pages are chunked (see utils.chunking), then embedded and uploaded
+in batches as they are parsed, with a bounded queue in between:
+parsing stays at most a few batches ahead of uploading. So the memory
+used does not grow with the size of the manual, and its first pages
+are searchable before the rest are analysed.
+"""
+
+import logging
+import queue
+import threading
+import time
+from itertools import islice
+from typing import Any, Callable, Iterable, Iterator, Optional, TypeVar
+
+from azure.ai.formrecognizer import DocumentAnalysisClient
+from azure.core.exceptions import HttpResponseError
+from langchain_core.documents import Document
+from langchain_core.vectorstores import VectorStore
+
+# Pages per analysis request
+PAGE_WINDOW = 20
+# Pages per add_documents call (i.e. embedded and uploaded together)
+INGESTION_BATCH_SIZE = 64
+# Batches parsed ahead of the one being uploaded
+PREFETCH_DEPTH = 2
+# How often a blocked producer checks if the consumer has stopped
+PUT_TIMEOUT_SECONDS = 0.1
+# Layout roles of headings, and their Markdown prefix
+HEADING_PREFIXES = {'title': '# ', 'sectionHeading': '## '}
+# Layout roles repeated on every page, which only add noise
+SKIPPED_ROLES = {'pageHeader', 'pageFooter', 'pageNumber'}
+# Inner error code of requests with invalid parameters (e.g. pages)
+INVALID_PARAMETER = 'InvalidParameter'
+
+T = TypeVar('T')
+
+
+def __page_texts(result: Any) -> dict[int, str]:
+    """
+    Gets the text of every page from its paragraphs, with headings in
+    Markdown, and without page headers, footers and numbers. Without
+    paragraphs, the lines of the page are joined instead.
+    """
+    if not result.paragraphs:
+        return {page.page_number: ' '.join(line.content
+                                           for line in page.lines or [])
+                for page in result.pages}
+
+    paragraphs: dict[int, list[str]] = {page.page_number: []
+                                        for page in result.pages}
+    for paragraph in result.paragraphs:
+        if paragraph.role in SKIPPED_ROLES \
+           or not paragraph.bounding_regions:
+            continue
+        number = paragraph.bounding_regions[0].page_number
+        paragraphs.setdefault(number, []).append(
+            HEADING_PREFIXES.get(paragraph.role, '') + paragraph.content)
+    return {number: '\n\n'.join(texts)
+            for number, texts in paragraphs.items()}
+
+
+def __is_invalid_page_range(error: HttpResponseError) -> bool:
+    """
+    Checks whether Document Intelligence rejected the pages of a
+    request, as it does for a range past the last page. Results only
+    hold the pages analysed, not the length of the document, so this
+    is how its end is found.
+    """
+    inner = (error.error.innererror or {}) if error.error else {}
+    return error.status_code == 400 \
+        and inner.get('code') == INVALID_PARAMETER \
+        and 'pages' in (inner.get('message') or '')
+
+
+def analyze_pages(client: DocumentAnalysisClient, model: str,
+                  document_url: Callable[[], str],
+                  source: Optional[str] = None,
+                  window: int = PAGE_WINDOW) -> Iterator[Document]:
+    """
+    Analyses a document a window of pages at a time, as the next page
+    is needed. A document is yielded per page, as
+    DocumentIntelligenceParser does; its paragraphs are separated by
+    blank lines, and titles and section headings are marked as
+    Markdown headings (# and ##), for HeadingChunker.
+
+    Args:
+        client (DocumentAnalysisClient): The Document Intelligence client
+        model (str): The model to analyse with
+        document_url (Callable[[], str]): Gets the URL of the
+            document, readable by Document Intelligence (e.g. with a
+            SAS); it is called for every window, so an expiring URL
+            can be signed again
+        source (Optional[str]): The source in the metadata of the pages
+        window (int): Pages per analysis request
+
+    Returns:
+        Iterator[Document]: The pages, in order
+    """
+    window = max(window, 1)
+    first = 1
+    while True:
+        try:
+            result = client.begin_analyze_document_from_url(
+                model, document_url(),
+                pages=f'{first}-{first + window - 1}').result()
+        except HttpResponseError as e:
+            # The previous window ended on the last page, so this one
+            # is out of range
+            if first > 1 and __is_invalid_page_range(e):
+                return
+            raise
+        for number, text in __page_texts(result).items():
+            yield Document(page_content=text,
+                           metadata={'source': source, 'page': number})
+        if len(result.pages) < window:
+            return
+        first += window
+
+
+def batched(items: Iterable[T], size: int) -> Iterator[list[T]]:
+    """
+    Groups items into lists of the size; the last may be shorter.
+
+    Args:
+        items (Iterable[T]): The items
+        size (int): The size of every list
+
+    Returns:
+        Iterator[list[T]]: The lists, in order
+    """
+    iterator = iter(items)
+    while batch := list(islice(iterator, max(size, 1))):
+        yield batch
+
+
+def __put(buffer: queue.Queue, stop: threading.Event, entry: Any) -> bool:
+    """
+    Puts an entry into the buffer, blocking while it is full, unless
+    the consumer stops.
+
+    Returns:
+        bool: False if the consumer stopped
+    """
+    while not stop.is_set():
+        try:
+            buffer.put(entry, timeout=PUT_TIMEOUT_SECONDS)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def prefetch(items: Iterable[T], depth: int = PREFETCH_DEPTH
+             ) -> Iterator[T]:
+    """
+    Produces items on a background thread, at most depth items ahead
+    of the consumer. Errors of the producer are raised to the
+    consumer.
+
+    Args:
+        items (Iterable[T]): The items, produced lazily
+        depth (int): How many items may wait for the consumer
+
+    Returns:
+        Iterator[T]: The items, in order
+    """
+    buffer: queue.Queue = queue.Queue(maxsize=max(depth, 1))
+    stop = threading.Event()
+
+    def produce() -> None:
+        try:
+            for item in items:
+                if not __put(buffer, stop, (item, None)):
+                    return
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            __put(buffer, stop, (None, e))
+            return
+        __put(buffer, stop, None)
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while (entry := buffer.get()) is not None:
+            item, error = entry
+            if error is not None:
+                raise error
+            yield item
+    finally:
+        stop.set()
+
+
+def ingest(documents: Iterable[Document], vector_store: VectorStore,
+           batch_size: int = INGESTION_BATCH_SIZE,
+           depth: int = PREFETCH_DEPTH) -> int:
+    """
+    Embeds and uploads documents (e.g. chunks) in batches, while the
+    next batches are parsed. Documents with a chunk_id in their
+    metadata are uploaded under it, so uploading them again replaces
+    them.
+
+    Args:
+        documents (Iterable[Document]): The documents, parsed lazily
+        vector_store (VectorStore): The store to add them to
+        batch_size (int): Documents per add_documents call
+        depth (int): Batches parsed ahead of the one being uploaded
+
+    Returns:
+        int: The number of documents added
+    """
+    start = time.perf_counter()
+    added = 0
+    for batch in prefetch(batched(documents, batch_size), depth):
+        keys = [document.metadata.get('chunk_id') for document in batch]
+        if all(keys):
+            vector_store.add_documents(batch, keys=keys)
+        else:
+            vector_store.add_documents(batch)
+        added += len(batch)
+        logging.info('Indexed %d documents in %.1f s', added,
+                     time.perf_counter() - start)
+    return added
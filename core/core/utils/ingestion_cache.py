@@ -0,0 +1,205 @@
+"""
+Reuses the chunks and vectors of manuals ingested before.
+
+The same manual is often uploaded again, e.g. for another machine, or
+as a revision changing a few pages. Files and pages are recorded by
+the SHA-256 of their content (see IngestionCacheDAO), with the index
+their chunks were uploaded to. An identical file is cloned from that
+index, without analysing or embedding it. For a revision, the chunks
+of every unchanged page are fetched from the index instead of being
+embedded again; only Document Intelligence runs on the whole file.
+
+Chunk IDs are deterministic (see utils.chunking), so the chunks of a
+page are found from its source, number and number of chunks alone.
+"""
+
+import base64
+import hashlib
+import json
+import logging
+from io import BufferedIOBase
+from typing import Any, Callable, Iterable, Iterator, Optional
+
+from azure.core.exceptions import HttpResponseError
+from azure.search.documents import SearchClient
+from langchain_community.vectorstores.azuresearch import (
+    FIELDS_CONTENT, FIELDS_CONTENT_VECTOR, FIELDS_ID, FIELDS_METADATA)
+from langchain_core.documents import Document
+from models.ingestion_cache import IngestedFileModel, IngestedPageModel
+from utils.chunking import Chunker, chunk_id
+from utils.embeddings import EMBEDDING_MODEL, BatchedEmbeddings
+
+HASH_BUFFER_BYTES = 1024 * 1024
+
+
+def hash_file(stream: BufferedIOBase) -> str:
+    """
+    Gets the SHA-256 of a file, reading it once, a buffer at a time.
+
+    Args:
+        stream (BufferedIOBase): The file (e.g. a blob), at its start
+
+    Returns:
+        str: The hex digest
+    """
+    digest = hashlib.sha256()
+    while buffer := stream.read(HASH_BUFFER_BYTES):
+        digest.update(buffer)
+    return digest.hexdigest()
+
+
+def hash_page(page: Document, chunker: Chunker) -> str:
+    """
+    Gets the hash of a page, which is the same whenever the page would
+    be chunked the same way.
+
+    Args:
+        page (Document): The page
+        chunker (Chunker): The chunker, before it splits the page
+
+    Returns:
+        str: The hex digest
+    """
+    return hashlib.sha256(
+        f'{chunker.state()}\0{page.page_content}'.encode()).hexdigest()
+
+
+def ingestion_settings(strategy: str, chunk_tokens: int,
+                       overlap_tokens: int) -> str:
+    """
+    Gets the settings files and pages are ingested with. Chunks are
+    only reused with the same settings.
+
+    Args:
+        strategy (str): The chunking strategy
+        chunk_tokens (int): Upper bound of tokens per chunk
+        overlap_tokens (int): Tokens shared by adjacent chunks
+
+    Returns:
+        str: The settings
+    """
+    return f'{strategy}:{chunk_tokens}:{overlap_tokens}:{EMBEDDING_MODEL}'
+
+
+def search_key(chunk: str) -> str:
+    """
+    Gets the key of a chunk in the search index, encoded as AzureSearch
+    does.
+
+    Args:
+        chunk (str): The chunk ID
+
+    Returns:
+        str: The key
+    """
+    return base64.urlsafe_b64encode(chunk.encode()).decode('ascii')
+
+
+class IngestionCache:
+    """
+    Clones files, or reuses the chunks of pages, from the indexes they
+    were ingested into, and records the pages of the file being
+    ingested. Use an IngestionCache per file.
+    """
+    def __init__(self,
+                 find_page: Callable[[str], Optional[IngestedPageModel]],
+                 open_index: Callable[[str], SearchClient],
+                 embeddings: BatchedEmbeddings) -> None:
+        self.find_page = find_page
+        self.open_index = open_index
+        self.embeddings = embeddings
+        # (hash, number, chunks) of every page ingested, in order
+        self.pages: list[tuple[str, int, int]] = []
+        self.reused_pages = 0
+
+    def __fetch_chunks(self, page: IngestedPageModel
+                       ) -> Optional[list[dict[str, Any]]]:
+        """
+        Fetches the chunks of a page from its index.
+
+        Returns:
+            Optional[list[dict[str, Any]]]: The chunks, in order, or
+                None if any is missing
+        """
+        keys = [search_key(chunk_id(page.source, page.page, ordinal))
+                for ordinal in range(page.chunks)]
+        if not keys:
+            return []
+        try:
+            results = self.open_index(page.search_index).search(
+                search_text='*',
+                filter=f"search.in({FIELDS_ID}, '{','.join(keys)}', ',')",
+                select=[FIELDS_ID, FIELDS_CONTENT, FIELDS_CONTENT_VECTOR,
+                        FIELDS_METADATA],
+                top=len(keys))
+            chunks = {result[FIELDS_ID]: result for result in results}
+        except HttpResponseError as e:
+            logging.warning('Cannot fetch the chunks of page %d of %s from'
+                            ' %s: %s', page.page, page.source,
+                            page.search_index, e)
+            return None
+        if any(key not in chunks for key in keys):
+            return None
+        return [chunks[key] for key in keys]
+
+    def clone(self, file: IngestedFileModel, source: str
+              ) -> Iterator[Document]:
+        """
+        Gets the chunks of an ingested file from the indexes its pages
+        were ingested into, with their vectors handed to the
+        embeddings. Raises LookupError if a page is no longer there.
+
+        Args:
+            file (IngestedFileModel): The ingested file
+            source (str): The source in the metadata of the new chunks
+
+        Returns:
+            Iterator[Document]: The chunks, in order
+        """
+        for number, page_hash in enumerate(json.loads(file.page_hashes), 1):
+            page = self.find_page(page_hash)
+            chunks = self.__fetch_chunks(page) if page else None
+            if chunks is None:
+                raise LookupError(f'page {number} of {file.file_hash}')
+            for ordinal, chunk in enumerate(chunks):
+                self.embeddings.reuse(chunk[FIELDS_CONTENT],
+                                      chunk[FIELDS_CONTENT_VECTOR])
+                yield Document(
+                    page_content=chunk[FIELDS_CONTENT],
+                    metadata={**json.loads(chunk[FIELDS_METADATA]),
+                              'source': source,
+                              'page': number,
+                              'chunk': ordinal,
+                              'chunk_id': chunk_id(source, number, ordinal)})
+            self.pages.append((page_hash, number, len(chunks)))
+            self.reused_pages += 1
+
+    def chunk(self, pages: Iterable[Document], chunker: Chunker
+              ) -> Iterator[Document]:
+        """
+        Chunks pages, handing the vectors of pages ingested before to
+        the embeddings.
+
+        Args:
+            pages (Iterable[Document]): The pages, in order
+            chunker (Chunker): The chunker
+
+        Returns:
+            Iterator[Document]: The chunks, in order
+        """
+        for page in pages:
+            page_hash = hash_page(page, chunker)
+            chunks = list(chunker.split([page]))
+            ingested = self.find_page(page_hash)
+            if ingested is not None and ingested.chunks == len(chunks):
+                fetched = self.__fetch_chunks(ingested)
+                if fetched is not None and all(
+                        chunk.page_content == cached[FIELDS_CONTENT]
+                        for chunk, cached in zip(chunks, fetched)):
+                    for cached in fetched:
+                        self.embeddings.reuse(cached[FIELDS_CONTENT],
+                                              cached[FIELDS_CONTENT_VECTOR])
+                    self.reused_pages += 1
+            self.pages.append((page_hash, page.metadata['page'],
+                               len(chunks)))
+            yield from chunks
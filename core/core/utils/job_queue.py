@@ -0,0 +1,90 @@
+"""
+Queues for background jobs, such as summarizing a completed
+conversation.
+
+In production, jobs are sent to an Azure Storage Queue, and processed
+by a queue-triggered function; the Functions host retries failed jobs,
+and moves them to the poison queue after 5 attempts. For local
+development without a storage emulator, InMemoryJobQueue processes
+jobs on a background thread of the same worker instead. Jobs are lost
+if the worker stops, so do not use it in production.
+"""
+
+import json
+import logging
+import queue
+import threading
+from abc import ABC, abstractmethod
+from typing import Any, Callable, Optional
+
+from azure.storage.queue import QueueClient, TextBase64EncodePolicy
+
+# The queue of the summarization worker (see function_app.py)
+SUMMARIZATION_QUEUE_NAME = 'summarization-jobs'
+
+# pylint: disable=too-few-public-methods
+
+
+class JobQueue(ABC):
+    """
+    A queue of JSON jobs.
+    """
+    @abstractmethod
+    def send(self, job: dict[str, Any]) -> None:
+        """
+        Sends a job to the queue.
+
+        Args:
+            job (dict[str, Any]): The job; must be JSON serializable
+        """
+
+
+class StorageJobQueue(JobQueue):
+    """
+    Sends jobs to an Azure Storage Queue.
+    """
+    def __init__(self, connection_string: str, queue_name: str) -> None:
+        # Queue triggers expect base64 encoded messages by default
+        self.client = QueueClient.from_connection_string(
+            connection_string, queue_name,
+            message_encode_policy=TextBase64EncodePolicy())
+
+    def send(self, job: dict[str, Any]) -> None:
+        self.client.send_message(json.dumps(job))
+
+
+class InMemoryJobQueue(JobQueue):
+    """
+    Processes jobs on a background thread, one at a time. Failed jobs
+    are logged, and not retried.
+    """
+    def __init__(self, handler: Callable[[dict[str, Any]], None]) -> None:
+        self.handler = handler
+        self.__jobs: queue.Queue[dict[str, Any]] = queue.Queue()
+        self.__thread: Optional[threading.Thread] = None
+        self.__lock = threading.Lock()
+
+    def __work(self) -> None:
+        while True:
+            job = self.__jobs.get()
+            try:
+                self.handler(job)
+            except Exception:  # pylint: disable=broad-exception-caught
+                logging.exception('Job failed: %s', job)
+            finally:
+                self.__jobs.task_done()
+
+    def send(self, job: dict[str, Any]) -> None:
+        # Round trip through JSON, as the storage queue would
+        self.__jobs.put(json.loads(json.dumps(job)))
+        with self.__lock:
+            if self.__thread is None:
+                self.__thread = threading.Thread(target=self.__work,
+                                                 daemon=True)
+                self.__thread.start()
+
+    def join(self) -> None:
+        """
+        Waits until every job sent so far has been processed.
+        """
+        self.__jobs.join()
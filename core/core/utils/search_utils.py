@@ -3,8 +3,109 @@ Utilities for AI Search.
 """
 
 import logging
+import time
+from threading import Lock
+from typing import Optional
+
 from azure.search.documents.indexes import SearchIndexClient
 from azure.core.exceptions import ResourceNotFoundError
+from utils.singleton import Singleton
+
+# How long an index is remembered to exist, or to not exist. Indexes
+# rarely disappear, but are created whenever a document or
+# conversation is first stored, hence the shorter negative TTL.
+POSITIVE_TTL_SECONDS = 300
+NEGATIVE_TTL_SECONDS = 30
+
+
+class IndexExistenceCache(metaclass=Singleton):
+    """
+    Process-wide cache of whether search indexes exist. Entries are
+    keyed by the index client and index name, and expire after the
+    positive or negative TTL.
+
+    Whenever an index is created or deleted, call invalidate() so the
+    change is seen immediately.
+    """
+    def __init__(self,
+                 positive_ttl: float = POSITIVE_TTL_SECONDS,
+                 negative_ttl: float = NEGATIVE_TTL_SECONDS) -> None:
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self.__entries: dict[tuple[SearchIndexClient, str],
+                             tuple[bool, float]] = {}
+        self.__lock = Lock()
+
+    def get(self, index_client: SearchIndexClient,
+            search_index: str) -> Optional[bool]:
+        """
+        Gets whether the index exists, if known.
+
+        Args:
+            index_client (SearchIndexClient): The search index client
+            search_index (str): The search index
+
+        Returns:
+            Optional[bool]: Whether the index exists, or None if not
+                cached or expired
+        """
+        with self.__lock:
+            entry = self.__entries.get((index_client, search_index))
+            if entry is None or entry[1] <= time.monotonic():
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[0]
+
+    def put(self, index_client: SearchIndexClient, search_index: str,
+            exists: bool) -> None:
+        """
+        Remembers whether the index exists.
+
+        Args:
+            index_client (SearchIndexClient): The search index client
+            search_index (str): The search index
+            exists (bool): Whether the index exists
+        """
+        ttl = self.positive_ttl if exists else self.negative_ttl
+        with self.__lock:
+            self.__entries[(index_client, search_index)] = \
+                (exists, time.monotonic() + ttl)
+
+    def invalidate(self, search_index: str) -> None:
+        """
+        Forgets the index for all index clients.
+
+        Args:
+            search_index (str): The search index
+        """
+        with self.__lock:
+            for key in [key for key in self.__entries
+                        if key[1] == search_index]:
+                del self.__entries[key]
+
+    def clear(self) -> None:
+        """
+        Forgets all indexes, and resets the counters.
+        """
+        with self.__lock:
+            self.__entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+def invalidate_index_cache(search_index: str) -> None:
+    """
+    Invalidates the cached existence of a search index. Call this
+    whenever the index is created or deleted.
+
+    Args:
+        search_index (str): The search index
+    """
+    logging.info('Invalidating cached existence of %s', search_index)
+    IndexExistenceCache().invalidate(search_index)
 
 
 def is_index_ready(search_index: str,
@@ -43,7 +144,8 @@ def is_index_ready(search_index: str,
 def does_index_exist(search_index: str,
                      index_client: SearchIndexClient) -> bool:
     """
-    Checks if a search index exists.
+    Checks if a search index exists. The result is cached by
+    IndexExistenceCache.
 
     Args:
         search_index (str): The search index
@@ -52,11 +154,20 @@ def does_index_exist(search_index: str,
     Returns:
         bool: True if the index exists, False if not
     """
+    cache = IndexExistenceCache()
+    cached = cache.get(index_client, search_index)
+    if cached is not None:
+        logging.info('Index %s existence is cached: %s', search_index, cached)
+        return cached
+
     logging.info('Checking if index %s exists', search_index)
     try:
         index_client.get_index(search_index)
         logging.info('%s found.', search_index)
-        return True
+        exists = True
     except ResourceNotFoundError:
         logging.error('%s not found.', search_index)
-        return False
+        exists = False
+
+    cache.put(index_client, search_index, exists)
+    return exists
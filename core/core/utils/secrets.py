@@ -9,6 +9,10 @@ variables required by the application. Strictly loading such
 environment variables allows the function to fail-first, signalling to
 the developer that something is wrong from the onset, rather than
 during usage.
+
+Optional settings (tuning knobs with sensible defaults) are loaded
+alongside the strict secrets, but fall back to their defaults when the
+environment variable is not set.
 """
 
 import os
@@ -68,6 +72,45 @@ class Secrets(metaclass=Singleton):
         "SMTPPassword",
         "UploaderBaseURL"
     ]
+    __optional_from_env: dict[str, str] = {
+        # serial | concurrent
+        "ChatRetrievalMode": "serial",
+        # serial | parallel | hedged
+        "ChatHistoryStrategy": "serial",
+        "ChatHistoryHedgeDelayMs": "1500",
+        "ChatStreaming": "false",
+        "DatabasePoolSize": "5",
+        "DatabaseMaxOverflow": "10",
+        "DatabasePoolRecycle": "1800",
+        "DatabasePoolPrePing": "true",
+        # blob | container
+        "CitationSasMode": "blob",
+        # default | detailed | small
+        "ImageCompressionPreset": "default",
+        # memory | sql | none
+        "ImageSummaryCache": "memory",
+        # sha256 | dhash
+        "ImageSummaryCacheKey": "sha256",
+        # seconds
+        "GPT4VConnectTimeout": "10",
+        "GPT4VReadTimeout": "120",
+        # refine | mapreduce
+        "SummarizationStrategy": "refine",
+        "SummarizationWorkers": "4",
+        # input tokens per call
+        "SummarizationTokenBudget": "6000",
+        # storage | memory | sync
+        "SummarizationQueue": "storage",
+        "AzureWebJobsStorage": "UseDevelopmentStorage=true",
+        "EmbeddingBatchSize": "16",
+        "EmbeddingWorkers": "4",
+        "IngestionPageWindow": "20",
+        "IngestionBatchSize": "64",
+        "ChunkingStrategy": "headings",
+        "ChunkTokens": "512",
+        "ChunkOverlapTokens": "64",
+        "IngestionCache": "sql",
+    }
 
     def __init__(self) -> None:
         self.__loaded_vars: Optional[dict[str, str]] = {}
@@ -79,6 +122,8 @@ class Secrets(metaclass=Singleton):
             if env not in os.environ:
                 raise SecretsException(f"Missing environment variable: {env}")
             self.__loaded_vars[env] = os.environ[env]
+        for env, default in self.__optional_from_env.items():
+            self.__loaded_vars[env] = os.environ.get(env, default)
 
     def get(self, key: str) -> str:
         """
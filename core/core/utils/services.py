@@ -18,6 +18,11 @@ Moreover, modularizing services this way allows us to more easily mock
 it for tests.
 """
 
+import threading
+from contextlib import contextmanager
+from importlib import import_module
+from typing import Iterator, Optional, cast
+
 from azure.core.credentials import AzureKeyCredential
 from azure.ai.formrecognizer import DocumentAnalysisClient
 from azure.messaging.webpubsubservice import (  # type: ignore[import-untyped]
@@ -27,10 +32,16 @@ from azure.storage.blob import BlobServiceClient, ContainerClient
 from langchain_core.utils import convert_to_secret_str
 from langchain_openai import AzureOpenAIEmbeddings
 from openai import AzureOpenAI
-from sqlalchemy.orm import Session
+from sqlalchemy import Engine
+from sqlalchemy.orm import Session, scoped_session
 
-from utils.db import create_session
+from utils.db import create_db_engine, create_scoped_session
 from utils.image_summary import ImageSummary
+from utils.image_summary_cache import (ImageSummaryCache,
+                                       InMemorySummaryStore,
+                                       SqlSummaryStore, SummaryStore)
+from utils.job_queue import (SUMMARIZATION_QUEUE_NAME, InMemoryJobQueue,
+                             JobQueue, StorageJobQueue)
 from utils.secrets import Secrets
 from utils.singleton import Singleton
 
@@ -50,17 +61,23 @@ class Services(metaclass=Singleton):
     def __init__(self):
         self._openai_chat_model = None
         self._image_summary_model = None
+        self._image_summary_cache = None
         self._webpubsub = None
         self._search = None
         self._image_blob_client = None
         self._doc_blob_client = None
         self._search_index_client = None
+        self._db_engine = None
         self._db_session = None
+        # Invocations run concurrently on a worker; the engine and its
+        # pool must only be created (and the schema ensured) once
+        self._db_lock = threading.Lock()
         self._embeddings = None
         self._document_analysis = None
         self._validation_container_client = None
         self._production_container_client = None
         self._document_cognitive_search_index = None
+        self._summarization_queue = None
 
     @property
     def openai_chat_model(self) -> AzureOpenAI:
@@ -96,10 +113,33 @@ class Services(metaclass=Singleton):
             self._image_summary_model = ImageSummary(
                 Secrets().get("GPT4VAPIBase"),
                 Secrets().get("GPT4VAPIKey"),
-                Secrets().get("GPT4VDeploymentName")
+                Secrets().get("GPT4VDeploymentName"),
+                connect_timeout=float(Secrets().get("GPT4VConnectTimeout")),
+                read_timeout=float(Secrets().get("GPT4VReadTimeout"))
             )
         return self._image_summary_model
 
+    @property
+    def image_summary_cache(self) -> ImageSummaryCache:
+        """
+        Gets the image summary cache, backed by the store configured
+        by ImageSummaryCache.
+
+        Returns:
+            ImageSummaryCache: The image summary cache.
+        """
+        if not self._image_summary_cache:
+            store: Optional[SummaryStore] = None
+            if Secrets().get("ImageSummaryCache") == 'memory':
+                store = InMemorySummaryStore()
+            elif Secrets().get("ImageSummaryCache") == 'sql':
+                store = SqlSummaryStore(lambda: self.db_session)
+            self._image_summary_cache = ImageSummaryCache(
+                store,
+                perceptual=Secrets().get("ImageSummaryCacheKey") == 'dhash'
+            )
+        return self._image_summary_cache
+
     @property
     def webpubsub(self) -> WebPubSubServiceClient:
         if not self._webpubsub:
@@ -147,17 +187,63 @@ class Services(metaclass=Singleton):
         return self._search_index_client
 
     @property
-    def db_session(self) -> Session:
+    def db_engine(self) -> Engine:
+        if not self._db_engine:
+            with self._db_lock:
+                if not self._db_engine:
+                    self._db_engine = create_db_engine(
+                        Secrets().get("DatabaseURL"),
+                        Secrets().get("DatabaseName"),
+                        Secrets().get("DatabaseUsername"),
+                        Secrets().get("DatabasePassword"),
+                        Secrets().get("DatabaseSelfSigned") != 'false',
+                        pool_size=int(Secrets().get("DatabasePoolSize")),
+                        max_overflow=int(
+                            Secrets().get("DatabaseMaxOverflow")),
+                        pool_recycle=int(
+                            Secrets().get("DatabasePoolRecycle")),
+                        pool_pre_ping=Secrets().get(
+                            "DatabasePoolPrePing") != 'false'
+                    )
+        return self._db_engine
+
+    def __db_session_registry(self) -> scoped_session[Session]:
         if not self._db_session:
-            self._db_session = create_session(
-                Secrets().get("DatabaseURL"),
-                Secrets().get("DatabaseName"),
-                Secrets().get("DatabaseUsername"),
-                Secrets().get("DatabasePassword"),
-                Secrets().get("DatabaseSelfSigned") != 'false'
-            )
+            # Outside of the lock, which creating the engine takes
+            engine = self.db_engine
+            with self._db_lock:
+                if not self._db_session:
+                    self._db_session = create_scoped_session(engine)
         return self._db_session
 
+    @property
+    def db_session(self) -> Session:
+        """
+        Gets the database session of the current thread. This is a
+        scoped session, which proxies the Session of the current
+        thread; hence, it is typed as one.
+
+        Returns:
+            Session: The database session
+        """
+        return cast(Session, self.__db_session_registry())
+
+    @contextmanager
+    def db_session_scope(self) -> Iterator[None]:
+        """
+        Scopes the database session of the current thread to a single
+        invocation. Wrap every function invocation with this.
+
+        The session is closed afterwards, which rolls back any
+        uncommitted work and returns its connection to the pool. The
+        session is only ever created if the invocation uses it.
+        """
+        try:
+            yield
+        finally:
+            if self._db_session is not None:
+                self._db_session.remove()
+
     @property
     def embeddings(self) -> AzureOpenAIEmbeddings:
         if not self._embeddings:
@@ -204,3 +290,29 @@ class Services(metaclass=Singleton):
                 AzureKeyCredential(Secrets().get("CognitiveSearchKey"))
             )
         return self._document_cognitive_search_index
+
+    def __run_summarization_job(self, job: dict) -> None:
+        # Resolved by name, like the queue trigger, as the worker
+        # depends on the services
+        worker = import_module('functions.summarization_worker')
+        with self.db_session_scope():
+            worker.process_job(job)
+
+    @property
+    def summarization_queue(self) -> JobQueue:
+        """
+        Gets the queue of summarization jobs, configured by
+        SummarizationQueue.
+
+        Returns:
+            JobQueue: The summarization queue.
+        """
+        if not self._summarization_queue:
+            if Secrets().get("SummarizationQueue") == 'memory':
+                self._summarization_queue = InMemoryJobQueue(
+                    self.__run_summarization_job)
+            else:
+                self._summarization_queue = StorageJobQueue(
+                    Secrets().get("AzureWebJobsStorage"),
+                    SUMMARIZATION_QUEUE_NAME)
+        return self._summarization_queue
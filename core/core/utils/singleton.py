@@ -2,6 +2,8 @@
 Represents a singleton. Credit: https://stackoverflow.com/a/6798042
 """
 
+import threading
+
 
 # This metaclass is excluded from unit tests, because its purpose is
 # to create classes with particular properties. It makes more sense to
@@ -13,9 +15,13 @@ class Singleton(type):
     Singleton metaclass. Use this metaclass to create a singleton class.
     """
     _instances: dict[object, object] = {}
+    # Instances may first be requested by concurrent invocations
+    _lock = threading.RLock()
 
     def __call__(cls, *args, **kwargs):
         if cls not in cls._instances:
-            cls._instances[cls] = super(Singleton, cls).\
-                __call__(*args, **kwargs)
+            with cls._lock:
+                if cls not in cls._instances:
+                    cls._instances[cls] = super(Singleton, cls).\
+                        __call__(*args, **kwargs)
         return cls._instances[cls]
@@ -0,0 +1,278 @@
+"""
+Strategies to summarize a conversation that has been split into chunks.
+
+refine walks the chunks in order, passing the summary thus far along
+with the next chunk. Every call waits on the previous one, so a long
+conversation takes as many round trips as it has chunks.
+
+map_reduce summarizes every chunk independently on a bounded worker
+pool, then merges the partial summaries, MERGE_FAN_IN at a time, until
+one is left. This takes about 1 + log(chunks) round trips, for a few
+more calls.
+
+Both can carry on from a previous summary, so only the messages since
+need to be summarized.
+
+The conversation is split into chunks of whole messages, packed up to
+a token budget per call (see split_conversation), and the calls and
+tokens spent are tallied in a SummaryUsage.
+"""
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import reduce
+from threading import Lock
+from typing import Callable, Optional
+
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from openai import AzureOpenAI
+from utils.tokens import get_token_counter
+
+SUMMARIZATION_PROMPT = (
+    "You are a summarization service. You will be iteratively passed chunks of"
+    " an entire chat history. Each message either begins with BOT or USER,"
+    " which represents the two different parties of the conversation. If the"
+    " message contains [USER IMAGE], it is the description of an image"
+    " uploaded by the USER, irregardless of the sender. You will receive, in"
+    " order, both the summary thus far (role: assistant), and the next chunk"
+    " of the conversation (role: user). You should summarize the conversation"
+    " up to that point."
+)
+
+MAP_PROMPT = (
+    "You are a summarization service. You will be passed one chunk of a"
+    " longer chat history. Each message either begins with BOT or USER,"
+    " which represents the two different parties of the conversation. If the"
+    " message contains [USER IMAGE], it is the description of an image"
+    " uploaded by the USER, irregardless of the sender. You should summarize"
+    " this chunk, keeping every fact that may matter to the rest of the"
+    " conversation."
+)
+
+MERGE_PROMPT = (
+    "You are a summarization service. You will be passed summaries of"
+    " consecutive parts of a chat history between a USER and a BOT, in"
+    " order, separated by blank lines. You should merge them into a single"
+    " summary of the conversation."
+)
+
+# Partial summaries merged by a single call
+MERGE_FAN_IN = 4
+# Concurrent calls to the summarization model
+SUMMARIZATION_WORKERS = 4
+# Input tokens per call: the prompt, the summary thus far and the chunk
+SUMMARIZATION_TOKEN_BUDGET = 6000
+# Room kept for the summary thus far (or the partial summaries)
+SUMMARY_TOKEN_RESERVE = 1000
+MESSAGE_SEPARATOR = '\n'
+
+
+class SummaryUsage:
+    """
+    Tallies the calls and tokens spent on a summary, as reported by
+    the model. Safe to share between threads.
+    """
+    def __init__(self) -> None:
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.__lock = Lock()
+
+    def add(self, prompt_tokens: int, completion_tokens: int) -> None:
+        """
+        Records a call.
+
+        Args:
+            prompt_tokens (int): The input tokens of the call
+            completion_tokens (int): The output tokens of the call
+        """
+        with self.__lock:
+            self.calls += 1
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+
+    @property
+    def total_tokens(self) -> int:
+        """
+        Gets the input and output tokens of all calls.
+        """
+        return self.prompt_tokens + self.completion_tokens
+
+
+def pack_messages(messages: list[str], budget: int,
+                  count_tokens: Callable[[str], int]) -> list[str]:
+    """
+    Packs whole messages, in order, into chunks of at most budget
+    tokens. A message longer than the budget is split on its own.
+
+    Args:
+        messages (list[str]): The messages, in order
+        budget (int): The tokens per chunk
+        count_tokens (Callable[[str], int]): Counts the tokens of a text
+
+    Returns:
+        list[str]: The chunks
+    """
+    separator_tokens = count_tokens(MESSAGE_SEPARATOR)
+    splitter = RecursiveCharacterTextSplitter(
+        chunk_size=budget, chunk_overlap=0, length_function=count_tokens)
+    chunks: list[str] = []
+    chunk: list[str] = []
+    chunk_tokens = 0
+    for message in messages:
+        tokens = count_tokens(message)
+        if chunk and chunk_tokens + separator_tokens + tokens > budget:
+            chunks.append(MESSAGE_SEPARATOR.join(chunk))
+            chunk, chunk_tokens = [], 0
+        if tokens > budget:
+            chunks.extend(splitter.split_text(message))
+            continue
+        chunk_tokens += tokens + (separator_tokens if chunk else 0)
+        chunk.append(message)
+    if chunk:
+        chunks.append(MESSAGE_SEPARATOR.join(chunk))
+    return chunks
+
+
+def split_conversation(messages: list[str], model: str,
+                       budget: int = SUMMARIZATION_TOKEN_BUDGET
+                       ) -> list[str]:
+    """
+    Splits a conversation into chunks for summarization. Each chunk
+    fits into a call along with the longest prompt, and
+    SUMMARY_TOKEN_RESERVE tokens for the summary thus far.
+
+    Args:
+        messages (list[str]): The messages, in order
+        model (str): The summarization model
+        budget (int): The input tokens per call
+
+    Returns:
+        list[str]: The chunks
+    """
+    count_tokens = get_token_counter(model)
+    prompt_tokens = max(count_tokens(prompt) for prompt in (
+        SUMMARIZATION_PROMPT, MAP_PROMPT, MERGE_PROMPT))
+    chunk_budget = budget - prompt_tokens - SUMMARY_TOKEN_RESERVE
+    if chunk_budget <= 0:
+        raise ValueError(f'Token budget {budget} is too small, it must be'
+                         f' over {prompt_tokens + SUMMARY_TOKEN_RESERVE}')
+    return pack_messages(messages, chunk_budget, count_tokens)
+
+
+def __complete(client: AzureOpenAI, model: str,
+               messages: list[dict[str, str]],
+               usage: Optional[SummaryUsage]) -> str:
+    """
+    Gets a completion from the summarization model.
+    """
+    chat_response = client.chat.completions.create(
+        model=model,
+        messages=messages,  # type: ignore[arg-type]
+    )
+    if usage is not None:
+        usage.add(chat_response.usage.prompt_tokens
+                  if chat_response.usage else 0,
+                  chat_response.usage.completion_tokens
+                  if chat_response.usage else 0)
+
+    response = chat_response.choices[0].message.content
+    assert response is not None
+    return response
+
+
+def summarize_refine(chunks: list[str], client: AzureOpenAI,
+                     model: str, previous: str = "", *,
+                     usage: Optional[SummaryUsage] = None) -> str:
+    """
+    Summarizes chunks one after another, refining the summary thus far
+    with the next chunk.
+
+    Args:
+        chunks (list[str]): The chunks of the conversation, in order
+        client (AzureOpenAI): The OpenAI client
+        model (str): The summarization model
+        previous (str): The summary of the conversation before the
+            chunks, if any
+
+    Keyword Args:
+        usage (Optional[SummaryUsage]): Tallies the calls and tokens
+
+    Returns:
+        str: The summary
+    """
+    def obtain_summary(prev_summary: str, next_chunk: str) -> str:
+        return __complete(client, model, [{
+            "role": "system",
+            "content": SUMMARIZATION_PROMPT
+        }, {
+            "role": "assistant",
+            "content": prev_summary
+        }, {
+            "role": "user",
+            "content": next_chunk
+        }], usage)
+
+    return reduce(obtain_summary, chunks, previous)
+
+
+# pylint: disable=too-many-arguments
+def summarize_map_reduce(chunks: list[str], client: AzureOpenAI,
+                         model: str,
+                         workers: int = SUMMARIZATION_WORKERS,
+                         previous: str = "", *,
+                         usage: Optional[SummaryUsage] = None) -> str:
+    """
+    Summarizes chunks concurrently, then merges the partial summaries
+    hierarchically, MERGE_FAN_IN at a time. The order of the chunks is
+    kept throughout.
+
+    Args:
+        chunks (list[str]): The chunks of the conversation, in order
+        client (AzureOpenAI): The OpenAI client
+        model (str): The summarization model
+        workers (int): Upper bound of concurrent calls
+        previous (str): The summary of the conversation before the
+            chunks, if any. It is merged as the first partial summary
+
+    Keyword Args:
+        usage (Optional[SummaryUsage]): Tallies the calls and tokens
+
+    Returns:
+        str: The summary
+    """
+    if not chunks:
+        return previous
+
+    def summarize(chunk: str) -> str:
+        return __complete(client, model, [{
+            "role": "system",
+            "content": MAP_PROMPT
+        }, {
+            "role": "user",
+            "content": chunk
+        }], usage)
+
+    def merge(summaries: list[str]) -> str:
+        if len(summaries) == 1:
+            return summaries[0]
+        return __complete(client, model, [{
+            "role": "system",
+            "content": MERGE_PROMPT
+        }, {
+            "role": "user",
+            "content": '\n\n'.join(summaries)
+        }], usage)
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        summaries = ([previous] if previous else []) + \
+            list(executor.map(summarize, chunks))
+        level = 0
+        while len(summaries) > 1:
+            level += 1
+            logging.info('Merging %d partial summaries (level %d)',
+                         len(summaries), level)
+            summaries = list(executor.map(merge, [
+                summaries[i:i + MERGE_FAN_IN]
+                for i in range(0, len(summaries), MERGE_FAN_IN)]))
+    return summaries[0]
@@ -0,0 +1,39 @@
+"""
+Counting tokens with tiktoken, to size requests to OpenAI models.
+"""
+
+import logging
+from functools import lru_cache
+from typing import Callable
+
+import tiktoken
+
+# Used if the model is unknown to tiktoken (e.g. a deployment name)
+DEFAULT_ENCODING = 'cl100k_base'
+# Rough estimate, if the encoding cannot be loaded
+CHARS_PER_TOKEN = 4
+
+
+@lru_cache(maxsize=None)
+def get_token_counter(model: str) -> Callable[[str], int]:
+    """
+    Gets a function counting the tokens of a text for a model. The
+    tiktoken encoding is downloaded on first use; if that fails, tokens
+    are estimated from the length of the text instead.
+
+    Args:
+        model (str): The model name
+
+    Returns:
+        Callable[[str], int]: The token counter
+    """
+    try:
+        try:
+            encoding = tiktoken.encoding_for_model(model)
+        except KeyError:
+            encoding = tiktoken.get_encoding(DEFAULT_ENCODING)
+    except OSError as e:
+        logging.warning('Cannot load the tiktoken encoding of %s (%s);'
+                        ' estimating tokens instead', model, e)
+        return lambda text: -(-len(text) // CHARS_PER_TOKEN)
+    return lambda text: len(encoding.encode(text, disallowed_special=()))
@@ -1,28 +1,139 @@
 """
 Verifies a JWT token.
+
+Every request verifies the same token more than once (e.g. the auth
+guard, then obtaining the user ID). To avoid repeating the signature
+verification, TokenVerifier caches the decoded claims of valid tokens
+until they expire, along with the parsed public key.
 """
 
+import hashlib
 import logging
+import time
+from threading import Lock
+from typing import Any, Optional
+
 import jwt
+from jwt.algorithms import get_default_algorithms
+
 from utils.secrets import Secrets
+from utils.singleton import Singleton
+
+# Upper bound of tokens to remember. Expired tokens are evicted first.
+MAX_CACHED_TOKENS = 1024
+
+
+class TokenVerifier(metaclass=Singleton):
+    """
+    Process-wide token verifier. Verifies a token once, and caches its
+    claims keyed by the token digest until the token expires.
+    """
+    def __init__(self) -> None:
+        self.hits = 0
+        self.misses = 0
+        self.__claims: dict[str, tuple[dict[str, Any], float]] = {}
+        self.__keys: dict[tuple[str, str], Any] = {}
+        self.__lock = Lock()
+
+    def __get_key(self, algorithm: str) -> Any:
+        """
+        Gets the parsed public key for an algorithm, parsing it on the
+        first use.
+        """
+        public_key = Secrets().get('ClerkPublicKey')
+        with self.__lock:
+            if (public_key, algorithm) not in self.__keys:
+                self.__keys[(public_key, algorithm)] = \
+                    get_default_algorithms()[algorithm].prepare_key(
+                        public_key)
+            return self.__keys[(public_key, algorithm)]
+
+    def __remember(self, digest: str, claims: dict[str, Any]) -> None:
+        """
+        Caches the claims of a valid token until it expires. Tokens
+        without an expiry are not cached.
+        """
+        if 'exp' not in claims:
+            return
+
+        with self.__lock:
+            if len(self.__claims) >= MAX_CACHED_TOKENS:
+                now = time.time()
+                for expired in [d for d, (_, exp) in self.__claims.items()
+                                if exp <= now]:
+                    del self.__claims[expired]
+            if len(self.__claims) >= MAX_CACHED_TOKENS:
+                del self.__claims[next(iter(self.__claims))]
+            self.__claims[digest] = (claims, float(claims['exp']))
+
+    def decode(self, token: Optional[str]) -> Optional[dict[str, Any]]:
+        """
+        Verifies a token, and returns its claims.
+
+        Args:
+            token (Optional[str]): The token
+
+        Returns:
+            Optional[dict[str, Any]]: The claims, or None if the token
+                is invalid
+        """
+        if not token:
+            logging.error("Token is missing")
+            return None
+
+        digest = hashlib.sha256(token.encode()).hexdigest()
+        with self.__lock:
+            cached = self.__claims.get(digest)
+            if cached is not None and cached[1] > time.time():
+                self.hits += 1
+                return cached[0]
+            self.misses += 1
+
+        try:
+            headers = jwt.get_unverified_header(token)
+            # Note: jwt.decode automatically checks for expiration
+            claims = jwt.decode(token, key=self.__get_key(headers['alg']),
+                                algorithms=headers['alg'])
+        except jwt.exceptions.ExpiredSignatureError:
+            logging.error("Token has expired")
+            return None
+        except jwt.exceptions.InvalidTokenError:
+            logging.error("Token is invalid")
+            return None
+        except Exception:  # pylint: disable=broad-except
+            logging.error('Other Exception occured')
+            return None
+
+        self.__remember(digest, claims)
+        return claims
+
+    def verify(self, token: Optional[str]) -> bool:
+        """
+        Verifies a token is valid, from the right source and has not
+        expired.
+        """
+        claims = self.decode(token)
+        azp_list = Secrets().get('ClerkAZPList').split(',')
+        return claims is not None and claims.get('azp') in azp_list
+
+    def get_user_id(self, token: Optional[str]) -> Optional[str]:
+        """
+        Gets the user ID from a valid token.
+        """
+        claims = self.decode(token)
+        return claims.get('sub') if claims is not None else None
+
+    def clear(self) -> None:
+        """
+        Forgets all cached claims and keys, and resets the counters.
+        """
+        with self.__lock:
+            self.__claims.clear()
+            self.__keys.clear()
+            self.hits = 0
+            self.misses = 0
 
 
 def verify_token(token):
     """Verify a token is valid, from the right source and has not expired."""
-    public_key = Secrets().get('ClerkPublicKey')
-    azp_list = Secrets().get('ClerkAZPList').split(',')
-
-    try:
-        headers = jwt.get_unverified_header(token)
-        # Note: jwt.decode automatically checks for expiration
-        decoded = jwt.decode(token, key=public_key, algorithms=headers['alg'])
-        return decoded['azp'] in azp_list
-    except jwt.exceptions.ExpiredSignatureError:
-        logging.error("Token has expired")
-        return False
-    except jwt.exceptions.InvalidTokenError:
-        logging.error("Token is invalid")
-        return False
-    except Exception:  # pylint: disable=broad-except
-        logging.error('Other Exception occured')
-        return False
+    return TokenVerifier().verify(token)